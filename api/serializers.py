@@ -78,3 +78,17 @@ class FeedingLogSerializer(serializers.ModelSerializer):
             "device_owner",
         ]
         depth = 0
+
+
+class FeedingLogEventSerializer(serializers.ModelSerializer):
+    idempotency_key = serializers.CharField(max_length=64)
+
+    class Meta:
+        model = FeedingLog
+        fields = [
+            "idempotency_key",
+            "pet_name",
+            "feed_type",
+            "feed_amt",
+            "feed_timestamp",
+        ]
@@ -1,3 +1,754 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import json
+import re
+import tempfile
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from asgiref.sync import sync_to_async
+from django.db import connection
+from django.test import AsyncClient, Client, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework.throttling import UserRateThrottle
+
+from app.device_cache import DeviceOwnerCache, device_owner_cache
+from app.event_channel import LocalEventChannel, RedisEventChannel, get_event_channel
+from app.device_context import load_device_context
+from app.feeding_log import archive_feeding_log, insert_feedings, record_feedings
+from app.hopper import refill
+from app.models import (
+    Device,
+    DeviceOwner,
+    DeviceStatus,
+    EventQueue,
+    FeederModel,
+    FeedingLog,
+    FeedingSchedule,
+    FeedingScheduleRemoval,
+    MessageQueue,
+    MotorTiming,
+    NotificationAlertTracking,
+    NotificationSettings,
+    Pet,
+    Settings,
+    TelemetryRollup,
+)
+from app.tasks import (
+    archive_old_feeding_log,
+    check_offline_status,
+    check_pushover_message_queue,
+    rebuild_feeding_rollups,
+    reconcile_device_hopper_levels,
+    rollup_device_telemetry,
+)
+from app.utils import complete_events, get_device_id, get_settings, is_device_registered, pending_events, queue_events
+
+
+class DeviceAPITestCase(TestCase):
+    """
+    Registered feeder with token and device key, as seen by the device endpoints
+    """
+
+    def setUp(self):
+        throttle = mock.patch.object(UserRateThrottle, "allow_request", return_value=True)
+        throttle.start()
+        self.addCleanup(throttle.stop)
+        cache.clear()
+        device_owner_cache.clear()
+
+        self.motor_timing = MotorTiming.objects.create(feed_amount=0.25, motor_duration=1000, interrupter_count=7)
+        self.feeder_model = FeederModel.objects.create(
+            brand_name="Petnet", model_name="SmartFeeder", hopper_capacity=20
+        )
+        self.user = User.objects.create_user(username="feeder-owner", email="owner@example.com", password="secret")
+        NotificationSettings.objects.create(user=self.user, pushover_user_key="", pushover_devices="")
+        self.device = Device.objects.create(
+            control_board_identifier="ESP32-abcd-0123abcd", secret_key="0123456789abcde"
+        )
+        # The settings (400) event of the new feeder is queued once the registration commits
+        with self.captureOnCommitCallbacks(execute=True):
+            self.device_owner = DeviceOwner.objects.create(
+                device=self.device,
+                user=self.user,
+                name="Kitchen",
+                device_key="0123456789abcdef0123456789abcdef",
+                feeder_model=self.feeder_model,
+                manual_motor_timing=self.motor_timing,
+            )
+        self.client = APIClient()
+        self.client.credentials(
+            HTTP_AUTHORIZATION="Token %s" % self.user.auth_token.key,
+            HTTP_X_DEVICE_KEY=self.device_owner.device_key,
+        )
+
+    def post_json(self, path, data):
+        return self.client.post(path, json.dumps(data), content_type="application/json")
+
+
+class HeartbeatTest(DeviceAPITestCase):
+    def test_heartbeat_updates_status(self):
+        response = self.post_json("/api/device/heartbeat/", {"battery_soc": 88.5, "on_power": True})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(DeviceStatus.objects.get(device=self.device).battery_soc, 88.5)
+
+    def test_heartbeat_query_count(self):
+        # token auth, device context, status update, telemetry sample, pending event
+        with self.assertNumQueries(5):
+            response = self.post_json("/api/device/heartbeat/", {"battery_soc": 88.5, "on_power": True})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["event"]["event_code"], 400)
+
+        # the next ping within the sample interval only updates the status
+        with self.assertNumQueries(4):
+            self.post_json("/api/device/heartbeat/", {"battery_soc": 88.0, "on_power": True})
+
+    def test_heartbeat_sends_back_online_alert(self):
+        NotificationSettings.objects.filter(user=self.user).update(feeder_offline=True)
+        NotificationAlertTracking.objects.filter(device_owner=self.device_owner).update(offline_alert=True)
+
+        self.post_json("/api/device/heartbeat/", {"on_power": True})
+
+        self.assertFalse(NotificationAlertTracking.objects.get(device_owner=self.device_owner).offline_alert)
+        self.assertEqual(self.user.messagequeue_set.get().message, "Your feeder is back online.")
+
+    def test_heartbeat_alerts_are_written_together(self):
+        NotificationSettings.objects.filter(user=self.user).update(
+            feeder_offline=True, power_disconnected=True, low_hopper=True, low_battery=True
+        )
+        self.post_json("/api/device/heartbeat/", {"on_power": True})
+
+        # power loss and low hopper: one UPDATE of the alert flags in a savepoint and one INSERT of both messages
+        with self.assertNumQueries(4 + 4):
+            self.post_json("/api/device/heartbeat/", {"on_power": False, "is_hopper_low": True})
+
+        alert = NotificationAlertTracking.objects.get(device_owner=self.device_owner)
+        self.assertTrue(alert.power_disconnect_alert)
+        self.assertTrue(alert.low_hopper_alert)
+        self.assertEqual(
+            list(self.user.messagequeue_set.order_by("id").values_list("message", flat=True)),
+            [
+                "Power has been disconnected from your feeder. It is currently running on battery.",
+                "Your feeder is low on food. Please refill the hopper as soon as possible.",
+            ],
+        )
+
+        # nothing changed, nothing written
+        with self.assertNumQueries(4):
+            self.post_json("/api/device/heartbeat/", {"on_power": False, "is_hopper_low": True})
+
+    def test_unknown_device_key_is_rejected(self):
+        self.client.credentials(
+            HTTP_AUTHORIZATION="Token %s" % self.user.auth_token.key,
+            HTTP_X_DEVICE_KEY="not-a-key",
+        )
+
+        response = self.post_json("/api/device/heartbeat/", {"on_power": True})
+
+        self.assertEqual(response.status_code, 403)
+
+
+class EventTaskCompletedTest(DeviceAPITestCase):
+    def test_event_is_completed(self):
+        event = EventQueue.objects.get(device_owner=self.device_owner, status_code="P")
+
+        response = self.post_json("/api/event/task-completed/", {"id": event.id})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(EventQueue.objects.get(id=event.id).status_code, "C")
+        self.assertFalse(DeviceStatus.objects.get(device=self.device).has_event)
+
+
+class BatchEventTest(DeviceAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.settings_sync = EventQueue.objects.get(device_owner=self.device_owner, status_code="P")
+        self.schedule_sync = EventQueue.objects.create(device_owner=self.device_owner, event_code=300)
+        self.firmware = EventQueue.objects.create(device_owner=self.device_owner, event_code=800)
+        self.latest_settings_sync = EventQueue.objects.create(device_owner=self.device_owner, event_code=400)
+
+    def test_heartbeat_returns_latest_event_of_each_code(self):
+        response = self.post_json("/api/device/heartbeat/", {"on_power": True})
+
+        events = response.data["events"]
+        self.assertEqual(
+            [e["id"] for e in events], [self.schedule_sync.id, self.firmware.id, self.latest_settings_sync.id]
+        )
+        self.assertEqual(response.data["event"]["id"], self.schedule_sync.id)
+
+    @override_settings(DEVICE_EVENT_BATCH_SIZE=2)
+    def test_heartbeat_events_are_capped(self):
+        response = self.post_json("/api/device/heartbeat/", {"on_power": True})
+
+        self.assertEqual(len(response.data["events"]), 2)
+
+    def test_batch_ack_completes_events_and_superseded_duplicates(self):
+        # token auth, device context, complete events, recompute has_event and ping
+        with self.assertNumQueries(4):
+            response = self.post_json(
+                "/api/event/tasks-completed/", {"ids": [self.schedule_sync.id, self.latest_settings_sync.id]}
+            )
+
+        self.assertEqual(response.data["completed"], 3)
+        self.assertEqual(
+            list(EventQueue.objects.filter(status_code="P").values_list("id", flat=True)), [self.firmware.id]
+        )
+        self.assertTrue(DeviceStatus.objects.get(device=self.device).has_event)
+
+        self.post_json("/api/event/tasks-completed/", {"ids": [self.firmware.id]})
+
+        self.assertFalse(DeviceStatus.objects.get(device=self.device).has_event)
+
+    def test_manual_feeds_are_delivered_and_completed_one_by_one(self):
+        feeds = [
+            EventQueue.objects.create(device_owner=self.device_owner, event_code=100, json_payload={"feed_amt": amount})
+            for amount in (0.25, 0.5)
+        ]
+
+        response = self.post_json("/api/device/heartbeat/", {"on_power": True})
+
+        events = [e for e in response.data["events"] if e["event_code"] == 100]
+        self.assertEqual(
+            [(e["id"], e["json_payload"]["feed_amt"]) for e in events], [(feeds[0].id, 0.25), (feeds[1].id, 0.5)]
+        )
+
+        self.post_json("/api/event/tasks-completed/", {"ids": [feeds[1].id]})
+
+        self.assertEqual(EventQueue.objects.get(id=feeds[0].id).status_code, "P")
+        self.assertEqual(EventQueue.objects.get(id=feeds[1].id).status_code, "C")
+
+    def test_batch_ack_ignores_other_devices_events(self):
+        other_user = User.objects.create_user(username="other", email="other@example.com", password="secret")
+        other_device = Device.objects.create(
+            control_board_identifier="ESP32-abcd-ffffffff", secret_key="0123456789abcde"
+        )
+        other_owner = DeviceOwner.objects.create(
+            device=other_device,
+            user=other_user,
+            name="Garage",
+            device_key="ffffffffffffffffffffffffffffffff",
+            feeder_model=self.feeder_model,
+            manual_motor_timing=self.motor_timing,
+        )
+        other_event = EventQueue.objects.create(device_owner=other_owner, event_code=400)
+
+        response = self.post_json("/api/event/tasks-completed/", {"ids": [other_event.id]})
+
+        self.assertEqual(response.data["completed"], 0)
+        self.assertEqual(EventQueue.objects.get(id=other_event.id).status_code, "P")
+
+    def test_bad_ids_are_rejected(self):
+        response = self.post_json("/api/event/tasks-completed/", {"ids": "1,2"})
+
+        self.assertEqual(response.status_code, 400)
+
+        for body in ["{not json", "[1, 2]", ""]:
+            response = self.client.post("/api/event/tasks-completed/", body, content_type="application/json")
+            self.assertEqual(response.status_code, 400)
+
+
+class WaitForEventTest(DeviceAPITestCase):
+    def test_tests_use_the_local_channel(self):
+        self.assertIsInstance(get_event_channel(), LocalEventChannel)
+        with override_settings(DEVICE_EVENT_CHANNEL_URL="redis://127.0.0.1:6379/2"):
+            self.assertEqual(get_event_channel().url, "redis://127.0.0.1:6379/2")
+        self.assertNotIsInstance(get_event_channel(), RedisEventChannel)
+
+    def wait(self, device_key=None, **params):
+        return AsyncClient().get(
+            "/api/event/wait/",
+            params,
+            AUTHORIZATION="Token %s" % self.user.auth_token.key,
+            **{"X-Device-Key": device_key or self.device_owner.device_key},
+        )
+
+    async def test_pending_event_is_returned_right_away(self):
+        response = await self.wait(timeout=5)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["event"]["event_code"], 400)
+
+    async def test_timeout_without_event(self):
+        await sync_to_async(EventQueue.objects.update)(status_code="C")
+
+        response = await self.wait(timeout=0.05)
+
+        self.assertFalse(response.json()["has_event"])
+
+    async def test_enqueued_event_wakes_the_request(self):
+        await sync_to_async(EventQueue.objects.update)(status_code="C")
+
+        def enqueue():
+            with self.captureOnCommitCallbacks(execute=True):
+                EventQueue.objects.create(device_owner=self.device_owner, event_code=100)
+
+        async def enqueue_later():
+            await asyncio.sleep(0.1)
+            await sync_to_async(enqueue)()
+
+        started = time.monotonic()
+        response, _ = await asyncio.gather(self.wait(timeout=10), enqueue_later())
+
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(response.json()["event"]["event_code"], 100)
+
+    async def test_unknown_device_key_is_rejected(self):
+        response = await self.wait(device_key="not-a-key")
+
+        self.assertEqual(response.status_code, 403)
+
+
+class ScheduleSyncTest(DeviceAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.pet = Pet.objects.create(user=self.user, name="Tom")
+        self.breakfast = self.add_schedule("Breakfast", "07:00:00")
+        self.dinner = self.add_schedule("Dinner", "18:00:00")
+
+    def add_schedule(self, meal_name, time, device_owner=None):
+        device_owner = device_owner or self.device_owner
+        return FeedingSchedule.objects.create(
+            device=device_owner.device,
+            device_owner=device_owner,
+            pet=self.pet,
+            meal_name=meal_name,
+            time=time,
+            local_time=time,
+            motor_timing=self.motor_timing,
+        )
+
+    def get_schedule(self, etag=None, **params):
+        headers = {"HTTP_IF_NONE_MATCH": etag} if etag else {}
+        return self.client.get("/api/feeding-schedule/", params, **headers)
+
+    def test_unchanged_schedule_is_not_modified(self):
+        response = self.get_schedule()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data["results"]), 2)
+
+        # token auth and schedule version, the device owner is cached
+        with self.assertNumQueries(2):
+            response = self.get_schedule(response["ETag"])
+
+        self.assertEqual(response.status_code, 304)
+
+    def test_changed_schedule_has_new_etag(self):
+        etag = self.get_schedule()["ETag"]
+
+        self.breakfast.time = "07:30:00"
+        self.breakfast.save()
+
+        response = self.get_schedule(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_diff_since_version(self):
+        version = int(self.get_schedule()["X-Schedule-Version"])
+        self.breakfast.meal_name = "Early breakfast"
+        self.breakfast.save()
+        lunch = self.add_schedule("Lunch", "12:00:00")
+        dinner_id = self.dinner.id
+        self.dinner.delete()
+
+        response = self.get_schedule(since=version)
+
+        self.assertEqual([row["id"] for row in response.data["added"]], [lunch.id])
+        self.assertEqual([row["meal_name"] for row in response.data["changed"]], ["Early breakfast"])
+        self.assertEqual(response.data["removed"], [dinner_id])
+        self.assertEqual(response.data["version"], int(response["X-Schedule-Version"]))
+
+        response = self.get_schedule(since=response.data["version"])
+        self.assertEqual((response.data["added"], response.data["changed"], response.data["removed"]), ([], [], []))
+
+    def test_diff_reports_deactivated_moved_and_pet_changes(self):
+        version = int(self.get_schedule()["X-Schedule-Version"])
+        other_device = Device.objects.create(
+            control_board_identifier="ESP32-abcd-ffffffff", secret_key="0123456789abcde"
+        )
+        other_owner = DeviceOwner.objects.create(
+            device=other_device,
+            user=self.user,
+            name="Garage",
+            device_key="ffffffffffffffffffffffffffffffff",
+            feeder_model=self.feeder_model,
+            manual_motor_timing=self.motor_timing,
+        )
+        self.breakfast.active_flag = False
+        self.breakfast.save()
+        self.dinner.device_owner = other_owner
+        self.dinner.device = other_device
+        self.dinner.save()
+
+        response = self.get_schedule(since=version)
+        self.assertEqual(sorted(response.data["removed"]), [self.breakfast.id, self.dinner.id])
+
+        version = response.data["version"]
+        self.breakfast.active_flag = True
+        self.breakfast.save()
+        self.pet.name = "Thomas"
+        self.pet.save()
+
+        response = self.get_schedule(since=version)
+        self.assertEqual(response.data["changed"][0]["pet"]["name"], "Thomas")
+        self.assertEqual(response.data["removed"], [])
+
+    def test_changed_motor_timing_is_served(self):
+        response = self.get_schedule()
+        etag, version = response["ETag"], int(response["X-Schedule-Version"])
+
+        self.motor_timing.motor_duration = 4500
+        self.motor_timing.save()
+
+        response = self.get_schedule(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({row["motor_timing"]["motor_duration"] for row in response.data["results"]}, {4500})
+        response = self.get_schedule(since=version)
+        self.assertEqual([row["motor_timing"]["motor_duration"] for row in response.data["changed"]], [4500, 4500])
+
+    def test_removed_device_owner_leaves_no_removals(self):
+        self.device_owner.delete()
+
+        self.assertFalse(FeedingSchedule.objects.exists())
+        self.assertFalse(FeedingScheduleRemoval.objects.exists())
+
+    def test_diff_without_version_resets(self):
+        response = self.get_schedule(since=0)
+
+        self.assertTrue(response.data["reset"])
+        self.assertEqual(len(response.data["added"]), 2)
+
+
+class DeviceOwnerCacheTest(DeviceAPITestCase):
+    def test_cache_hit_costs_no_queries(self):
+        load_device_context(self.user.id, self.device_owner.device_key)
+
+        with self.assertNumQueries(0):
+            context = load_device_context(self.user.id, self.device_owner.device_key)
+
+        self.assertEqual(context.device_owner.id, self.device_owner.id)
+        self.assertEqual(context.device_owner.name, "Kitchen")
+
+    def test_rekeyed_device_is_invalidated(self):
+        old_key = self.device_owner.device_key
+        load_device_context(self.user.id, old_key)
+
+        self.device_owner.device_key = "fedcba9876543210fedcba9876543210"
+        self.device_owner.save()
+
+        self.assertIsNone(load_device_context(self.user.id, old_key))
+        self.assertIsNotNone(load_device_context(self.user.id, self.device_owner.device_key))
+
+    def test_row_cached_before_the_commit_is_invalidated(self):
+        old_key = self.device_owner.device_key
+        old_row = DeviceOwner.objects.get(id=self.device_owner.id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.device_owner.device_key = "fedcba9876543210fedcba9876543210"
+            self.device_owner.save()
+            # A concurrent request still reads the old row before the commit
+            device_owner_cache.set(old_row)
+
+        self.assertIsNone(load_device_context(self.user.id, old_key))
+
+    def test_shared_tier_needs_a_shared_backend(self):
+        self.assertIsNone(DeviceOwnerCache().shared)
+        with tempfile.TemporaryDirectory() as directory:
+            backend = {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": directory}
+            with override_settings(CACHES={"default": backend}):
+                self.assertIsNotNone(DeviceOwnerCache().shared)
+
+    def test_removed_device_is_invalidated(self):
+        load_device_context(self.user.id, self.device_owner.device_key)
+
+        self.device_owner.delete()
+
+        self.assertIsNone(load_device_context(self.user.id, self.device_owner.device_key))
+        response = self.post_json("/api/device/heartbeat/", {"on_power": True})
+        self.assertEqual(response.status_code, 403)
+
+
+@override_settings(ALLOWED_API_CLIENTS=["SmartPetFeederApp"])
+class TelemetryAPITest(DeviceAPITestCase):
+    def test_range_query_reads_rollups(self):
+        start = int(time.time()) // 3600 * 3600 - 86400
+        TelemetryRollup.objects.create(
+            device=self.device, resolution=3600, bucket=start, samples=60, on_power_samples=30, battery_soc_avg=805
+        )
+
+        response = self.client.get(
+            "/api/device/telemetry/%d/?start=%d&end=%d" % (self.device_owner.id, start, start + 2 * 86400),
+            HTTP_USER_AGENT="SmartPetFeederApp",
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["resolution"], 3600)
+        self.assertEqual(response.data["points"][0]["battery_soc_avg"], 80.5)
+        self.assertEqual(response.data["points"][0]["on_power_ratio"], 0.5)
+
+    def test_other_users_device_is_not_found(self):
+        other = User.objects.create_user(username="other", email="other@example.com", password="secret")
+        self.client.credentials(HTTP_AUTHORIZATION="Token %s" % other.auth_token.key)
+
+        response = self.client.get(
+            "/api/device/telemetry/%d/" % self.device_owner.id,
+            HTTP_USER_AGENT="SmartPetFeederApp",
+        )
+
+        self.assertEqual(response.status_code, 404)
+
+
+class FeedingLogBatchTest(DeviceAPITestCase):
+    def setUp(self):
+        super().setUp()
+        NotificationSettings.objects.filter(user=self.user).update(pushover_user_key="user-key", auto_food=True)
+        DeviceStatus.objects.filter(device=self.device).update(hopper_level=50)
+
+    def feeds(self, *keys):
+        return [
+            {
+                "idempotency_key": key,
+                "pet_name": "Tom",
+                "feed_type": "S",
+                "feed_amt": 0.5,
+                "feed_timestamp": "2022-06-04T07:00:00Z",
+            }
+            for key in keys
+        ]
+
+    def test_replayed_batch_is_recorded_once(self):
+        response = self.post_json("/api/feeding-log/batch/", {"events": self.feeds("a", "b", "c", "a")})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["created"], ["a", "b", "c"])
+        self.assertEqual(DeviceStatus.objects.get(device=self.device).hopper_level, 50 - 1.5 * 100 / 20)
+        self.assertEqual(
+            self.user.messagequeue_set.get().message,
+            "3 feeds were recorded while the feeder was offline, 3/2 cup in total.",
+        )
+
+        # token auth, then in a savepoint: owner lock, existing keys, insert in a savepoint, feeder, hopper, rollup,
+        # notification settings, message
+        with self.assertNumQueries(13):
+            response = self.post_json("/api/feeding-log/batch/", {"events": self.feeds("a", "b", "c", "d")})
+
+        self.assertEqual(response.data["created"], ["d"])
+        self.assertEqual(response.data["duplicates"], ["a", "b", "c"])
+        self.assertEqual(FeedingLog.objects.filter(device_owner=self.device_owner).count(), 4)
+        self.assertEqual(DeviceStatus.objects.get(device=self.device).hopper_level, 50 - 2 * 100 / 20)
+        self.assertEqual(
+            self.user.messagequeue_set.order_by("-id").first().message, "1/2 cup was automatically dispensed for Tom."
+        )
+
+        # Nothing new, nothing written
+        self.post_json("/api/feeding-log/batch/", {"events": self.feeds("d")})
+        self.assertEqual(self.user.messagequeue_set.count(), 2)
+
+    def test_archived_feeds_are_not_recorded_again(self):
+        self.post_json("/api/feeding-log/batch/", {"events": self.feeds("a", "b")})
+        self.assertEqual(archive_feeding_log(), 2)
+
+        response = self.post_json("/api/feeding-log/batch/", {"events": self.feeds("a", "b", "c")})
+
+        self.assertEqual(response.data["created"], ["c"])
+        self.assertEqual(response.data["duplicates"], ["a", "b"])
+        self.assertEqual(FeedingLog.objects.filter(device_owner=self.device_owner).count(), 1)
+        self.assertEqual(DeviceStatus.objects.get(device=self.device).hopper_level, 50 - 1.5 * 100 / 20)
+
+    def test_feeds_recorded_since_the_check_are_not_counted(self):
+        FeedingLog.objects.create(device_owner=self.device_owner, idempotency_key="b", feed_amt=0.5)
+        feedings = [dict(feeding, feed_timestamp=timezone.now()) for feeding in self.feeds("a", "b", "c")]
+
+        inserted, rows = insert_feedings(self.device_owner.id, feedings)
+
+        self.assertEqual([feeding["idempotency_key"] for feeding in inserted], ["a", "c"])
+        self.assertEqual([row.idempotency_key for row in rows], ["a", "c"])
+        self.assertEqual(FeedingLog.objects.filter(device_owner=self.device_owner).count(), 3)
+
+    def test_bad_batches_are_rejected(self):
+        for body in ({"events": []}, {"events": "a"}, {"events": [{"feed_amt": 0.5}]}, [1]):
+            response = self.post_json("/api/feeding-log/batch/", body)
+
+            self.assertEqual(response.status_code, 400, body)
+        self.assertFalse(FeedingLog.objects.exists())
+
+
+@override_settings(ALLOWED_API_CLIENTS=["SmartPetFeederApp"])
+class RecentFeedingTest(DeviceAPITestCase):
+    def test_history_pages_continue_into_the_archive(self):
+        now = timezone.now()
+        FeedingLog.objects.bulk_create(
+            [
+                FeedingLog(
+                    device_owner=self.device_owner, feed_amt=0.25, feed_timestamp=now - datetime.timedelta(days=days)
+                )
+                for days in range(0, 400, 10)
+            ]
+        )
+        archive_feeding_log()
+
+        first = self.client.get("/api/recent-feeding/", HTTP_USER_AGENT="SmartPetFeederApp")
+        second = self.client.get("/api/recent-feeding/?page=2", HTTP_USER_AGENT="SmartPetFeederApp")
+
+        self.assertEqual(first.data["count"], 40)
+        timestamps = [row["feed_timestamp"] for row in first.data["results"] + second.data["results"]]
+        self.assertEqual(len(timestamps), 40)
+        self.assertEqual(timestamps, sorted(timestamps, reverse=True))
+        self.assertEqual(second.data["results"][0]["device_owner"]["id"], self.device_owner.id)
+
+
+@override_settings(ALLOWED_API_CLIENTS=["SmartPetFeederApp"])
+class FeedingConsumptionTest(DeviceAPITestCase):
+    def test_consumption_per_day_and_week(self):
+        start = datetime.datetime(2022, 6, 1, 12, tzinfo=datetime.timezone.utc)
+        record_feedings(
+            self.device_owner.id,
+            [
+                {
+                    "idempotency_key": str(day),
+                    "pet_name": "Tom",
+                    "feed_type": "S",
+                    "feed_amt": 0.5,
+                    "feed_timestamp": start + datetime.timedelta(days=day),
+                }
+                for day in range(14)
+            ],
+        )
+
+        # token auth and the rollups, the feeding log is not read
+        with self.assertNumQueries(2):
+            response = self.client.get(
+                "/api/feeding-consumption/?start=2022-06-05&end=2022-06-07", HTTP_USER_AGENT="SmartPetFeederApp"
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [row["period"] for row in response.data["consumption"]],
+            [datetime.date(2022, 6, 5), datetime.date(2022, 6, 6), datetime.date(2022, 6, 7)],
+        )
+        self.assertEqual(response.data["consumption"][0]["feed_amt"], 0.5)
+        self.assertEqual(response.data["consumption"][0]["device_owner_id"], self.device_owner.id)
+
+        response = self.client.get(
+            "/api/feeding-consumption/?start=2022-06-01&end=2022-06-30&period=week", HTTP_USER_AGENT="SmartPetFeederApp"
+        )
+        self.assertEqual(
+            [(row["period"], row["feeds"], row["feed_amt"]) for row in response.data["consumption"]],
+            [
+                (datetime.date(2022, 5, 30), 5, 2.5),
+                (datetime.date(2022, 6, 6), 7, 3.5),
+                (datetime.date(2022, 6, 13), 2, 1.0),
+            ],
+        )
+
+        response = self.client.get(
+            "/api/feeding-consumption/?start=2022-06-07&end=2022-06-01", HTTP_USER_AGENT="SmartPetFeederApp"
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+# Reference and content tables of a few rows, read whole on purpose
+SCANNED_TABLES = {"app_article", "app_carousel", "app_firmwareupdate", "app_posix_timezone"}
+
+
+def full_scans(queries):
+    """
+    Tables read by a full table scan in the query plans of the captured SELECT, UPDATE and DELETE statements
+    """
+    tables = set(connection.introspection.table_names()) - SCANNED_TABLES
+    scans = []
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            # Small test tables are cheaper to scan, only a missing index should lead to one
+            cursor.execute("SET LOCAL enable_seqscan = off")
+        for query in queries:
+            sql = query["sql"]
+            if not sql.startswith(("SELECT", "UPDATE", "DELETE")):
+                continue
+            # Tables of subqueries and repeated joins are aliased, U0 or T3
+            aliases = dict((alias, table) for table, alias in re.findall(r'[`"](\w+)[`"] ([TU]\d+)\b', sql))
+            for table in _scanned_tables(cursor, sql):
+                table = aliases.get(table, table)
+                if table in tables:
+                    scans.append("%s: %s" % (table, sql))
+    return scans
+
+
+def _scanned_tables(cursor, sql):
+    if connection.vendor == "mysql":
+        cursor.execute("EXPLAIN " + sql)
+        columns = [column[0] for column in cursor.description]
+        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        # Small test tables are cheaper to scan, only a scan without any usable index is a regression
+        return [row["table"] for row in rows if row["type"] == "ALL" and row["possible_keys"] is None]
+    if connection.vendor == "postgresql":
+        cursor.execute("EXPLAIN " + sql)
+        pattern = r"Seq Scan on (\w+)"
+    else:
+        cursor.execute("EXPLAIN QUERY PLAN " + sql)
+        pattern = r"^SCAN (\w+)"
+    return [match.group(1) for match in (re.search(pattern, row[-1]) for row in cursor.fetchall()) if match]
+
+
+@override_settings(ALLOWED_API_CLIENTS=["SmartPetFeederApp"])
+class QueryPlanTest(DeviceAPITestCase):
+    """
+    The queries of the device endpoints, web pages and periodic tasks are all served from indexes
+    """
+
+    def setUp(self):
+        super().setUp()
+        Settings.objects.create(user=self.user, name="timezone", value="America/New_York")
+        self.web_client = Client()
+        self.web_client.force_login(self.user)
+
+    def assertNoFullScans(self, queries):
+        scans = full_scans(queries)
+        self.assertEqual(scans, [], "Full table scans:\n%s" % "\n".join(scans))
+
+    def test_device_endpoints(self):
+        with CaptureQueriesContext(connection) as captured:
+            self.client.get(
+                "/api/device/verify/%s/%s/" % (self.device.control_board_identifier, self.device.secret_key)
+            )
+            self.client.get("/api/device/verify/ESP32-ffff-ffffffff/fffffffffffffff/")
+            response = self.post_json("/api/device/heartbeat/", {"battery_soc": 88.5, "on_power": True})
+            self.post_json("/api/event/task-completed/", {"id": response.data["event"]["id"]})
+            self.client.get("/api/next-meal/device/")
+            self.client.get("/api/feeding-schedule/")
+            self.post_json("/api/feeding-log/", {"pet_name": "Tom", "feed_type": "S", "feed_amt": 0.5})
+            self.post_json("/api/feeding-log/batch/", {"events": [{"idempotency_key": "a", "feed_amt": 0.5}]})
+
+        self.assertNoFullScans(captured.captured_queries)
+
+    def test_app_endpoints_and_pages(self):
+        with CaptureQueriesContext(connection) as captured:
+            for path in ["/api/recent-feeding/", "/api/devices/own/", "/api/feeding-consumption/", "/api/next-meal/"]:
+                self.assertEqual(self.client.get(path, HTTP_USER_AGENT="SmartPetFeederApp").status_code, 200)
+            for path in ["/", "/dashboard/", "/feeders/", "/schedule/", "/pets/", "/settings/"]:
+                self.assertEqual(self.web_client.get(path).status_code, 200)
+
+        self.assertNoFullScans(captured.captured_queries)
+
+    def test_utils_and_tasks(self):
+        MessageQueue.objects.create(user=self.user, device_owner=self.device_owner, title="Kitchen", message="Hello")
+        refill(self.device.id, 80)
+        with CaptureQueriesContext(connection) as captured:
+            queue_events([(self.device_owner.id, 300)])
+            complete_events(self.device.id, [event["id"] for event in pending_events(self.device.id)])
+            get_device_id(self.device_owner.device_key, self.user.id)
+            get_settings(self.user.id)
+            is_device_registered(self.device.control_board_identifier, self.user.id)
+            check_offline_status()
+            check_pushover_message_queue()
+            reconcile_device_hopper_levels()
+            archive_old_feeding_log()
+            rebuild_feeding_rollups()
+            rebuild_feeding_rollups(self.user.id)
+            rollup_device_telemetry()
+
+        self.assertNoFullScans(captured.captured_queries)
@@ -24,7 +24,11 @@ urlpatterns = [
     path("next-meal/", views.get_all_next_meal),
     path("device/verify/<device_id>/<secret_key>/", views.verify_device),
     path("device/heartbeat/", views.heartbeat),
+    path("device/telemetry/<int:device_owner_id>/", views.get_telemetry),
+    path("feeding-consumption/", views.get_feeding_consumption),
     path("event/task-completed/", views.event_task_completed),
+    path("event/tasks-completed/", views.event_tasks_completed),
+    path("event/wait/", views.wait_for_event),
     path("account/local/auth/<username>/", views.authenticate_account),
     path("account/local/create/", views.create_local_account),
     path("account/local/exists/<username>/", views.local_account_exists),
@@ -1,8 +1,11 @@
+import datetime
 import json
 import logging
 import re
+from hashlib import md5
 
 from allauth.socialaccount.models import SocialAccount
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib.auth import authenticate
 from django.contrib.auth.models import Group, User
@@ -10,12 +13,16 @@ from django.core import serializers
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import IntegrityError, transaction
 from django.db.models import Q
+from django.http import JsonResponse
 from django.shortcuts import render
 from django.utils import timezone
-from rest_framework import filters, permissions, status, viewsets
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import exceptions, filters, permissions, status, viewsets
 from rest_framework.authtoken.models import Token
 from rest_framework.decorators import action, api_view, permission_classes
+from rest_framework.request import Request
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 
 from app.models import (
     AnimalSize,
@@ -26,30 +33,36 @@ from app.models import (
     EventQueue,
     FeederModel,
     FeedingLog,
+    FeedingLogArchive,
     FeedingSchedule,
-    MessageQueue,
     MotorTiming,
-    NotificationAlertTracking,
-    NotificationSettings,
     Pet,
     PosixTimezone,
     Settings,
 )
+from app.alerts import HEARTBEAT, process_alerts
+from app.device_context import get_device_context, load_device_context
+from app.event_channel import get_event_channel
+from app.feeding_log import FeedingHistory, feeding_consumption, record_feedings
+from app.schedule_sync import schedule_diff, schedule_version
+from app.telemetry import save_heartbeat
+from app.timeseries import query_telemetry, record_sample
 from app.utils import (
-    battery_time,
     is_device_registered,
     generate_device_key,
-    get_device_id,
     get_next_feeding,
+    get_next_feedings,
     get_settings,
+    complete_events,
+    pending_events,
     update_has_event_tasks,
-    update_ping,
     update_setting,
 )
 
 from .serializers import (
     DeviceOwnerSerializer,
     DeviceSerializer,
+    FeedingLogEventSerializer,
     FeedingLogSerializer,
     FeedingScheduleSerializer,
     GroupSerializer,
@@ -69,11 +82,8 @@ class DevicePermission(permissions.BasePermission):
 
     def has_permission(self, request, view):
         if "X-Device-Key" in request.headers:
-            owner = DeviceOwner.objects.filter(
-                user_id=request.user.id,
-                device_key=request.headers["X-Device-Key"],
-            )
-            if owner.exists():
+            request.device_context = load_device_context(request.user.id, request.headers["X-Device-Key"])
+            if request.device_context is not None:
                 return True
             else:
                 return False
@@ -156,18 +166,45 @@ class FeedingScheduleViewSet(viewsets.ModelViewSet):
     permission_classes = [permissions.IsAuthenticated, DevicePermission]
 
     def get_queryset(self):
-        try:
-            device_owner = DeviceOwner.objects.get(
-                user_id=self.request.user.id,
-                device_key=self.request.headers["X-Device-Key"],
-            )
+        context = get_device_context(self.request)
+        if context is None:
+            return None
 
-            return (
-                super().get_queryset().filter(device_owner_id=device_owner.id, active_flag=True).order_by("local_time")
-            )
+        return (
+            super()
+            .get_queryset()
+            .filter(device_owner_id=context.device_owner.id, active_flag=True)
+            .select_related("pet", "motor_timing")
+            .order_by("local_time")
+        )
+
+    def list(self, request, *args, **kwargs):
+        """
+        Schedule listing with a strong ETag of the schedule version, or with ?since=<version> only the rows
+        added, changed and removed since that version. An unchanged schedule is answered with 304.
+        """
+        device_owner_id = get_device_context(request).device_owner.id
+        version = schedule_version(device_owner_id)
+        query = md5(request.GET.urlencode().encode()).hexdigest()[:8]
+        etag = quote_etag("%d-%d-%s" % (device_owner_id, version, query))
+        if etag in parse_etags(request.headers.get("If-None-Match", "")):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+        if "since" in request.query_params:
+            try:
+                since = int(request.query_params["since"])
+            except ValueError:
+                return Response({"error": "bad request"}, status=status.HTTP_400_BAD_REQUEST)
+            response = Response(schedule_diff(device_owner_id, since, version, self.serialize))
+        else:
+            response = super().list(request, *args, **kwargs)
 
-        except ObjectDoesNotExist:
-            return None
+        response["ETag"] = etag
+        response["X-Schedule-Version"] = version
+        return response
+
+    def serialize(self, rows):
+        return self.get_serializer(rows, many=True).data
 
 
 class SettingsViewSet(viewsets.ModelViewSet):
@@ -195,28 +232,35 @@ class FeedingLogViewSet(viewsets.ModelViewSet):
     permission_classes = [permissions.IsAuthenticated, DevicePermission]
 
     def get_queryset(self):
-        try:
-            device_owner = DeviceOwner.objects.get(
-                user_id=self.request.user.id,
-                device_key=self.request.headers["X-Device-Key"],
-            )
-
-            return super().get_queryset().filter(device_owner_id=device_owner.id)
-
-        except ObjectDoesNotExist:
+        context = get_device_context(self.request)
+        if context is None:
             return None
 
+        return super().get_queryset().filter(device_owner_id=context.device_owner.id)
+
     def perform_create(self, serializer):
-        try:
-            device_owner = DeviceOwner.objects.get(
-                user_id=self.request.user.id,
-                device_key=self.request.headers["X-Device-Key"],
-            )
-        except ObjectDoesNotExist:
+        context = get_device_context(self.request)
+        if context is None:
             log.info("Device ID not found.")
             raise IntegrityError
         log.info("Saving Log record")
-        serializer.save(device_owner=device_owner)
+        serializer.save(device_owner=context.device_owner)
+
+    @action(detail=False, methods=["post"])
+    def batch(self, request):
+        """
+        Record a batch of feeds, e.g. replayed by a feeder that was offline. Each feed carries an
+        idempotency key generated by the feeder, feeds already recorded under their key are skipped.
+        """
+        context = get_device_context(request)
+        events = request.data.get("events") if isinstance(request.data, dict) else None
+        if not isinstance(events, list) or not 0 < len(events) <= settings.FEEDING_LOG_BATCH_SIZE:
+            return Response({"error": "bad request"}, status=status.HTTP_400_BAD_REQUEST)
+
+        serializer = FeedingLogEventSerializer(data=events, many=True)
+        serializer.is_valid(raise_exception=True)
+        result = record_feedings(context.device_owner.id, serializer.validated_data)
+        return Response({"status": 200, **result})
 
 
 class RecentFeedingViewSet(viewsets.ModelViewSet):
@@ -232,15 +276,20 @@ class RecentFeedingViewSet(viewsets.ModelViewSet):
     search_fields = ["device_owner__id"]
 
     def get_queryset(self):
-        try:
-            device_list = []
-            device_owner = DeviceOwner.objects.filter(user_id=self.request.user.id)
-            for device in device_owner:
-                device_list.append(device.id)
-            return super().get_queryset().filter(device_owner_id__in=device_list).order_by("-feed_timestamp")
-
-        except ObjectDoesNotExist:
-            return None
+        return super().get_queryset().filter(device_owner__user_id=self.request.user.id).order_by("-feed_timestamp")
+
+    def list(self, request, *args, **kwargs):
+        # Recent pages only read the feeding log, older pages continue into the archive
+        history = FeedingHistory(
+            self.filter_queryset(self.get_queryset().select_related("device_owner")),
+            self.filter_queryset(
+                FeedingLogArchive.objects.filter(device_owner__user_id=request.user.id).select_related("device_owner")
+            ),
+        )
+        page = self.paginate_queryset(history)
+        if page is not None:
+            return self.get_paginated_response(self.get_serializer(page, many=True).data)
+        return Response(self.get_serializer(history[:], many=True).data)
 
 
 class DeviceViewSet(viewsets.ModelViewSet):
@@ -269,17 +318,12 @@ class DeviceOwnerViewSet(viewsets.ModelViewSet):
     #     return super().get_queryset().filter(user_id=self.request.user.id)
 
     def get_queryset(self):
-        try:
-            device_owner = DeviceOwner.objects.get(
-                user_id=self.request.user.id,
-                device_key=self.request.headers["X-Device-Key"],
-            )
-
-            return super().get_queryset().filter(id=device_owner.id)
-
-        except ObjectDoesNotExist:
+        context = get_device_context(self.request)
+        if context is None:
             return None
 
+        return super().get_queryset().filter(id=context.device_owner.id)
+
 
 class DevicesOwnedViewSet(viewsets.ModelViewSet):
     """
@@ -345,9 +389,11 @@ def activate_device(request):
                 name=form["name"],
                 manual_motor_timing_id=form["manual_motor_timing_id"],
             )
-            device_owned.save()
-            device_owned.device_key = generate_device_key(device_owned.id)
-            device_owned.save()
+            # Both saves queue the settings event of the feeder, it is queued once on commit
+            with transaction.atomic():
+                device_owned.save()
+                device_owned.device_key = generate_device_key(device_owned.id)
+                device_owned.save()
             data["status"] = "201"
             data["message"] = "Device activated successfully."
             return Response(data, status=status.HTTP_201_CREATED)
@@ -365,15 +411,11 @@ def get_next_meal(request):
     user_settings = get_settings(user_id=request.user.id)
 
     if request.method == "GET":
-        try:
-            device_owner = DeviceOwner.objects.get(
-                user_id=request.user.id,
-                device_key=request.headers["X-Device-Key"],
-            )
-        except ObjectDoesNotExist:
+        context = get_device_context(request)
+        if context is None:
             return Response({"error": "bad request"}, status=status.HTTP_404_NOT_FOUND)
 
-        next_meal = get_next_feeding(device_owner.device_id, the_timezone=user_settings["timezone"])
+        next_meal = get_next_feeding(context.device_id, the_timezone=user_settings["timezone"])
         return Response(next_meal)
     else:
         return Response({"error": "bad request"}, status=status.HTTP_400_BAD_REQUEST)
@@ -389,14 +431,69 @@ def get_all_next_meal(request):
     next_meal = []
 
     if request.method == "GET":
-        device_owner = DeviceOwner.objects.filter(user_id=request.user.id)
-        for device in device_owner:
-            next_meal.append(get_next_feeding(device.device_id, the_timezone=user_settings["timezone"]))
+        device_ids = DeviceOwner.objects.filter(user_id=request.user.id).values_list("device_id", flat=True)
+        next_meals = get_next_feedings(device_ids, the_timezone=user_settings["timezone"])
+        next_meal = list(next_meals.values())
         return Response(next_meal)
     else:
         return Response({"error": "bad request"}, status=status.HTTP_400_BAD_REQUEST)
 
 
+@api_view(["GET"])
+@permission_classes((permissions.IsAuthenticated, UserAgentPermission))
+def get_telemetry(request, device_owner_id):
+    """
+    API endpoint that gives the battery and hopper history of a device from the telemetry rollups
+    """
+    try:
+        device_owner = DeviceOwner.objects.get(id=device_owner_id, user_id=request.user.id)
+    except ObjectDoesNotExist:
+        return Response({"status": 404, "message": "Not Found"}, status=status.HTTP_404_NOT_FOUND)
+
+    now = int(timezone.now().timestamp())
+    try:
+        end = int(request.query_params.get("end", now))
+        start = int(request.query_params.get("start", end - 86400))
+    except ValueError:
+        return Response({"error": "bad request"}, status=status.HTTP_400_BAD_REQUEST)
+
+    if start >= end:
+        return Response({"error": "bad request"}, status=status.HTTP_400_BAD_REQUEST)
+
+    data = query_telemetry(device_owner.device_id, start, end)
+    data["status"] = 200
+    return Response(data)
+
+
+@api_view(["GET"])
+@permission_classes((permissions.IsAuthenticated, UserAgentPermission))
+def get_feeding_consumption(request):
+    """
+    API endpoint that gives the food dispensed per feeder and pet for each day or week of a date range,
+    from the daily feeding rollups
+    """
+    try:
+        end = datetime.date.fromisoformat(request.query_params.get("end", timezone.localdate().isoformat()))
+        start = datetime.date.fromisoformat(
+            request.query_params.get("start", (end - datetime.timedelta(days=6)).isoformat())
+        )
+    except ValueError:
+        return Response({"error": "bad request"}, status=status.HTTP_400_BAD_REQUEST)
+
+    period = request.query_params.get("period", "day")
+    if start > end or period not in ("day", "week") or (end - start).days >= settings.FEEDING_CONSUMPTION_MAX_DAYS:
+        return Response({"error": "bad request"}, status=status.HTTP_400_BAD_REQUEST)
+
+    data = {
+        "status": 200,
+        "start": start,
+        "end": end,
+        "period": period,
+        "consumption": feeding_consumption(request.user.id, start, end, period),
+    }
+    return Response(data)
+
+
 @api_view(["GET"])
 @permission_classes((permissions.AllowAny,))
 def verify_device(request, *args, **kwargs):
@@ -437,13 +534,11 @@ def verify_device(request, *args, **kwargs):
             data["api_key"] = api_key.key
             data["device_key"] = owner.device_key
 
-            try:
-                device_status = DeviceStatus.objects.get(device_id=owner.device_id)
-                device_status.last_boot = timezone.now()
-            except ObjectDoesNotExist:
-                device_status = DeviceStatus(device_id=owner.device_id)
-
-            device_status.save()
+            # Only the boot time is written, the hopper level may be changing concurrently
+            if not DeviceStatus.objects.filter(device_id=owner.device_id).update(
+                last_boot=timezone.now(), updated_at=timezone.now()
+            ):
+                DeviceStatus.objects.get_or_create(device_id=owner.device_id)
 
         except ObjectDoesNotExist:
             data["message"] = "Device not registered"
@@ -801,7 +896,8 @@ def heartbeat(request):
     """
 
     if request.method == "POST":
-        device_id = get_device_id(device_key=request.headers["X-Device-Key"], user_id=request.user.id)
+        context = get_device_context(request)
+        device_id = context.device_id
 
         body_unicode = request.body.decode("utf-8")
         if body_unicode:
@@ -818,117 +914,23 @@ def heartbeat(request):
             "firmware_version",
             "is_hopper_low",
         ]
-        device_status = DeviceStatus.objects.get(device_id=device_id)
+        device_status = context.device_status
+        if device_status is None:
+            device_status = DeviceStatus(device_id=device_id)
+            context.device_status = device_status
         device_status.last_ping = timezone.now()
+        changed_fields = []
         for a in attr_list:
-            if a in body:
+            if a in body and getattr(device_status, a) != body[a]:
                 setattr(device_status, a, body[a])
-        device_status.save()
+                changed_fields.append(a)
+        save_heartbeat(device_status, changed_fields)
+        record_sample(device_status)
 
-        try:
-            notification_settings = NotificationSettings.objects.get(user_id=request.user.id)
-            alert_tracking = NotificationAlertTracking.objects.select_for_update().filter(
-                device_owner__device_id=device_id
-            )
-
-            if notification_settings.feeder_offline:
-                with transaction.atomic():
-                    for alert in alert_tracking:
-                        if alert.offline_alert:
-                            alert.offline_alert = False
-                            MessageQueue(
-                                device_owner_id=alert.device_owner_id,
-                                user_id=request.user.id,
-                                title=alert.device_owner.name,
-                                message="Your feeder is back online.",
-                            ).save()
-                            alert.save()
-
-            if notification_settings.power_disconnected and not device_status.on_power:
-                with transaction.atomic():
-                    for alert in alert_tracking:
-                        if not alert.power_disconnect_alert:
-                            alert.power_disconnect_alert = True
-                            MessageQueue(
-                                device_owner_id=alert.device_owner_id,
-                                user_id=request.user.id,
-                                title=alert.device_owner.name,
-                                message="Power has been disconnected from your feeder. It is currently running on battery.",
-                            ).save()
-                            alert.save()
-
-            if notification_settings.power_disconnected and device_status.on_power:
-                with transaction.atomic():
-                    for alert in alert_tracking:
-                        if alert.power_disconnect_alert:
-                            alert.power_disconnect_alert = False
-                            MessageQueue(
-                                device_owner_id=alert.device_owner_id,
-                                user_id=request.user.id,
-                                title=alert.device_owner.name,
-                                message="The power to your feeder has been restored.",
-                            ).save()
-                            alert.save()
-
-            if notification_settings.low_battery and not device_status.on_power:
-                with transaction.atomic():
-                    for alert in alert_tracking:
-                        crate_time = battery_time(device_status.battery_soc, device_status.battery_crate)
-
-                        log.info("crate time: %s" % crate_time)
-                        # If time remaining is less than 30 minutes, send notification.
-                        if (
-                            not alert.low_battery_alert
-                            and 1800 > crate_time > 1500
-                            and device_status.battery_crate < 0
-                            and device_status.battery_voltage <= 3.30
-                            and not device_status.on_power
-                        ):
-                            alert.low_battery_alert = True
-                            MessageQueue(
-                                device_owner_id=alert.device_owner_id,
-                                user_id=request.user.id,
-                                title=alert.device_owner.name,
-                                message="Your feeder's backup battery has %d minutes of running time remaining. Please connect the power to the feeder as soon as possible."
-                                % int(crate_time / 60),
-                            ).save()
-                            alert.save()
-
-            if notification_settings.low_battery and device_status.on_power:
-                with transaction.atomic():
-                    for alert in alert_tracking:
-                        if alert.low_battery_alert:
-                            alert.low_battery_alert = False
-                            alert.save()
-
-            if notification_settings.low_hopper and device_status.is_hopper_low:
-                with transaction.atomic():
-                    for alert in alert_tracking:
-                        if not alert.low_hopper_alert:
-                            alert.low_hopper_alert = True
-                            MessageQueue(
-                                device_owner_id=alert.device_owner_id,
-                                user_id=request.user.id,
-                                title=alert.device_owner.name,
-                                message="Your feeder is low on food. Please refill the hopper as soon as possible.",
-                            ).save()
-                            alert.save()
-
-            if notification_settings.low_hopper and not device_status.is_hopper_low:
-                with transaction.atomic():
-                    for alert in alert_tracking:
-                        if alert.low_hopper_alert:
-                            alert.low_hopper_alert = False
-                            MessageQueue(
-                                device_owner_id=alert.device_owner_id,
-                                user_id=request.user.id,
-                                title=alert.device_owner.name,
-                                message="The hopper has been filled up. Please indicate the current hopper level on the website.",
-                            ).save()
-                            alert.save()
-
-        except ObjectDoesNotExist:
+        if context.notification_settings is None:
             log.error("user id %s not found", request.user.id)
+        else:
+            process_alerts([context], HEARTBEAT)
 
         data = {
             "status": 200,
@@ -936,14 +938,10 @@ def heartbeat(request):
         }
 
         if device_status.has_event:
-            event = (
-                EventQueue.objects.filter(device_owner__device_id=device_id, status_code="P")
-                .order_by("created_at")
-                .values()
-                .first()
-            )
-            if event is not None:
-                data["event"] = event
+            events = pending_events(device_id, settings.DEVICE_EVENT_BATCH_SIZE)
+            if events:
+                data["event"] = events[0]
+                data["events"] = events
             else:
                 data["has_event"] = False
 
@@ -952,6 +950,55 @@ def heartbeat(request):
         return Response({"error": "bad request"}, status=status.HTTP_400_BAD_REQUEST)
 
 
+def authenticate_device(request):
+    """
+    Token authentication and device key check of the device API, for plain Django views
+    """
+    try:
+        user = Request(request, authenticators=[auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES]).user
+    except exceptions.AuthenticationFailed:
+        return None
+    if not user.is_authenticated:
+        return None
+    return load_device_context(user.id, request.headers.get("X-Device-Key"))
+
+
+async def wait_for_event(request):
+    """
+    API endpoint that holds the request until an event is enqueued for the device or the timeout expires.
+    Served through ASGI, a waiting feeder costs no worker and no database queries.
+    """
+
+    if request.method != "GET":
+        return JsonResponse({"error": "bad request"}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    context = await sync_to_async(authenticate_device)(request)
+    if context is None:
+        return JsonResponse({"detail": "Permission denied"}, status=status.HTTP_403_FORBIDDEN)
+
+    max_timeout = settings.DEVICE_EVENT_LONGPOLL_TIMEOUT
+    try:
+        timeout = min(float(request.GET.get("timeout", max_timeout)), max_timeout)
+    except ValueError:
+        return JsonResponse({"error": "bad request"}, status=status.HTTP_400_BAD_REQUEST)
+
+    get_events = sync_to_async(pending_events)
+    # Subscribe before looking for pending events so an event enqueued in between is not missed
+    async with get_event_channel().subscribe(context.device_owner.id) as subscription:
+        events = await get_events(context.device_id, settings.DEVICE_EVENT_BATCH_SIZE)
+        if not events and await subscription.wait(timeout):
+            events = await get_events(context.device_id, settings.DEVICE_EVENT_BATCH_SIZE)
+
+    data = {
+        "status": 200,
+        "has_event": bool(events),
+    }
+    if events:
+        data["event"] = events[0]
+        data["events"] = events
+    return JsonResponse(data)
+
+
 @api_view(["POST"])
 @permission_classes((permissions.IsAuthenticated, DevicePermission))
 def event_task_completed(request):
@@ -960,7 +1007,7 @@ def event_task_completed(request):
     """
 
     if request.method == "POST":
-        device_id = get_device_id(device_key=request.headers["X-Device-Key"], user_id=request.user.id)
+        device_id = get_device_context(request).device_id
 
         body_unicode = request.body.decode("utf-8")
         if body_unicode:
@@ -970,10 +1017,9 @@ def event_task_completed(request):
 
         try:
             event = EventQueue.objects.get(device_owner__device_id=device_id, id=body["id"])
+            complete_events(device_id, [event.id])
             event.status_code = "C"
-            event.save()
-            update_ping(device_id)
-            update_has_event_tasks(device_id)
+            update_has_event_tasks(device_id, ping=True)
             serialized_event = serializers.serialize("json", [event])
             data = {
                 "status": 200,
@@ -983,3 +1029,26 @@ def event_task_completed(request):
 
         except ObjectDoesNotExist:
             return Response({"error": "bad request"}, status=status.HTTP_404_NOT_FOUND)
+
+
+@api_view(["POST"])
+@permission_classes((permissions.IsAuthenticated, DevicePermission))
+def event_tasks_completed(request):
+    """
+    API endpoint that completes a batch of event tasks
+    """
+
+    device_id = get_device_context(request).device_id
+
+    try:
+        body = json.loads(request.body.decode("utf-8"))
+    except ValueError:
+        log.info("Invalid JSON")
+        return Response({"error": "bad request"}, status=status.HTTP_400_BAD_REQUEST)
+    ids = body.get("ids") if isinstance(body, dict) else None
+    if not isinstance(ids, list) or not all(isinstance(i, int) for i in ids):
+        return Response({"error": "bad request"}, status=status.HTTP_400_BAD_REQUEST)
+
+    completed = complete_events(device_id, ids)
+    update_has_event_tasks(device_id, ping=True)
+    return Response({"status": 200, "completed": completed})
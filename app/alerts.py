@@ -0,0 +1,264 @@
+import logging
+from functools import reduce
+from operator import or_
+
+from django.db import transaction
+from django.db.models import Case, F, Q, Value, When
+
+from .models import MessageQueue, NotificationAlertTracking
+from .utils import battery_time
+
+log = logging.getLogger(__name__)
+
+HEARTBEAT = "heartbeat"
+OFFLINE = "offline"
+
+
+class AlertRule:
+    """
+    Sets an alert tracking flag and queues a message when the rule's notification setting is enabled,
+    the flag is not already at the target value and the trigger condition holds. The summary replaces the
+    messages of several feeders in a digest.
+    """
+
+    def __init__(self, name, trigger, setting, flag, value, condition, message=None, summary=None):
+        self.name = name
+        self.trigger = trigger
+        self.setting = setting
+        self.flag = flag
+        self.value = value
+        self.condition = condition
+        self.message = message
+        self.summary = summary
+
+    def applies(self, context, flags):
+        return (
+            getattr(context.notification_settings, self.setting)
+            and flags[self.flag] != self.value
+            and self.condition(context.device_status, context)
+        )
+
+    def format_message(self, context):
+        if self.message is None:
+            return None
+        values = {"name": context.device_owner.name}
+        # The battery readings are only reported by feeders with a battery, and only the battery messages use them
+        if "{minutes}" in self.message:
+            status = context.device_status
+            if status.battery_soc is None or status.battery_crate is None:
+                values["minutes"] = 0
+            else:
+                values["minutes"] = int(battery_time(status.battery_soc, status.battery_crate) / 60)
+        return self.message.format(**values)
+
+
+def is_battery_low(status, context):
+    if status.battery_soc is None or status.battery_crate is None or status.battery_voltage is None:
+        return False
+    crate_time = battery_time(status.battery_soc, status.battery_crate)
+    log.info("crate time: %s" % crate_time)
+    # If time remaining is less than 30 minutes, send notification.
+    return (
+        1800 > crate_time > 1500 and status.battery_crate < 0 and status.battery_voltage <= 3.30 and not status.on_power
+    )
+
+
+# Rules are evaluated in order against the flags as updated by the previous rules
+RULES = [
+    AlertRule(
+        "back_online",
+        HEARTBEAT,
+        "feeder_offline",
+        "offline_alert",
+        False,
+        lambda status, context: True,
+        "Your feeder is back online.",
+        "{count} feeders are back online: {names}",
+    ),
+    AlertRule(
+        "offline",
+        OFFLINE,
+        "feeder_offline",
+        "offline_alert",
+        True,
+        lambda status, context: context.notification_settings.pushover_user_key != "",
+        "Your feeder is currently offline, possibly lost an internet connection or it was powered off.",
+        "{count} feeders went offline: {names}",
+    ),
+    AlertRule(
+        "power_loss",
+        HEARTBEAT,
+        "power_disconnected",
+        "power_disconnect_alert",
+        True,
+        lambda status, context: not status.on_power,
+        "Power has been disconnected from your feeder. It is currently running on battery.",
+        "{count} feeders lost power and are running on battery: {names}",
+    ),
+    AlertRule(
+        "power_restore",
+        HEARTBEAT,
+        "power_disconnected",
+        "power_disconnect_alert",
+        False,
+        lambda status, context: status.on_power,
+        "The power to your feeder has been restored.",
+        "Power was restored to {count} feeders: {names}",
+    ),
+    AlertRule(
+        "low_battery",
+        HEARTBEAT,
+        "low_battery",
+        "low_battery_alert",
+        True,
+        is_battery_low,
+        "Your feeder's backup battery has {minutes} minutes of running time remaining. Please connect the power to "
+        "the feeder as soon as possible.",
+        "{count} feeders are running low on battery: {names}",
+    ),
+    AlertRule(
+        "battery_reset",
+        HEARTBEAT,
+        "low_battery",
+        "low_battery_alert",
+        False,
+        lambda status, context: status.on_power,
+    ),
+    AlertRule(
+        "low_hopper",
+        HEARTBEAT,
+        "low_hopper",
+        "low_hopper_alert",
+        True,
+        lambda status, context: status.is_hopper_low,
+        "Your feeder is low on food. Please refill the hopper as soon as possible.",
+        "{count} feeders are low on food: {names}",
+    ),
+    AlertRule(
+        "hopper_refill",
+        HEARTBEAT,
+        "low_hopper",
+        "low_hopper_alert",
+        False,
+        lambda status, context: not status.is_hopper_low,
+        "The hopper has been filled up. Please indicate the current hopper level on the website.",
+        "{count} hoppers have been filled up: {names}",
+    ),
+]
+
+FLAGS = list(dict.fromkeys(rule.flag for rule in RULES))
+
+
+class AlertChange:
+    """
+    Flag changes and queued messages of one alert tracking row
+    """
+
+    def __init__(self, alert_tracking, old_flags, new_flags, messages):
+        self.alert_tracking = alert_tracking
+        self.old_flags = old_flags
+        self.new_flags = new_flags
+        self.messages = messages
+
+    @property
+    def changed_flags(self):
+        return {flag: value for flag, value in self.new_flags.items() if self.old_flags[flag] != value}
+
+    def unchanged_since_read(self):
+        return Q(id=self.alert_tracking.id, **{flag: self.old_flags[flag] for flag in self.changed_flags})
+
+    def save(self):
+        alert_tracking = self.alert_tracking
+        updated = NotificationAlertTracking.objects.filter(self.unchanged_since_read()).update(**self.changed_flags)
+        if updated:
+            for flag, value in self.changed_flags.items():
+                setattr(alert_tracking, flag, value)
+        return updated > 0
+
+
+def evaluate(context, trigger, rules=None):
+    """
+    Run the rules of a trigger over one device context, without touching the database
+    """
+    alert_tracking = context.alert_tracking
+    if alert_tracking is None or context.notification_settings is None or context.device_status is None:
+        return None
+
+    old_flags = {flag: getattr(alert_tracking, flag) for flag in FLAGS}
+    flags = dict(old_flags)
+    messages = []
+    for rule in rules if rules is not None else RULES:
+        if rule.trigger != trigger or not rule.applies(context, flags):
+            continue
+        flags[rule.flag] = rule.value
+        message = rule.format_message(context)
+        if message is not None:
+            messages.append(
+                MessageQueue(
+                    device_owner_id=context.device_owner.id,
+                    user_id=context.user_id,
+                    title=context.device_owner.name,
+                    message=message,
+                    kind=rule.name,
+                )
+            )
+
+    if flags == old_flags:
+        return None
+    return AlertChange(alert_tracking, old_flags, flags, messages)
+
+
+def save_flags(changes):
+    updates = {}
+    for flag in FLAGS:
+        whens = [
+            When(id=change.alert_tracking.id, then=Value(change.new_flags[flag]))
+            for change in changes
+            if flag in change.changed_flags
+        ]
+        if whens:
+            updates[flag] = Case(*whens, default=F(flag))
+
+    # Savepoint so a partially matched UPDATE can be undone before falling back to row by row saves
+    with transaction.atomic():
+        condition = reduce(or_, [change.unchanged_since_read() for change in changes])
+        if NotificationAlertTracking.objects.filter(condition).update(**updates) != len(changes):
+            transaction.set_rollback(True)
+            return None
+
+    for change in changes:
+        for flag, value in change.changed_flags.items():
+            setattr(change.alert_tracking, flag, value)
+    return changes
+
+
+def save_changes(changes):
+    """
+    Write the flag changes with one conditional UPDATE and the messages with one bulk INSERT.
+
+    The UPDATE only matches rows whose flags are still as they were read. If a concurrent heartbeat or
+    offline check got there first, the rows are settled one by one so no message is queued twice.
+    """
+    if not changes:
+        return []
+
+    with transaction.atomic(savepoint=False):
+        saved = save_flags(changes)
+        if saved is None:
+            log.info("Alert tracking changed concurrently, saving %d alert changes one by one", len(changes))
+            saved = [change for change in changes if change.save()]
+
+        messages = [message for change in saved for message in change.messages]
+        if messages:
+            MessageQueue.objects.bulk_create(messages)
+
+    return saved
+
+
+def process_alerts(contexts, trigger, rules=None):
+    changes = []
+    for context in contexts:
+        change = evaluate(context, trigger, rules)
+        if change is not None:
+            changes.append(change)
+    return save_changes(changes)
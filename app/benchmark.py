@@ -0,0 +1,44 @@
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+from django.test.utils import setup_databases, teardown_databases
+
+
+@contextmanager
+def benchmark_database(verbosity=0, keepdb=False):
+    """
+    Run a benchmark against a throwaway test database instead of the configured one
+    """
+    old_config = setup_databases(verbosity, interactive=False, keepdb=keepdb, aliases={"default"})
+    try:
+        yield
+    finally:
+        teardown_databases(old_config, verbosity, keepdb=keepdb)
+
+
+class QueryCounter:
+    """
+    Database execute wrapper counting statements, time spent and rows written by UPDATE statements
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.updates = 0
+        self.rows_updated = 0
+        self.elapsed = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        result = execute(sql, params, many, context)
+        self.elapsed += time.perf_counter() - start
+        self.queries += 1
+        if sql.lstrip()[:6].upper() == "UPDATE":
+            self.updates += 1
+            self.rows_updated += max(context["cursor"].rowcount, 0)
+        return result
+
+    @contextmanager
+    def count(self):
+        with connection.execute_wrapper(self):
+            yield self
@@ -1,6 +1,7 @@
 import logging
+from functools import lru_cache
 from pathlib import Path
-from .models import Settings
+from .feeder_overview import get_user_settings
 
 import yaml
 
@@ -9,14 +10,18 @@ log = logging.getLogger(__name__)
 MENU_PATH = "%s%s" % (Path(__file__).resolve().parent, "/menu.yaml")
 
 
+@lru_cache(maxsize=None)
+def load_menu():
+    # Parsed once per process, the menu only changes with a deploy
+    with open(MENU_PATH) as file:
+        return yaml.full_load(file)
+
+
 def menu_context(request):
     context_data = dict()
     try:
-        with open(MENU_PATH) as file:
-            data = yaml.full_load(file)
-
         context_data = {
-            "menu_list": data,
+            "menu_list": load_menu(),
             "current_route": request.resolver_match.view_name,
         }
         # print(context_data)
@@ -45,10 +50,11 @@ def account_setup_status(request):
     }
 
     if request.user.id:
-        settings = Settings.objects.filter(user_id=request.user.id, name="is_setup_done").first()
+        # The settings the view already read for the same request
+        settings = get_user_settings(request)
 
-        if settings is not None:
-            is_setup_done = int(settings.value)
+        if "is_setup_done" in settings:
+            is_setup_done = int(settings["is_setup_done"])
 
     if request.resolver_match.view_name in lookup_table:
         setup_phase = lookup_table[request.resolver_match.view_name]
@@ -0,0 +1,150 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+
+from .models import DeviceOwner
+
+log = logging.getLogger(__name__)
+
+OWNER_FIELDS = [f.attname for f in DeviceOwner._meta.concrete_fields]
+
+
+class LocalTTLCache:
+    """
+    Small in-process LRU cache with a per-entry time to live
+    """
+
+    def __init__(self, maxsize, timeout):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0 or self.timeout <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.timeout, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def discard_if(self, predicate):
+        with self.lock:
+            for key in [k for k, (expires, value) in self.entries.items() if predicate(value)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class DeviceOwnerCache:
+    """
+    Maps (user id, X-Device-Key) to a DeviceOwner without touching the database on a hit.
+
+    Entries live in a short-lived in-process tier in front of Django's cache backend, so a shared
+    backend such as Redis serves all gunicorn workers. Both tiers are invalidated from the DeviceOwner
+    post_save and post_delete signals, and again once the transaction commits, so a concurrent request
+    caching the old row in between does not keep it.
+
+    A per-process backend (LocMemCache) cannot be invalidated from the other workers, the shared tier is
+    not used then and a removed or re-keyed feeder is only served for the local timeout.
+    """
+
+    def __init__(self, alias=None, timeout=None, local_timeout=None, local_size=None):
+        self.alias = alias if alias else settings.DEVICE_OWNER_CACHE_ALIAS
+        self.timeout = timeout if timeout is not None else settings.DEVICE_OWNER_CACHE_TIMEOUT
+        self.local = LocalTTLCache(
+            local_size if local_size is not None else settings.DEVICE_OWNER_LOCAL_CACHE_SIZE,
+            local_timeout if local_timeout is not None else settings.DEVICE_OWNER_LOCAL_CACHE_TIMEOUT,
+        )
+
+    @property
+    def shared(self):
+        cache = caches[self.alias]
+        return None if isinstance(cache, LocMemCache) else cache
+
+    @staticmethod
+    def key(user_id, device_key):
+        digest = hashlib.md5(str(device_key).encode()).hexdigest()
+        return "device-owner:%s:%s" % (user_id, digest)
+
+    @staticmethod
+    def owner_key(device_owner_id):
+        return "device-owner-id:%s" % device_owner_id
+
+    def get(self, user_id, device_key):
+        key = self.key(user_id, device_key)
+        values = self.local.get(key)
+        if values is None:
+            shared = self.shared
+            values = shared.get(key) if shared is not None else None
+            if values is None:
+                return None
+            self.local.set(key, values)
+        return DeviceOwner.from_db(DeviceOwner.objects.db, OWNER_FIELDS, values)
+
+    def set(self, device_owner):
+        key = self.key(device_owner.user_id, device_owner.device_key)
+        values = tuple(getattr(device_owner, name) for name in OWNER_FIELDS)
+        self.local.set(key, values)
+        shared = self.shared
+        if shared is not None:
+            shared.set_many({key: values, self.owner_key(device_owner.id): key}, self.timeout)
+
+    def invalidate(self, device_owner):
+        self.discard(device_owner.id, device_owner.user_id, device_owner.device_key)
+        transaction.on_commit(lambda: self.discard(device_owner.id, device_owner.user_id, device_owner.device_key))
+
+    def discard(self, device_owner_id, user_id, device_key):
+        # The saved row may carry a new device key, so also drop whatever key was cached for this owner id
+        keys = [self.key(user_id, device_key), self.owner_key(device_owner_id)]
+        shared = self.shared
+        if shared is not None:
+            previous_key = shared.get(self.owner_key(device_owner_id))
+            if previous_key:
+                keys.append(previous_key)
+            shared.delete_many(keys)
+        for key in keys:
+            self.local.delete(key)
+        self.local.discard_if(lambda values: values[0] == device_owner_id)
+
+    def resolve(self, user_id, device_key):
+        device_owner = self.get(user_id, device_key)
+        if device_owner is None:
+            device_owner = (
+                DeviceOwner.objects.filter(user_id=user_id, device_key=device_key).order_by("device_id").first()
+            )
+            if device_owner is not None:
+                self.set(device_owner)
+        return device_owner
+
+    def clear(self):
+        self.local.clear()
+
+
+device_owner_cache = DeviceOwnerCache()
@@ -0,0 +1,141 @@
+import logging
+
+from .device_cache import device_owner_cache
+from .models import DeviceOwner, DeviceStatus, NotificationAlertTracking, NotificationSettings
+
+log = logging.getLogger(__name__)
+
+# (attribute on DeviceContext, lookup from DeviceOwner, model) for the rows joined onto the device owner
+RELATED_ROWS = [
+    ("device_status", "device__devicestatus", DeviceStatus),
+    ("notification_settings", "user__notificationsettings", NotificationSettings),
+    ("alert_tracking", "notificationalerttracking", NotificationAlertTracking),
+]
+
+
+def _related_row(attr):
+    def getter(self):
+        return self.load_related()[attr]
+
+    def setter(self, value):
+        self.load_related()[attr] = value
+
+    return property(getter, setter)
+
+
+class DeviceContext:
+    """
+    Device owner with its status, notification settings and alert tracking.
+
+    The related rows are either resolved in the same query as the device owner, or loaded together
+    in one query on first access when the device owner came from the cache.
+    """
+
+    device_status = _related_row("device_status")
+    notification_settings = _related_row("notification_settings")
+    alert_tracking = _related_row("alert_tracking")
+
+    def __init__(self, device_owner, related=None):
+        self.device_owner = device_owner
+        self.related = related
+
+    @property
+    def device_id(self):
+        return self.device_owner.device_id
+
+    @property
+    def user_id(self):
+        return self.device_owner.user_id
+
+    def load_related(self):
+        if self.related is None:
+            row = DeviceOwner.objects.filter(id=self.device_owner.id).values_list(*_related_columns()).first()
+            self.related = _related_from_row(self.device_owner, row) if row else dict.fromkeys(_related_attrs())
+        return self.related
+
+    def alerts(self):
+        return [self.alert_tracking] if self.alert_tracking is not None else []
+
+
+def _field_names(model):
+    return [f.attname for f in model._meta.concrete_fields]
+
+
+def _related_attrs():
+    return [attr for attr, lookup, model in RELATED_ROWS]
+
+
+def _related_columns():
+    columns = []
+    for attr, lookup, model in RELATED_ROWS:
+        columns += ["%s__%s" % (lookup, name) for name in _field_names(model)]
+    return columns
+
+
+def _from_row(model, field_names, values):
+    # A missing LEFT OUTER JOIN row comes back with a NULL primary key
+    if values[0] is None:
+        return None
+    return model.from_db(DeviceOwner.objects.db, field_names, values)
+
+
+def _related_from_row(device_owner, row):
+    related = {}
+    offset = 0
+    for attr, lookup, model in RELATED_ROWS:
+        field_names = _field_names(model)
+        related[attr] = _from_row(model, field_names, row[offset : offset + len(field_names)])
+        offset += len(field_names)
+
+    if related["alert_tracking"] is not None:
+        related["alert_tracking"].device_owner = device_owner
+
+    return related
+
+
+def load_device_context(user_id, device_key):
+    if not user_id or not device_key:
+        return None
+
+    device_owner = device_owner_cache.get(user_id, device_key)
+    if device_owner is not None:
+        return DeviceContext(device_owner)
+
+    owner_fields = _field_names(DeviceOwner)
+    row = (
+        DeviceOwner.objects.filter(user_id=user_id, device_key=device_key)
+        .order_by("device_id")
+        .values_list(*owner_fields, *_related_columns())
+        .first()
+    )
+    if row is None:
+        return None
+
+    device_owner = _from_row(DeviceOwner, owner_fields, row[: len(owner_fields)])
+    device_owner_cache.set(device_owner)
+    return DeviceContext(device_owner, _related_from_row(device_owner, row[len(owner_fields) :]))
+
+
+def load_device_contexts(**filters):
+    """
+    Device contexts of every device owner matching the filters, in one query
+    """
+    owner_fields = _field_names(DeviceOwner)
+    rows = DeviceOwner.objects.filter(**filters).order_by("id").values_list(*owner_fields, *_related_columns())
+
+    contexts = {}
+    for row in rows:
+        device_owner = _from_row(DeviceOwner, owner_fields, row[: len(owner_fields)])
+        if device_owner.id not in contexts:
+            contexts[device_owner.id] = DeviceContext(
+                device_owner, _related_from_row(device_owner, row[len(owner_fields) :])
+            )
+    return list(contexts.values())
+
+
+def get_device_context(request):
+    context = getattr(request, "device_context", None)
+    if context is None and "X-Device-Key" in request.headers:
+        context = load_device_context(request.user.id, request.headers["X-Device-Key"])
+        request.device_context = context
+    return context
@@ -0,0 +1,113 @@
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+
+log = logging.getLogger(__name__)
+
+
+class EventBatch:
+    """
+    Events registered during one transaction, flushed by its on_commit callback
+    """
+
+    def __init__(self, collector):
+        self.collector = collector
+        self.events = set()
+        self.flushed = False
+
+    def __call__(self):
+        self.flushed = True
+        self.collector.flush(self.events)
+
+
+class DeviceEventCollector:
+    """
+    Unit of work for the device events queued by the model signals. A receiver registers that a device
+    owner needs an event and the events of the transaction are flushed once it commits: deduplicated,
+    inserted together and the devices flagged with a single has_event UPDATE (see utils.queue_events).
+    Events registered in a savepoint that is rolled back after the first registration of the transaction
+    are still flushed, which only costs the feeder an extra sync.
+
+    Debounced events wait DEVICE_EVENT_DEBOUNCE seconds after the commit, a later commit registering the
+    same event restarts the wait so rapid edits end in a single sync of the feeder. The wait is tracked with
+    tokens in the default cache, read back by the celery worker, so the cache must be shared (Redis): with a
+    per-process cache the events are not debounced.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self.warned = False
+
+    def add(self, device_owner_id, event_code, debounce=False):
+        event = (device_owner_id, event_code, debounce)
+        connection = transaction.get_connection()
+        if not connection.in_atomic_block:
+            self.flush([event])
+            return
+
+        batch = getattr(self._local, "batch", None)
+        if batch is None or batch.flushed or not any(entry[1] is batch for entry in connection.run_on_commit):
+            batch = EventBatch(self)
+            self._local.batch = batch
+            transaction.on_commit(batch)
+        batch.events.add(event)
+
+    def flush(self, events):
+        from .utils import queue_events
+
+        debounce = self.debounce()
+        now = [(device_owner_id, event_code) for device_owner_id, event_code, debounced in events]
+        if debounce > 0:
+            now = [(device_owner_id, event_code) for device_owner_id, event_code, debounced in events if not debounced]
+            later = {(device_owner_id, event_code) for device_owner_id, event_code, debounced in events if debounced}
+            later -= set(now)
+            if later:
+                self.schedule(sorted(later), debounce)
+        queue_events(now)
+
+    def debounce(self):
+        debounce = settings.DEVICE_EVENT_DEBOUNCE
+        if debounce > 0 and isinstance(caches["default"], LocMemCache):
+            if not self.warned:
+                log.warning("DEVICE_EVENT_DEBOUNCE needs a shared cache, device events are queued without debounce")
+                self.warned = True
+            return 0
+        return debounce
+
+    def schedule(self, events, debounce):
+        from .tasks import flush_device_events
+
+        tokens = []
+        for device_owner_id, event_code in events:
+            key = _debounce_key(device_owner_id, event_code)
+            cache.add(key, 0, debounce * 10 + 60)
+            tokens.append([device_owner_id, event_code, cache.incr(key)])
+        flush_device_events.apply_async(args=[tokens], countdown=debounce)
+
+    def flush_debounced(self, tokens):
+        """
+        Queue the debounced events that were not registered again since their flush was scheduled. An event
+        whose token is gone from the cache is treated as superseded.
+        """
+        from .utils import queue_events
+
+        keys = {_debounce_key(device_owner_id, event_code): token for device_owner_id, event_code, token in tokens}
+        current = cache.get_many(list(keys))
+        events = [
+            (device_owner_id, event_code)
+            for device_owner_id, event_code, token in tokens
+            if current.get(_debounce_key(device_owner_id, event_code)) == token
+        ]
+        log.debug("Flushing %d of %d debounced device events", len(events), len(tokens))
+        return queue_events(events)
+
+
+def _debounce_key(device_owner_id, event_code):
+    return "device-event:%d:%d" % (device_owner_id, event_code)
+
+
+device_events = DeviceEventCollector()
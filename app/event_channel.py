@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+
+from django.conf import settings
+
+log = logging.getLogger(__name__)
+
+
+class Subscription:
+    def __init__(self, event):
+        self.event = event
+
+    async def wait(self, timeout):
+        """
+        Wait until the channel is notified, returns False when the timeout expires first
+        """
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+
+class LocalEventChannel:
+    """
+    Wakes the long-polling requests of a device owner within this process.
+
+    Waiters are asyncio events on the event loop of the ASGI server, publish() may be called from any
+    thread (e.g. a sync view or a transaction.on_commit callback).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiters = defaultdict(set)
+
+    def publish(self, key):
+        self.notify(key)
+
+    def notify(self, key):
+        with self.lock:
+            waiters = list(self.waiters.get(key, ()))
+        for loop, event in waiters:
+            loop.call_soon_threadsafe(event.set)
+        return len(waiters)
+
+    @asynccontextmanager
+    async def subscribe(self, key):
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self.lock:
+            self.waiters[key].add(waiter)
+        try:
+            yield Subscription(waiter[1])
+        finally:
+            with self.lock:
+                self.waiters[key].discard(waiter)
+                if not self.waiters[key]:
+                    del self.waiters[key]
+
+
+class RedisEventChannel(LocalEventChannel):
+    """
+    Publishes through Redis so an event enqueued by any web or celery worker wakes the waiters of
+    every ASGI process. Each process holds a single pattern subscription and fans the messages out
+    to its local waiters.
+    """
+
+    def __init__(self, url, prefix="device-events:"):
+        super().__init__()
+        self.url = url
+        self.prefix = prefix
+        self.listener = None
+        self.client = None
+
+    def get_client(self):
+        if self.client is None:
+            import redis
+
+            self.client = redis.Redis.from_url(self.url)
+        return self.client
+
+    def publish(self, key):
+        try:
+            self.get_client().publish("%s%s" % (self.prefix, key), 1)
+        except Exception as e:
+            log.warning("Unable to publish device event %s: %r", key, e)
+
+    @asynccontextmanager
+    async def subscribe(self, key):
+        self.start_listener()
+        async with super().subscribe(key) as subscription:
+            yield subscription
+
+    def start_listener(self):
+        if self.listener is not None:
+            return
+        with self.lock:
+            if self.listener is None:
+                self.listener = threading.Thread(target=self.run_listener, name="device-event-listener", daemon=True)
+                self.listener.start()
+
+    def run_listener(self):
+        import redis
+
+        while True:
+            try:
+                pubsub = redis.Redis.from_url(self.url).pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe("%s*" % self.prefix)
+                for message in pubsub.listen():
+                    key = message["channel"].decode()[len(self.prefix) :]
+                    self.notify(int(key) if key.isdigit() else key)
+            except Exception as e:
+                log.warning("Device event listener disconnected: %r", e)
+                time.sleep(1)
+
+
+event_channel = None
+
+
+def get_event_channel():
+    global event_channel
+    url = settings.DEVICE_EVENT_CHANNEL_URL
+    # Created again when the setting changes, e.g. with override_settings
+    if event_channel is None or getattr(event_channel, "url", None) != url:
+        if url:
+            event_channel = RedisEventChannel(url)
+        else:
+            if not settings.DEBUG:
+                log.warning(
+                    "DEVICE_EVENT_CHANNEL_URL is not set, long-polling feeders are only woken by events enqueued in "
+                    "the same process and otherwise wait until the timeout"
+                )
+            event_channel = LocalEventChannel()
+    return event_channel
+
+
+def publish_event(device_owner_id):
+    get_event_channel().publish(device_owner_id)
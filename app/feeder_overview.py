@@ -0,0 +1,119 @@
+import datetime
+import logging
+from collections import defaultdict
+
+from django.db.models import OuterRef, Q, Subquery
+
+from .models import DeviceOwner, DeviceStatus, FeedingLog, FirmwareUpdate, Settings
+from .utils import battery_time, get_next_feedings, seconds_to_days, uptime
+
+log = logging.getLogger(__name__)
+
+# Columns of the recent feeds shown on the dashboard
+FEEDING_FIELDS = ("device_owner_id", "pet_name", "feed_type", "feed_amt", "feed_timestamp")
+
+
+def get_user_settings(request):
+    """
+    Settings of the signed in user as a {name: value} dict, read once per request and shared with the
+    context processors
+    """
+    user_settings = getattr(request, "user_settings", None)
+    if user_settings is None:
+        user_settings = dict(Settings.objects.filter(user_id=request.user.id).values_list("name", "value"))
+        request.user_settings = user_settings
+    return user_settings
+
+
+def load_feeder_overview(user_id, timezone, feedings=0, firmware=False):
+    """
+    Status, next meal and optionally the latest feeds and available firmware update of every feeder of a
+    user, for the dashboard and feeders pages. Each kind of row is read with one query for all the
+    feeders: the device owners joined to their device, status, model and motor timing, the meal indexes
+    (cached), the latest feeds and the firmware updates.
+    """
+    owners = (
+        DeviceOwner.objects.filter(user_id=user_id)
+        .select_related("device__devicestatus", "feeder_model", "manual_motor_timing")
+        .order_by("name")
+    )
+    if feedings:
+        # Timestamp of the feeder's nth latest feed, the feeds from there on are read together below
+        since = FeedingLog.objects.filter(device_owner_id=OuterRef("id")).order_by("-feed_timestamp", "-id")
+        owners = owners.annotate(feedings_since=Subquery(since.values("feed_timestamp")[feedings - 1 : feedings]))
+
+    devices = []
+    for owner in owners:
+        try:
+            devices.append((owner, owner.device.devicestatus))
+        except DeviceStatus.DoesNotExist:
+            log.error("Unable to get DeviceStatus of device %s", owner.device_id)
+
+    next_meals = get_next_feedings([owner.device_id for owner, status in devices], timezone)
+    recent = _recent_feedings([owner for owner, status in devices], feedings) if feedings else {}
+    updates = _firmware_updates({status.control_board_revision for owner, status in devices}) if firmware else {}
+
+    info = []
+    for owner, status in devices:
+        last_ping = uptime(status.last_ping)
+        log.debug("Last ping: %d" % last_ping)
+        row = {
+            "uptime": seconds_to_days(uptime(status.last_boot)),
+            "next_meal": next_meals[owner.device_id],
+            "device": owner,
+            "online": "Online" if last_ping <= 500 else "Offline",
+            "device_status": status,
+            "crate_time": str(datetime.timedelta(seconds=battery_time(status.battery_soc, status.battery_crate))),
+        }
+        if feedings:
+            row["feedings"] = recent.get(owner.id, [])
+        if firmware:
+            row["firmware_update"] = updates.get(status.control_board_revision)
+        info.append(row)
+    return info
+
+
+def _recent_feedings(owners, count):
+    """
+    Latest feeds of each device owner as slim dicts, newest first, in one query
+    """
+    since = [
+        Q(device_owner_id=owner.id, feed_timestamp__gte=owner.feedings_since)
+        for owner in owners
+        if owner.feedings_since
+    ]
+    fewer = [owner.id for owner in owners if owner.feedings_since is None]
+    if fewer:
+        since.append(Q(device_owner_id__in=fewer))
+    if not since:
+        return {}
+
+    condition = since.pop()
+    for q in since:
+        condition |= q
+    rows = (
+        FeedingLog.objects.filter(condition)
+        .order_by("device_owner_id", "-feed_timestamp", "-id")
+        .values(*FEEDING_FIELDS)
+    )
+    recent = defaultdict(list)
+    for row in rows:
+        # Feeds sharing the timestamp of the nth latest one are read as well
+        if len(recent[row["device_owner_id"]]) < count:
+            recent[row["device_owner_id"]].append(row)
+    return recent
+
+
+def _firmware_updates(revisions):
+    """
+    Latest firmware update of each control board revision, {revision: {"version", "description"}}
+    """
+    updates = {}
+    rows = (
+        FirmwareUpdate.objects.filter(control_board__revision__in=revisions)
+        .order_by("-created_at", "-id")
+        .values("control_board__revision", "version", "description")
+    )
+    for row in rows:
+        updates.setdefault(row.pop("control_board__revision"), row)
+    return updates
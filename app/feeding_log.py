@@ -0,0 +1,357 @@
+import hashlib
+import logging
+from collections import Counter, defaultdict
+from datetime import timedelta
+from fractions import Fraction
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import TruncDate, TruncWeek
+from django.utils import timezone
+
+from .hopper import dispense, get_feeder
+from .models import (
+    DeviceOwner,
+    FeedingLog,
+    FeedingLogArchive,
+    FeedingRollup,
+    MessageQueue,
+    NotificationSettings,
+    Settings,
+)
+from .timezones import get_zone, timestamps_to_local
+
+log = logging.getLogger(__name__)
+
+# MessageQueue.kind of the feed notifications
+FEEDING = "feeding"
+
+
+def feed_message(user_settings, feed_type, feed_amt, pet_name):
+    """
+    Notification message of a dispensed feed, or an empty string when the user does not want it
+    """
+    if user_settings.pushover_user_key == "" or not (user_settings.manual_food or user_settings.auto_food):
+        return ""
+    if feed_type == "R" and user_settings.manual_food:
+        return "%s cup was manually dispensed from a remote computer or mobile device." % Fraction(feed_amt)
+    elif feed_type == "M" and user_settings.manual_food:
+        return "%s cup was manually dispensed from the feeder." % Fraction(feed_amt)
+    elif user_settings.auto_food:
+        return "%s cup was automatically dispensed for %s." % (Fraction(feed_amt), pet_name)
+    return ""
+
+
+def record_feedings(device_owner_id, feedings):
+    """
+    Record a batch of feeds replayed by a feeder, each with the idempotency key the feeder generated.
+    Feeds already recorded under their key are skipped, so a retried upload is recorded once. The hopper
+    level is decremented once by the total of the new feeds and a single summarized notification is
+    queued. Returns the keys of the new feeds and of the duplicates.
+    """
+    unique = {}
+    for feeding in feedings:
+        unique.setdefault(feeding["idempotency_key"], feeding)
+    feedings = list(unique.values())
+    keys = list(unique)
+
+    with transaction.atomic():
+        # Uploads of the same feeder are serialized, a retry racing the original waits for it
+        list(DeviceOwner.objects.select_for_update().filter(id=device_owner_id).values_list("id"))
+        # A feed replayed after it was archived is a duplicate as well
+        existing = set(
+            FeedingLog.objects.filter(device_owner_id=device_owner_id, idempotency_key__in=keys)
+            .values_list("idempotency_key", flat=True)
+            .union(
+                FeedingLogArchive.objects.filter(device_owner_id=device_owner_id, idempotency_key__in=keys).values_list(
+                    "idempotency_key", flat=True
+                )
+            )
+        )
+        new = [feeding for feeding in feedings if feeding["idempotency_key"] not in existing]
+        new, rows = insert_feedings(device_owner_id, new)
+
+        feeder = get_feeder(device_owner_id)
+        if new and feeder is not None:
+            dispense(feeder["device_id"], feeder["hopper_capacity"], sum(feeding["feed_amt"] for feeding in new))
+            rollup_feedings(device_owner_id, rows, feeder["timezone"])
+            queue_feedings_message(feeder, device_owner_id, new)
+
+    log.info("Recorded %d of %d feeds of device owner %s", len(new), len(feedings), device_owner_id)
+    created = [feeding["idempotency_key"] for feeding in new]
+    return {
+        "created": created,
+        "duplicates": [key for key in keys if key not in created],
+    }
+
+
+def insert_feedings(device_owner_id, feedings):
+    """
+    Insert the feeds, returns the ones inserted and their rows. bulk_create skips the per-row post_save
+    signal, the hopper, rollups and notification are handled by the caller. A key recorded since it was
+    checked fails the batch, which is then inserted feed by feed so only the rows inserted are counted.
+    """
+    rows = [FeedingLog(device_owner_id=device_owner_id, **feeding) for feeding in feedings]
+    try:
+        with transaction.atomic():
+            FeedingLog.objects.bulk_create(rows)
+        return feedings, rows
+    except IntegrityError:
+        pass
+
+    inserted = []
+    for feeding, row in zip(feedings, rows):
+        try:
+            with transaction.atomic():
+                FeedingLog.objects.bulk_create([row])
+            inserted.append((feeding, row))
+        except IntegrityError:
+            log.info("Feed %s of device owner %s already recorded", feeding["idempotency_key"], device_owner_id)
+    return [feeding for feeding, row in inserted], [row for feeding, row in inserted]
+
+
+def queue_feedings_message(feeder, device_owner_id, feedings):
+    user_settings = NotificationSettings.objects.filter(user_id=feeder["user_id"]).first()
+    if user_settings is None:
+        return None
+
+    messages = [
+        feed_message(user_settings, feeding.get("feed_type", "M"), feeding["feed_amt"], feeding.get("pet_name"))
+        for feeding in feedings
+    ]
+    messages = [message for message in messages if message]
+    if not messages:
+        return None
+    if len(messages) == 1:
+        message = messages[0]
+    else:
+        total = sum(feeding["feed_amt"] for feeding in feedings)
+        message = "%d feeds were recorded while the feeder was offline, %s cup in total." % (
+            len(feedings),
+            Fraction(total).limit_denominator(100),
+        )
+    return MessageQueue.objects.create(
+        device_owner_id=device_owner_id, user_id=feeder["user_id"], title=feeder["name"], message=message, kind=FEEDING
+    )
+
+
+ARCHIVE_GENERATION_KEY = "feeding-log-archive:generation"
+ARCHIVE_FIELDS = [field.attname for field in FeedingLogArchive._meta.concrete_fields]
+
+
+class FeedingHistory:
+    """
+    Feeding log of the hot table followed by the archive, newest first, sliceable like a queryset so it
+    can be paginated. Archived rows are older than every hot row, so a slice within the hot rows never
+    reads the archive and the archive row count is cached until the next archive run.
+    """
+
+    ordered = True
+
+    def __init__(self, hot, archive):
+        self.hot = hot.order_by("-feed_timestamp", "-id")
+        self.archive = archive.order_by("-feed_timestamp", "-id")
+        self._hot_count = None
+
+    def hot_count(self):
+        if self._hot_count is None:
+            self._hot_count = self.hot.count()
+        return self._hot_count
+
+    def archive_count(self):
+        query = str(self.archive.query).encode()
+        key = "feeding-log-archive:%d:%s" % (cache.get(ARCHIVE_GENERATION_KEY, 0), hashlib.md5(query).hexdigest())
+        count = cache.get(key)
+        if count is None:
+            count = self.archive.count()
+            cache.set(key, count, settings.FEEDING_LOG_ARCHIVE_COUNT_TIMEOUT)
+        return count
+
+    def count(self):
+        return self.hot_count() + self.archive_count()
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index : index + 1][0]
+        start, stop = index.start or 0, index.stop
+        rows = []
+        if stop is None or stop > self.hot_count():
+            hot_count = self.hot_count()
+            if start < hot_count:
+                rows += list(self.hot[start:])
+            archive_stop = None if stop is None else stop - hot_count
+            rows += list(self.archive[max(start - hot_count, 0) : archive_stop])
+        else:
+            rows += list(self.hot[start:stop])
+        return rows
+
+
+def feeding_history(**filters):
+    """
+    Feeding log rows of both tables matching the filters, e.g. device_owner__user_id=1
+    """
+    return FeedingHistory(
+        FeedingLog.objects.filter(**filters).select_related("device_owner"),
+        FeedingLogArchive.objects.filter(**filters).select_related("device_owner"),
+    )
+
+
+def archive_feeding_log(before=None, batch_size=10000):
+    """
+    Move the feeding log rows older than FEEDING_LOG_HOT_DAYS (or the given datetime) to the archive table,
+    one transaction per batch. Returns the number of archived rows.
+    """
+    before = before or timezone.now() - timedelta(days=settings.FEEDING_LOG_HOT_DAYS)
+    archived = 0
+    while True:
+        with transaction.atomic():
+            # Oldest first, in the order of the feed_timestamp index
+            rows = list(
+                FeedingLog.objects.filter(feed_timestamp__lt=before)
+                .order_by("feed_timestamp", "id")
+                .select_for_update()
+                .values_list(*ARCHIVE_FIELDS)[:batch_size]
+            )
+            if not rows:
+                break
+            FeedingLogArchive.objects.bulk_create(
+                [FeedingLogArchive(**dict(zip(ARCHIVE_FIELDS, row))) for row in rows], batch_size=1000
+            )
+            FeedingLog.objects.filter(id__in=[row[0] for row in rows]).delete()
+        archived += len(rows)
+        log.info("Archived %d feeding log rows older than %s", archived, before)
+
+    if archived:
+        # Invalidate the cached archive counts
+        cache.set(ARCHIVE_GENERATION_KEY, cache.get(ARCHIVE_GENERATION_KEY, 0) + 1, None)
+    return archived
+
+
+# Rollup column counting the feeds of each feed type
+FEED_TYPE_COLUMNS = {
+    FeedingLog.FeedType.MANUAL: "manual_feeds",
+    FeedingLog.FeedType.AUTO: "scheduled_feeds",
+    FeedingLog.FeedType.REMOTE: "remote_feeds",
+}
+ROLLUP_COLUMNS = ["feed_amt", "feeds"] + list(FEED_TYPE_COLUMNS.values())
+
+
+def rollup_feedings(device_owner_id, feedings, timezone_name):
+    """
+    Add recorded FeedingLog rows of a feeder to its daily rollups, the day being the feed's date in the
+    user's timezone. Each (pet, day) row is incremented with a single UPDATE and created when missing.
+    """
+    local_times = timestamps_to_local([feeding.feed_timestamp for feeding in feedings], timezone_name)
+    totals = defaultdict(Counter)
+    for feeding, local_time in zip(feedings, local_times):
+        total = totals[(feeding.pet_name, local_time.date())]
+        total["feed_amt"] += feeding.feed_amt
+        total["feeds"] += 1
+        total[FEED_TYPE_COLUMNS[feeding.feed_type]] += 1
+
+    for (pet_name, day), total in totals.items():
+        rollup = FeedingRollup.objects.filter(device_owner_id=device_owner_id, pet_name=pet_name, day=day)
+        increments = {column: F(column) + value for column, value in total.items()}
+        if rollup.update(**increments):
+            continue
+        try:
+            with transaction.atomic():
+                FeedingRollup.objects.create(device_owner_id=device_owner_id, pet_name=pet_name, day=day, **total)
+        except IntegrityError:
+            # Created by a concurrent feed since the UPDATE
+            rollup.update(**increments)
+
+
+def _aggregate_days(queryset, zone):
+    # Aggregates are aliased with "agg_" so they don't shadow the feeding log columns they are read from
+    per_type = {
+        "agg_%s" % column: Count("id", filter=Q(feed_type=feed_type)) for feed_type, column in FEED_TYPE_COLUMNS.items()
+    }
+    return (
+        queryset.annotate(day=TruncDate("feed_timestamp", tzinfo=zone))
+        .order_by()
+        .values("device_owner_id", "pet_name", "day")
+        .annotate(agg_feed_amt=Sum("feed_amt"), agg_feeds=Count("id"), **per_type)
+    )
+
+
+def backfill_feeding_rollups(user_id=None, batch_size=None):
+    """
+    Rebuild the daily rollups from the feeding log and its archive, a batch of feeders per transaction
+    (FEEDING_ROLLUP_BATCH_SIZE), for every user or a single one. Returns the number of rollup rows written.
+    """
+    batch_size = batch_size or settings.FEEDING_ROLLUP_BATCH_SIZE
+    owners = DeviceOwner.objects.order_by("id")
+    if user_id is not None:
+        owners = owners.filter(user_id=user_id)
+
+    written = rebuilt = last_id = 0
+    while True:
+        # Paged by id, so every batch is read from the primary key or the user index
+        page = list(owners.filter(id__gt=last_id).values_list("id", "user_id")[:batch_size])
+        if not page:
+            break
+        last_id = page[-1][0]
+        rebuilt += len(page)
+        timezones = dict(
+            Settings.objects.filter(name="timezone", user_id__in={user for owner, user in page}).values_list(
+                "user_id", "value"
+            )
+        )
+        batch = defaultdict(list)
+        for device_owner_id, owner_user_id in page:
+            batch[timezones.get(owner_user_id, "UTC")].append(device_owner_id)
+
+        with transaction.atomic():
+            # Feeds recorded by the owners of the batch wait for their rollups to be rebuilt
+            owner_ids = [device_owner_id for device_owner_ids in batch.values() for device_owner_id in device_owner_ids]
+            list(DeviceOwner.objects.select_for_update().filter(id__in=owner_ids).values_list("id"))
+            FeedingRollup.objects.filter(device_owner_id__in=owner_ids).delete()
+
+            rollups = {}
+            for timezone_name, device_owner_ids in batch.items():
+                zone = get_zone(timezone_name)
+                for model in (FeedingLog, FeedingLogArchive):
+                    for row in _aggregate_days(model.objects.filter(device_owner_id__in=device_owner_ids), zone):
+                        key = (row["device_owner_id"], row["pet_name"], row["day"])
+                        rollup = rollups.setdefault(
+                            key, FeedingRollup(device_owner_id=key[0], pet_name=key[1], day=key[2])
+                        )
+                        for column in ROLLUP_COLUMNS:
+                            setattr(rollup, column, getattr(rollup, column) + row["agg_%s" % column])
+            FeedingRollup.objects.bulk_create(rollups.values(), batch_size=1000)
+
+        written += len(rollups)
+        log.info("Rebuilt %d feeding rollups of %d feeders", written, rebuilt)
+    return written
+
+
+def feeding_consumption(user_id, start, end, period="day"):
+    """
+    Food dispensed to the pets of a user per feeder, pet and day (or ISO week, keyed by its Monday) from
+    start to end inclusive, read from the rollups alone
+    """
+    rows = FeedingRollup.objects.filter(device_owner__user_id=user_id, day__gte=start, day__lte=end)
+    if period == "week":
+        rows = rows.annotate(period=TruncWeek("day"))
+    else:
+        rows = rows.annotate(period=F("day"))
+    rows = (
+        rows.order_by("period", "device_owner_id", "pet_name")
+        .values("period", "device_owner_id", "pet_name")
+        .annotate(**{"agg_%s" % column: Sum(column) for column in ROLLUP_COLUMNS})
+    )
+    return [
+        {
+            "period": row["period"],
+            "device_owner_id": row["device_owner_id"],
+            "pet_name": row["pet_name"],
+            **{column: row["agg_%s" % column] for column in ROLLUP_COLUMNS},
+        }
+        for row in rows
+    ]
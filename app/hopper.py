@@ -0,0 +1,138 @@
+import logging
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db.models import F, FloatField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from .models import DeviceOwner, DeviceStatus, FeedingLog, FeedingLogArchive, Settings
+
+log = logging.getLogger(__name__)
+
+FEEDER_FIELDS = ("device_id", "user_id", "name", "feeder_model__hopper_capacity", "timezone")
+
+
+def _cache_key(device_owner_id):
+    return "feeder:%d" % device_owner_id
+
+
+def _shared_cache():
+    # A per-process cache is not invalidated in the other workers, e.g. the celery worker recording the feeds
+    cache = caches["default"]
+    return None if isinstance(cache, LocMemCache) else cache
+
+
+def get_feeder(device_owner_id):
+    """
+    Device, user, name, hopper capacity and user's timezone of a device owner, cached when the cache is
+    shared. None when it does not exist.
+    """
+    cache = _shared_cache()
+    key = _cache_key(device_owner_id)
+    feeder = cache.get(key) if cache is not None else None
+    if feeder is None:
+        user_timezone = Settings.objects.filter(user_id=OuterRef("user_id"), name="timezone").values("value")[:1]
+        row = (
+            DeviceOwner.objects.filter(id=device_owner_id)
+            .annotate(timezone=Subquery(user_timezone))
+            .values_list(*FEEDER_FIELDS)
+            .first()
+        )
+        if row is None:
+            return None
+        feeder = dict(zip(("device_id", "user_id", "name", "hopper_capacity", "timezone"), row))
+        feeder["timezone"] = feeder["timezone"] or "UTC"
+        if cache is not None:
+            cache.set(key, feeder, settings.FEEDER_CACHE_TIMEOUT)
+    return feeder
+
+
+def invalidate_feeder(device_owner_id):
+    cache = _shared_cache()
+    if cache is not None:
+        cache.delete(_cache_key(device_owner_id))
+
+
+def invalidate_user_feeders(user_id):
+    cache = _shared_cache()
+    if cache is None:
+        return
+    cache.delete_many(
+        [_cache_key(owner_id) for owner_id in DeviceOwner.objects.filter(user_id=user_id).values_list("id", flat=True)]
+    )
+
+
+def invalidate_feeder_model(feeder_model_id):
+    cache = _shared_cache()
+    if cache is None:
+        return
+    cache.delete_many(
+        [
+            _cache_key(owner_id)
+            for owner_id in DeviceOwner.objects.filter(feeder_model_id=feeder_model_id).values_list("id", flat=True)
+        ]
+    )
+
+
+def dispense(device_id, capacity, amount):
+    """
+    Take a dispensed amount out of the hopper level in a single UPDATE of that column, so concurrent
+    heartbeats and feeds cannot overwrite each other's changes
+    """
+    if not capacity:
+        return 0
+    return DeviceStatus.objects.filter(device_id=device_id).update(
+        hopper_level=Greatest(F("hopper_level") - amount * 100 / capacity, Value(0.0))
+    )
+
+
+def refill(device_id, level):
+    """
+    Record a refill of the hopper, the level is reconciled from the feeding log from now on
+    """
+    return DeviceStatus.objects.filter(device_id=device_id).update(
+        hopper_level=level, hopper_refill_level=level, hopper_refilled_at=timezone.now()
+    )
+
+
+def _dispensed_since_refill(model):
+    total = (
+        model.objects.filter(
+            device_owner__device_id=OuterRef("device_id"), feed_timestamp__gte=OuterRef("hopper_refilled_at")
+        )
+        .order_by()
+        .values("device_owner__device_id")
+        .annotate(total=Sum("feed_amt"))
+        .values("total")
+    )
+    return Coalesce(Subquery(total), 0.0, output_field=FloatField())
+
+
+def reconcile_hopper_levels(batch_size=None):
+    """
+    Recompute the hopper level of every refilled device from the food dispensed since its last refill,
+    with one UPDATE of a batch of devices that aggregates their feeding logs. A hopper refilled before
+    FEEDING_LOG_HOT_DAYS also counts the feeds moved to the archive since.
+    """
+    dispensed = _dispensed_since_refill(FeedingLog) + _dispensed_since_refill(FeedingLogArchive)
+    capacity = (
+        DeviceOwner.objects.filter(device_id=OuterRef("device_id"), feeder_model__hopper_capacity__gt=0)
+        .order_by("id")
+        .values("feeder_model__hopper_capacity")[:1]
+    )
+    level = F("hopper_refill_level") - dispensed * 100 / Subquery(capacity)
+
+    batch_size = batch_size or settings.HOPPER_RECONCILE_BATCH_SIZE
+    statuses = DeviceStatus.objects.filter(hopper_refilled_at__isnull=False).order_by("device_id")
+    # Sorted here, so the ids are read from the hopper_refilled_at index
+    device_ids = sorted(statuses.order_by().values_list("device_id", flat=True))
+    updated = 0
+    for start in range(0, len(device_ids), batch_size):
+        batch = device_ids[start : start + batch_size]
+        updated += statuses.filter(
+            device_id__in=batch, device__deviceowner__feeder_model__hopper_capacity__gt=0
+        ).update(hopper_level=Greatest(level, Value(0.0)))
+    log.info("Reconciled the hopper level of %d devices", updated)
+    return updated
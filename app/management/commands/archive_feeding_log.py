@@ -0,0 +1,22 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from app.feeding_log import archive_feeding_log
+
+
+class Command(BaseCommand):
+    help = "Move feeding log rows older than FEEDING_LOG_HOT_DAYS to the archive table"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days", type=int, default=settings.FEEDING_LOG_HOT_DAYS, help="Keep this many days in the feeding log"
+        )
+        parser.add_argument("--batch-size", type=int, default=10000, help="Rows moved per transaction")
+
+    def handle(self, *args, **options):
+        before = timezone.now() - datetime.timedelta(days=options["days"])
+        archived = archive_feeding_log(before, options["batch_size"])
+        self.stdout.write("Archived %d feeding log rows older than %s" % (archived, before.isoformat()))
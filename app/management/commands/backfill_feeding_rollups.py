@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from app.feeding_log import backfill_feeding_rollups
+
+
+class Command(BaseCommand):
+    help = "Rebuild the daily feeding rollups from the feeding log and its archive"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", type=int, help="Only rebuild the rollups of this user id")
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.FEEDING_ROLLUP_BATCH_SIZE,
+            help="Feeders rebuilt per transaction",
+        )
+
+    def handle(self, *args, **options):
+        written = backfill_feeding_rollups(user_id=options["user"], batch_size=options["batch_size"])
+        self.stdout.write("Wrote %d feeding rollups" % written)
@@ -0,0 +1,179 @@
+import datetime
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from app.benchmark import benchmark_database
+from app.feeding_log import FeedingHistory
+from app.models import Device, DeviceOwner, FeedingLog, FeedingLogArchive, MotorTiming
+
+# Archived feeds of a device are 8 hours apart, going back from the archive cutoff
+ARCHIVE_INTERVAL = 8 * 3600
+
+# Timestamp of the archived row n, per database vendor
+ARCHIVE_TIMESTAMP = {
+    "sqlite": "datetime(%(cutoff)d - (n / %(devices)d) * %(interval)d, 'unixepoch')",
+    "postgresql": "to_timestamp(%(cutoff)d - (n / %(devices)d) * %(interval)d)",
+    "mysql": "CONVERT_TZ(FROM_UNIXTIME(%(cutoff)d - (n DIV %(devices)d) * %(interval)d), @@session.time_zone, '+00:00')",
+}
+
+
+class Command(BaseCommand):
+    help = "Measure the dashboard and history queries of the feeding log as the archive grows"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rows",
+            default="1000000,10000000,50000000",
+            help="Comma separated total feeding log sizes to benchmark (default 1000000,10000000,50000000)",
+        )
+        parser.add_argument("--devices", type=int, default=1000, help="Number of feeders")
+        parser.add_argument("--meals", type=int, default=3, help="Feeds per feeder and day in the hot table")
+        parser.add_argument("--hot-days", type=int, default=90, help="Days of feeds kept in the hot table")
+        parser.add_argument("--samples", type=int, default=200, help="Queries timed per measurement")
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            owner_ids = self.create_fleet(options)
+            hot_rows = FeedingLog.objects.count()
+            self.stdout.write(
+                "%d feeders, %d rows in the hot table (%d days)" % (len(owner_ids), hot_rows, options["hot_days"])
+            )
+            archived = 0
+            for total in sorted(int(n) for n in options["rows"].split(",")):
+                start = time.perf_counter()
+                archived = self.grow_archive(archived, max(total - hot_rows, 0), options)
+                self.stdout.write(
+                    "%11d rows  archive of %d rows filled in %.1fs"
+                    % (hot_rows + archived, archived, time.perf_counter() - start)
+                )
+                self.measure(hot_rows + archived, owner_ids, options["samples"])
+
+    def create_fleet(self, options):
+        user = User.objects.create_user(username="benchmark", password="benchmark")
+        motor_timing = MotorTiming.objects.create(feed_amount=0.25, motor_duration=1000, interrupter_count=7)
+        devices = Device.objects.bulk_create(
+            [
+                Device(control_board_identifier="ESP32-0000-%08x" % i, secret_key="%015d" % i)
+                for i in range(options["devices"])
+            ],
+            batch_size=1000,
+        )
+        # bulk_create skips the signals, no events or hopper updates
+        owners = DeviceOwner.objects.bulk_create(
+            [
+                DeviceOwner(
+                    device_id=device.id, user=user, device_key="%032x" % device.id, manual_motor_timing=motor_timing
+                )
+                for device in devices
+            ],
+            batch_size=1000,
+        )
+        now = timezone.now()
+        step = datetime.timedelta(days=1) / options["meals"]
+        for owner in owners:
+            FeedingLog.objects.bulk_create(
+                [
+                    FeedingLog(
+                        device_owner_id=owner.id,
+                        pet_name="Benchmark",
+                        feed_type="S",
+                        feed_amt=0.25,
+                        feed_timestamp=now - i * step,
+                    )
+                    for i in range(options["hot_days"] * options["meals"])
+                ],
+                batch_size=1000,
+            )
+        self.owner_ids = [owner.id for owner in owners]
+        self.cutoff = int((now - datetime.timedelta(days=options["hot_days"])).timestamp())
+        return self.owner_ids
+
+    def grow_archive(self, archived, size, options):
+        """
+        Append archived rows server side, a million per statement, ids continuing after the hot table's
+        """
+        first_owner = min(self.owner_ids)
+        devices = len(self.owner_ids)
+        first_id = FeedingLog.objects.order_by("-id").values_list("id", flat=True).first() + 1
+        timestamp = ARCHIVE_TIMESTAMP[connection.vendor] % {
+            "cutoff": self.cutoff,
+            "devices": devices,
+            "interval": ARCHIVE_INTERVAL,
+        }
+        with connection.cursor() as cursor:
+            if connection.vendor == "mysql":
+                # The row numbers are generated by a recursive CTE, a million levels deep
+                cursor.execute("SET SESSION cte_max_recursion_depth = 1000000")
+            for start in range(archived, size, 1000000):
+                end = min(size, start + 1000000)
+                cursor.execute(
+                    "INSERT INTO %s (id, device_owner_id, pet_name, feed_type, feed_amt, feed_timestamp) "
+                    "WITH RECURSIVE seq(n) AS (SELECT %d UNION ALL SELECT n + 1 FROM seq WHERE n < %d) "
+                    "SELECT %d + n, %d + n %% %d, 'Benchmark', 'S', 0.25, %s FROM seq"
+                    % (FeedingLogArchive._meta.db_table, start, end - 1, first_id, first_owner, devices, timestamp)
+                )
+        cache.clear()
+        return max(size, archived)
+
+    def measure(self, total, owner_ids, samples):
+        step = max(len(owner_ids) // samples, 1)
+        sample = (owner_ids * samples)[::step][:samples]
+
+        def dashboard(owner_id):
+            list(FeedingLog.objects.filter(device_owner_id=owner_id).order_by("-feed_timestamp")[:5])
+
+        def history(owner_id):
+            rows = FeedingHistory(
+                FeedingLog.objects.filter(device_owner_id=owner_id),
+                FeedingLogArchive.objects.filter(device_owner_id=owner_id),
+            )
+            rows.count()
+            list(rows[0:30])
+
+        def deep_history(owner_id):
+            rows = FeedingHistory(
+                FeedingLog.objects.filter(device_owner_id=owner_id),
+                FeedingLogArchive.objects.filter(device_owner_id=owner_id),
+            )
+            list(rows[rows.hot_count() + 300 : rows.hot_count() + 330])
+
+        def unsplit(owner_id):
+            # The history page of a single table holding every row: whole history sorted, then the first page
+            rows = (
+                FeedingLog.objects.filter(device_owner_id=owner_id)
+                .values_list("id", "feed_timestamp")
+                .union(
+                    FeedingLogArchive.objects.filter(device_owner_id=owner_id).values_list("id", "feed_timestamp"),
+                    all=True,
+                )
+            )
+            list(rows.order_by("-feed_timestamp")[:30])
+
+        for label, query in (
+            ("dashboard recent 5", dashboard),
+            ("history page 1", history),
+            ("history in archive", deep_history),
+            ("unsplit page 1", unsplit),
+        ):
+            timings = []
+            for owner_id in sample:
+                start = time.perf_counter()
+                query(owner_id)
+                timings.append((time.perf_counter() - start) * 1000)
+            timings.sort()
+            self.stdout.write(
+                "%11d rows  %-20s p50: %8.3fms  p95: %8.3fms  mean: %8.3fms"
+                % (
+                    total,
+                    label,
+                    statistics.median(timings),
+                    timings[int(len(timings) * 0.95) - 1],
+                    statistics.mean(timings),
+                )
+            )
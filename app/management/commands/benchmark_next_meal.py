@@ -0,0 +1,111 @@
+import datetime
+import time
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+
+from app.benchmark import QueryCounter, benchmark_database
+from app.models import Device, DeviceOwner, FeederModel, FeedingSchedule, MotorTiming, Pet
+from app.next_meal import fleet_next_meals
+from app.utils import get_next_feeding
+
+
+class Command(BaseCommand):
+    help = "Compare the per-device next meal lookup with the vectorized fleet computation"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--devices",
+            default="10,1000,100000",
+            help="Comma separated fleet sizes to benchmark (default 10,1000,100000)",
+        )
+        parser.add_argument("--meals", type=int, default=3, help="Active meals per feeder")
+
+    def handle(self, *args, **options):
+        # Saturday evening, most feeders' next meal is in the next week
+        now = datetime.datetime(2022, 6, 4, 20, 0, tzinfo=datetime.timezone.utc)
+        with benchmark_database():
+            created = 0
+            for size in sorted(int(n) for n in options["devices"].split(",")):
+                created = self.grow_fleet(created, size, options["meals"])
+                device_ids = list(Device.objects.order_by("id").values_list("id", flat=True))
+
+                cache.clear()
+                per_device, per_device_counter = self.run(lambda: self.per_device(device_ids, now))
+                fleet, fleet_counter = self.run(lambda: fleet_next_meals(device_ids, now=now))
+
+                expected = {device_id: meal["meal_id"] for device_id, meal in per_device.items()}
+                if {device_id: schedule_id for device_id, (dt, schedule_id) in fleet.as_dict().items()} != expected:
+                    self.stderr.write("Next meals of the two paths differ")
+
+                self.report(size, "per-device", per_device_counter)
+                self.report(size, "vectorized", fleet_counter)
+                self.stdout.write("%8d devices  speedup: %.1fx" % (size, per_device_counter.wall / fleet_counter.wall))
+
+    def per_device(self, device_ids, now):
+        return {device_id: get_next_feeding(device_id, now=now) for device_id in device_ids}
+
+    def run(self, compute):
+        counter = QueryCounter()
+        start = time.perf_counter()
+        with counter.count():
+            result = compute()
+        counter.wall = time.perf_counter() - start
+        return result, counter
+
+    def grow_fleet(self, created, size, meals):
+        if created == 0:
+            user = User.objects.create_user(username="benchmark", password="benchmark")
+            self.pet = Pet.objects.create(user=user, name="Benchmark")
+            self.motor_timing = MotorTiming.objects.create(feed_amount=0.25, motor_duration=1000, interrupter_count=7)
+            self.feeder_model = FeederModel.objects.create(
+                brand_name="Petnet", model_name="SmartFeeder", hopper_capacity=20
+            )
+            self.user = user
+
+        # bulk_create skips the signals, the fleet is written without events or schedule versions
+        for start in range(created, size, 10000):
+            end = min(size, start + 10000)
+            devices = Device.objects.bulk_create(
+                [
+                    Device(control_board_identifier="ESP32-0000-%08x" % i, secret_key="%015d" % i)
+                    for i in range(start, end)
+                ]
+            )
+            owners = DeviceOwner.objects.bulk_create(
+                [
+                    DeviceOwner(
+                        device_id=device.id,
+                        user=self.user,
+                        device_key="%032x" % device.id,
+                        feeder_model=self.feeder_model,
+                        manual_motor_timing=self.motor_timing,
+                    )
+                    for device in devices
+                ]
+            )
+            FeedingSchedule.objects.bulk_create(
+                [
+                    FeedingSchedule(
+                        device_id=owner.device_id,
+                        device_owner=owner,
+                        pet=self.pet,
+                        meal_name="Meal %d" % meal,
+                        # Spread the meals over the day and the feeders over different weekdays
+                        dow=(0b1111111 if meal else 1 << (owner.device_id % 7)),
+                        time=datetime.time((6 + meal * 6 + owner.device_id) % 24, (owner.device_id * 7) % 60),
+                        motor_timing=self.motor_timing,
+                    )
+                    for owner in owners
+                    for meal in range(meals)
+                ],
+                batch_size=5000,
+            )
+        return size
+
+    def report(self, size, label, counter):
+        self.stdout.write(
+            "%8d devices  %-12s queries: %7d  wall: %8.3fs  devices/s: %12.1f"
+            % (size, label, counter.queries, counter.wall, size / counter.wall)
+        )
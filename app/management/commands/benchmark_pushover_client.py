@@ -0,0 +1,70 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from app.pushover.client import AsyncPushover, Pushover
+from app.pushover.ratelimit import TokenBucket
+from app.pushover.stub import PushoverStub
+
+
+class Command(BaseCommand):
+    help = "Measure the messages per second of the sync and asyncio Pushover clients against the local stub"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=500)
+        parser.add_argument("--serial-messages", type=int, default=50, help="Messages sent one by one")
+        parser.add_argument("--latency", type=float, default=50, help="Response time of the Pushover stub (ms)")
+        parser.add_argument("--concurrency", type=int, default=16)
+        parser.add_argument("--rate", type=float, default=None, help="Token bucket rate, unlimited by default")
+
+    def handle(self, *args, **options):
+        concurrency = options["concurrency"]
+        with PushoverStub(latency=options["latency"] / 1000) as stub:
+            self.stdout.write("Pushover stub answering in %dms" % options["latency"])
+
+            def client(cls, pool_size):
+                bucket = TokenBucket(options["rate"], burst=1) if options["rate"] else None
+                return cls(api_key="benchmark", base_url=stub.url, pool_size=pool_size, bucket=bucket)
+
+            pushover = client(Pushover, 1)
+            self.report("sync serial", self.serial(pushover, self.messages(options["serial_messages"])))
+
+            pushover = client(Pushover, concurrency)
+            label = "sync %d threads" % concurrency
+            self.report(label, self.threaded(pushover, self.messages(options["messages"]), concurrency))
+
+            label = "async send_many x%d" % concurrency
+            self.report(label, asyncio.run(self.send_many(client(AsyncPushover, concurrency), options["messages"])))
+
+    @staticmethod
+    def messages(count):
+        return [("user%d" % i, "phone", "Kitchen", "Message %d" % i, 0) for i in range(count)]
+
+    @staticmethod
+    def serial(pushover, messages):
+        start = time.perf_counter()
+        responses = [pushover.send_message(*message) for message in messages]
+        return responses, time.perf_counter() - start
+
+    @staticmethod
+    def threaded(pushover, messages, concurrency):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            responses = list(executor.map(lambda message: pushover.send_message(*message), messages))
+        return responses, time.perf_counter() - start
+
+    async def send_many(self, pushover, count):
+        async with pushover:
+            start = time.perf_counter()
+            responses = await pushover.send_many(self.messages(count))
+            return responses, time.perf_counter() - start
+
+    def report(self, label, result):
+        responses, elapsed = result
+        failed = sum(1 for r in responses if isinstance(r, Exception) or r.status_code != 200)
+        self.stdout.write(
+            "%-22s messages: %5d  failed: %4d  wall: %6.2fs  messages/s: %7.1f"
+            % (label, len(responses), failed, elapsed, len(responses) / elapsed)
+        )
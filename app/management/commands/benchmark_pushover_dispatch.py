@@ -0,0 +1,92 @@
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from app.benchmark import QueryCounter, benchmark_database
+from app.models import MessageQueue, NotificationSettings
+from app.pushover.client import Pushover
+from app.pushover.dispatcher import PushoverDispatcher
+from app.pushover.ratelimit import TokenBucket
+from app.pushover.stub import PushoverStub
+
+
+class Command(BaseCommand):
+    help = "Compare the Pushover messages sent per second by the dispatcher and by the former 5 per tick drain"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=500, help="Pending messages")
+        parser.add_argument("--users", type=int, default=100, help="Users the messages are spread over")
+        parser.add_argument("--latency", type=float, default=100, help="Response time of the Pushover stub (ms)")
+        parser.add_argument("--concurrency", type=int, default=settings.PUSHOVER_CONCURRENCY)
+        parser.add_argument("--rate", type=float, default=settings.PUSHOVER_RATE, help="Messages per second")
+        parser.add_argument("--burst", type=float, default=settings.PUSHOVER_BURST)
+        parser.add_argument("--legacy-messages", type=int, default=10, help="Messages timed with the former drain")
+
+    def handle(self, *args, **options):
+        with benchmark_database(), PushoverStub(latency=options["latency"] / 1000) as stub:
+            self.create_messages(options["messages"], options["users"])
+            self.stdout.write(
+                "%d pending messages of %d users, Pushover stub answering in %dms"
+                % (options["messages"], options["users"], options["latency"])
+            )
+            self.report("5 per tick drain", options["legacy_messages"], *self.measure(self.legacy_drain, stub, options))
+
+            MessageQueue.objects.update(status_code="P")
+            dispatcher = PushoverDispatcher(
+                Pushover(base_url=stub.url, pool_size=options["concurrency"]),
+                bucket=TokenBucket(options["rate"], options["burst"]),
+                concurrency=options["concurrency"],
+            )
+            label = "dispatcher x%d %g/s" % (options["concurrency"], options["rate"])
+            sent = stub.sent
+
+            def dispatch(stub, options):
+                return dispatcher.run(window=0)
+
+            self.report(label, options["messages"], *self.measure(dispatch, stub, options))
+            self.stdout.write("%d Pushover calls, one digest per user" % (stub.sent - sent))
+
+    def create_messages(self, num_messages, num_users):
+        users = User.objects.bulk_create([User(username="benchmark%d" % i) for i in range(num_users)])
+        NotificationSettings.objects.bulk_create(
+            [
+                NotificationSettings(user=user, pushover_user_key="key%d" % user.id, pushover_devices="phone")
+                for user in users
+            ]
+        )
+        MessageQueue.objects.bulk_create(
+            [
+                MessageQueue(user=users[i % num_users], title="Feeder", message="Message %d" % i)
+                for i in range(num_messages)
+            ],
+            batch_size=1000,
+        )
+
+    @staticmethod
+    def measure(run, stub, options):
+        counter = QueryCounter()
+        start = time.perf_counter()
+        with counter.count():
+            run(stub, options)
+        return time.perf_counter() - start, counter
+
+    @staticmethod
+    def legacy_drain(stub, options):
+        # The former check_pushover_message_queue: a settings query, a send, a save and a 0.5s sleep per message
+        pushover = Pushover(base_url=stub.url)
+        for message in MessageQueue.objects.filter(status_code="P").order_by("created_at")[
+            : options["legacy_messages"]
+        ]:
+            user = NotificationSettings.objects.get(user_id=message.user_id)
+            r = pushover.send_message(user.pushover_user_key, user.pushover_devices, message.title, message.message, 0)
+            message.status_code = "C" if r.status_code == 200 else "E"
+            message.save()
+            time.sleep(0.5)
+
+    def report(self, label, messages, elapsed, counter):
+        self.stdout.write(
+            "%-24s messages: %6d  wall: %7.2fs  messages/s: %7.1f  queries/message: %5.2f"
+            % (label, messages, elapsed, messages / elapsed, counter.queries / messages)
+        )
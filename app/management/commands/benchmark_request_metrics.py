@@ -0,0 +1,75 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.urls import resolve
+
+from app.benchmark import benchmark_database
+from app.metrics import RequestMetrics
+from app.middleware.metrics import RequestMetricsMiddleware
+
+
+class Command(BaseCommand):
+    help = "Measure the per request overhead of the request metrics middleware on a heartbeat sized request"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=20000, help="Number of simulated requests")
+        parser.add_argument("--queries", type=int, default=4, help="Queries run by each request (heartbeat: 4)")
+
+    def handle(self, *args, **options):
+        # Recorded in a store of its own, never written to the files of the running workers
+        store = RequestMetrics(directory="")
+        factory = RequestFactory()
+        match = resolve("/api/device/heartbeat/")
+
+        def view(request):
+            with connection.cursor() as cursor:
+                for i in range(options["queries"]):
+                    cursor.execute("SELECT %s", [i])
+            return HttpResponse()
+
+        def plain(request):
+            return view(request)
+
+        def instrumented(request):
+            middleware.process_request(request)
+            return middleware.process_response(request, view(request))
+
+        middleware = RequestMetricsMiddleware(view)
+        middleware.metrics = store
+        with benchmark_database():
+            # Warm up the connection and the fingerprint cache
+            self.run(factory, match, (plain, instrumented), 1000)
+            without, with_metrics = self.run(factory, match, (plain, instrumented), options["requests"])
+
+        self.stdout.write(
+            "%d requests of %d queries on %s" % (options["requests"], options["queries"], match._func_path)
+        )
+        for label, timings in (("without metrics", without), ("with metrics", with_metrics)):
+            self.stdout.write(
+                "%-16s p50: %8.2fus  mean: %8.2fus"
+                % (label, statistics.median(timings) * 1e6, statistics.mean(timings) * 1e6)
+            )
+        self.stdout.write(
+            "overhead         p50: %8.2fus  mean: %8.2fus"
+            % (
+                (statistics.median(with_metrics) - statistics.median(without)) * 1e6,
+                (statistics.mean(with_metrics) - statistics.mean(without)) * 1e6,
+            )
+        )
+
+    @staticmethod
+    def run(factory, match, handlers, requests):
+        # The handlers take turns so both see the same machine load
+        timings = [[] for handler in handlers]
+        for i in range(requests):
+            for handler, handler_timings in zip(handlers, timings):
+                request = factory.post("/api/device/heartbeat/")
+                request.resolver_match = match
+                start = time.perf_counter()
+                handler(request)
+                handler_timings.append(time.perf_counter() - start)
+        return timings
@@ -0,0 +1,116 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from app.benchmark import QueryCounter, benchmark_database
+from app.models import Device, DeviceStatus
+from app.telemetry import TELEMETRY_FIELDS, TelemetryBuffer
+
+
+class VirtualClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Command(BaseCommand):
+    help = "Compare DeviceStatus rows written per second with and without heartbeat telemetry coalescing"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--devices", type=int, default=10000, help="Number of simulated feeders")
+        parser.add_argument("--heartbeat", type=int, default=5, help="Heartbeat interval of each feeder (seconds)")
+        parser.add_argument("--duration", type=int, default=60, help="Simulated fleet time (seconds)")
+        parser.add_argument("--flush-interval", type=int, default=30, help="Coalescing flush interval (seconds)")
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            statuses = self.create_fleet(options["devices"])
+            self.stdout.write(
+                "%d feeders, heartbeat every %ds, %ds of simulated traffic"
+                % (options["devices"], options["heartbeat"], options["duration"])
+            )
+            self.report("full row save", self.run(statuses, options, self.save_full_row))
+            self.report("update_fields save", self.run(statuses, options, self.save_telemetry_fields))
+            self.report("coalesced", self.run_coalesced(statuses, options))
+
+    def create_fleet(self, num_devices):
+        Device.objects.bulk_create(
+            [
+                Device(control_board_identifier="ESP32-0000-%08x" % i, secret_key="%015d" % i)
+                for i in range(num_devices)
+            ],
+            batch_size=1000,
+        )
+        DeviceStatus.objects.bulk_create(
+            [DeviceStatus(device_id=device_id) for device_id in Device.objects.values_list("id", flat=True)],
+            batch_size=1000,
+        )
+        return list(DeviceStatus.objects.all())
+
+    def pings(self, statuses, options):
+        # Each feeder pings once per heartbeat interval, spread evenly over the interval
+        start = timezone.now()
+        for second in range(options["duration"]):
+            for status in statuses[second % options["heartbeat"] :: options["heartbeat"]]:
+                status.last_ping = start + datetime.timedelta(seconds=second)
+                status.battery_soc = 100 - (second % 100)
+                status.battery_voltage = 4.1
+                status.battery_crate = -0.5
+                status.on_power = bool(second % 2)
+                yield second, status
+
+    @staticmethod
+    def save_full_row(status):
+        status.save()
+
+    @staticmethod
+    def save_telemetry_fields(status):
+        status.save(update_fields=TELEMETRY_FIELDS + ["updated_at"])
+
+    def run(self, statuses, options, save):
+        counter = QueryCounter()
+        pings = 0
+        start = time.perf_counter()
+        with counter.count():
+            for second, status in self.pings(statuses, options):
+                save(status)
+                pings += 1
+        return pings, counter, time.perf_counter() - start, options["duration"]
+
+    def run_coalesced(self, statuses, options):
+        clock = VirtualClock()
+        buffer = TelemetryBuffer(interval=options["flush_interval"], clock=clock, background=False)
+        counter = QueryCounter()
+        pings = 0
+        start = time.perf_counter()
+        with counter.count():
+            for second, status in self.pings(statuses, options):
+                if clock.now != second:
+                    clock.now = second
+                    if buffer.is_due():
+                        buffer.flush()
+                with buffer.lock:
+                    buffer.pending[status.device_id] = {name: getattr(status, name) for name in TELEMETRY_FIELDS}
+                pings += 1
+            buffer.flush()
+        return pings, counter, time.perf_counter() - start, options["duration"]
+
+    def report(self, label, result):
+        pings, counter, elapsed, duration = result
+        self.stdout.write(
+            "%-20s pings: %7d  UPDATE statements: %7d  rows written: %7d  rows/s (fleet time): %9.1f"
+            "  wall: %6.2fs  pings/s (wall): %9.1f"
+            % (
+                label,
+                pings,
+                counter.updates,
+                counter.rows_updated,
+                counter.rows_updated / duration,
+                elapsed,
+                pings / elapsed,
+            )
+        )
@@ -0,0 +1,460 @@
+import datetime
+import heapq
+import json
+import logging
+import math
+import random
+import re
+import statistics
+import subprocess
+import threading
+import time
+from collections import Counter, defaultdict
+
+import requests
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connection, transaction
+from django.utils import timezone
+
+from app.models import (
+    Device,
+    DeviceOwner,
+    FeedingSchedule,
+    MotorTiming,
+    NotificationSettings,
+    Pet,
+    Settings,
+)
+from app.utils import generate_device_key
+
+# Simulated feeders are tagged through their usernames and board identifiers, so a fleet is reused by later runs
+USERNAME = "loadtest-%06d"
+BOARD_IDENTIFIER = "ESP32-10ad-%08x"
+
+# Requests of the device protocol, with the view serving them as named in the request metrics (app.metrics)
+ENDPOINTS = {
+    "device/verify": "api.views.verify_device",
+    "device/heartbeat": "api.views.heartbeat",
+    "feeding-schedule": "api.views.FeedingScheduleViewSet",
+    "event/task-completed": "api.views.event_task_completed",
+}
+SCHEDULE_CHANGED = 300
+
+# The API allows each user one request per second, the requests a heartbeat leads to are spaced out
+FOLLOW_UP_DELAY = 1.1
+
+QUERY_METRIC = re.compile(r'^smart_petfeeder_request_db_queries_(sum|count)\{view="([^"]+)"\} (\S+)$', re.M)
+
+
+def percentile(timings, q):
+    """
+    Nearest rank percentile of sorted timings
+    """
+    if not timings:
+        return None
+    return timings[min(len(timings) - 1, max(math.ceil(q * len(timings)) - 1, 0))]
+
+
+class SimulatedFeeder:
+    """
+    One ESP32 feeder following the device protocol: verify on boot, then a heartbeat every interval. A
+    schedule (300) event is answered by fetching the feeding schedule, every event is then completed.
+    """
+
+    def __init__(self, number, secret_key, heartbeat_body):
+        self.number = number
+        self.board_identifier = BOARD_IDENTIFIER % number
+        self.secret_key = secret_key
+        self.heartbeat_body = heartbeat_body
+        # Every feeder has an address of its own, as seen by the anonymous rate limit of device/verify
+        self.headers = {"CF-Connecting-IP": "10.%d.%d.%d" % (number >> 16 & 255, number >> 8 & 255, number & 255)}
+        self.schedule_etag = None
+        # Actions queued by the last heartbeat, run FOLLOW_UP_DELAY apart
+        self.follow_ups = []
+
+    def boot(self, client):
+        response = client.request(
+            "device/verify", "get", "/api/device/verify/%s/%s/" % (self.board_identifier, self.secret_key), self.headers
+        )
+        if response is not None and response.status_code == 200:
+            data = response.json()
+            self.headers["Authorization"] = "Token %s" % data["api_key"]
+            self.headers["X-Device-Key"] = data["device_key"]
+            return True
+        return False
+
+    def heartbeat(self, client):
+        body = dict(self.heartbeat_body, battery_soc=round(random.uniform(20, 100), 1))
+        response = client.request("device/heartbeat", "post", "/api/device/heartbeat/", self.headers, body)
+        if response is None or response.status_code != 200:
+            return
+        for event in response.json().get("events", []):
+            if event["event_code"] == SCHEDULE_CHANGED:
+                self.follow_ups.append(self.fetch_schedule)
+            self.follow_ups.append(lambda client, event_id=event["id"]: self.complete_event(client, event_id))
+
+    def fetch_schedule(self, client):
+        headers = dict(self.headers)
+        if self.schedule_etag:
+            headers["If-None-Match"] = self.schedule_etag
+        response = client.request("feeding-schedule", "get", "/api/feeding-schedule/", headers)
+        if response is not None and response.status_code == 200:
+            self.schedule_etag = response.headers.get("ETag")
+
+    def complete_event(self, client, event_id):
+        client.request("event/task-completed", "post", "/api/event/task-completed/", self.headers, {"id": event_id})
+
+
+class FleetClient:
+    """
+    HTTP session of a load generator thread, keeping the latency and status of every request it sent
+    """
+
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.timings = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.lags = []
+
+    def request(self, endpoint, method, path, headers, body=None):
+        start = time.perf_counter()
+        try:
+            response = self.session.request(
+                method, self.base_url + path, headers=headers, json=body, timeout=self.timeout
+            )
+        except requests.RequestException as e:
+            self.statuses[endpoint][type(e).__name__] += 1
+            return None
+        self.timings[endpoint].append(time.perf_counter() - start)
+        self.statuses[endpoint][str(response.status_code)] += 1
+        return response
+
+
+class Command(BaseCommand):
+    help = (
+        "Simulate a fleet of feeders against a running server and report the throughput, latency and database "
+        "queries of each device endpoint. Run it with the settings of the server: the simulated feeders are "
+        "created in its database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="http://127.0.0.1:8000", help="Base URL of the server under test")
+        parser.add_argument("--feeders", type=int, default=100, help="Number of simulated feeders")
+        parser.add_argument("--heartbeat", type=float, default=5, help="Heartbeat interval of each feeder (seconds)")
+        parser.add_argument("--duration", type=float, default=60, help="Length of the run (seconds)")
+        parser.add_argument("--concurrency", type=int, default=16, help="Load generator threads")
+        parser.add_argument(
+            "--schedule-changes",
+            type=float,
+            default=6,
+            help="Schedule edits per minute across the fleet, each queues a schedule (300) event",
+        )
+        parser.add_argument("--timeout", type=float, default=30, help="HTTP timeout (seconds)")
+        parser.add_argument(
+            "--metrics-token", default=None, help="Bearer token of metrics/ (default: REQUEST_METRICS_TOKEN)"
+        )
+        parser.add_argument("--output", default=None, help="Write the results as JSON to this file")
+        parser.add_argument("--seed", type=int, default=None, help="Random seed, for repeatable runs")
+        parser.add_argument("--delete", action="store_true", help="Delete the simulated fleet and exit")
+
+    def handle(self, *args, **options):
+        if options["delete"]:
+            self.delete_fleet()
+            return
+        if options["feeders"] < 1 or options["concurrency"] < 1 or options["heartbeat"] <= 0:
+            raise CommandError("--feeders, --concurrency and --heartbeat must be positive")
+        random.seed(options["seed"])
+        # One line per request otherwise when DEBUG is on
+        logging.getLogger("urllib3").setLevel(logging.WARNING)
+
+        feeders = self.create_fleet(options["feeders"])
+        metrics_token = options["metrics_token"] or settings.REQUEST_METRICS_TOKEN
+        queries_before = self.scrape_queries(options["url"], metrics_token)
+        clients, elapsed = self.run(feeders, options)
+        queries_after = self.scrape_queries(options["url"], metrics_token)
+
+        results = self.summarize(clients, elapsed, options, queries_before, queries_after)
+        self.report(results)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write("Results written to %s" % options["output"])
+
+    def create_fleet(self, num_feeders):
+        """
+        Users, tokens, devices and device owners of the simulated feeders, the missing ones are created
+        """
+        motor_timing = MotorTiming.objects.order_by("id").first() or MotorTiming.objects.create(
+            feed_amount=0.25, motor_duration=1000, interrupter_count=7
+        )
+        existing = dict(
+            Device.objects.filter(
+                control_board_identifier__in=[BOARD_IDENTIFIER % i for i in range(num_feeders)]
+            ).values_list("control_board_identifier", "secret_key")
+        )
+        feeders = []
+        created = 0
+        for number in range(num_feeders):
+            board_identifier = BOARD_IDENTIFIER % number
+            if board_identifier not in existing:
+                existing[board_identifier] = self.create_feeder(number, motor_timing)
+                created += 1
+            feeders.append(
+                SimulatedFeeder(
+                    number,
+                    existing[board_identifier],
+                    {
+                        "battery_voltage": 4.1,
+                        "battery_crate": -0.5,
+                        "on_power": True,
+                        "control_board_revision": "1.1",
+                        "firmware_version": "1.0.0",
+                        "is_hopper_low": False,
+                    },
+                )
+            )
+        self.stdout.write("%d simulated feeders, %d created" % (num_feeders, created))
+        return feeders
+
+    @transaction.atomic
+    def create_feeder(self, number, motor_timing):
+        # The user's token is created by its post_save signal, the owner's status and events by the owner's
+        user = User.objects.create_user(username=USERNAME % number, password=None)
+        Settings.objects.create(user=user, name="timezone", value="UTC")
+        NotificationSettings.objects.create(user=user, pushover_user_key="", pushover_devices="")
+        pet = Pet.objects.create(user=user, name="Pet %d" % number)
+        secret_key = "%015d" % random.randrange(10**15)
+        device = Device.objects.create(control_board_identifier=BOARD_IDENTIFIER % number, secret_key=secret_key)
+        owner = DeviceOwner.objects.create(
+            device=device,
+            user=user,
+            name="Load test %d" % number,
+            device_key=generate_device_key(device.id),
+            manual_motor_timing=motor_timing,
+        )
+        for meal_name, time_of_day in (("Breakfast", "07:00:00"), ("Dinner", "18:00:00")):
+            FeedingSchedule.objects.create(
+                device=device,
+                device_owner=owner,
+                pet=pet,
+                meal_name=meal_name,
+                dow=127,
+                time=time_of_day,
+                local_time=time_of_day,
+                motor_timing=motor_timing,
+            )
+        return secret_key
+
+    def delete_fleet(self):
+        users = User.objects.filter(username__startswith=USERNAME.split("%")[0])
+        devices = Device.objects.filter(control_board_identifier__startswith=BOARD_IDENTIFIER.split("%")[0])
+        num_users = users.count()
+        with transaction.atomic():
+            users.delete()
+            devices.delete()
+        self.stdout.write("Deleted %d simulated feeders" % num_users)
+
+    def edit_schedule(self):
+        """
+        Move a random simulated feeder's meal by a minute, as the schedule page does
+        """
+        schedule = (
+            FeedingSchedule.objects.filter(device__control_board_identifier__startswith=BOARD_IDENTIFIER.split("%")[0])
+            .order_by("?")
+            .first()
+        )
+        if schedule is None:
+            return False
+        moved = datetime.datetime.combine(datetime.date.today(), schedule.time) + datetime.timedelta(minutes=1)
+        schedule.time = schedule.local_time = moved.time()
+        try:
+            # The save queues the schedule (300) event of the feeder
+            schedule.save()
+        except DatabaseError as e:
+            # e.g. SQLite refusing a second writer, the server's requests see the same
+            self.stderr.write("Unable to edit a schedule: %r" % e)
+            return False
+        return True
+
+    def run(self, feeders, options):
+        threads = min(options["concurrency"], len(feeders))
+        clients = [FleetClient(options["url"], options["timeout"]) for i in range(threads)]
+        start = time.monotonic()
+        end = start + options["duration"]
+        workers = [
+            threading.Thread(
+                target=self.drive, args=(clients[i], feeders[i::threads], options["heartbeat"], start, end), daemon=True
+            )
+            for i in range(threads)
+        ]
+        for worker in workers:
+            worker.start()
+
+        self.stdout.write(
+            "Running %d feeders on %d threads for %ds, heartbeat every %ss"
+            % (len(feeders), threads, options["duration"], options["heartbeat"])
+        )
+        interval = 60 / options["schedule_changes"] if options["schedule_changes"] > 0 else None
+        next_change = start + interval if interval else end
+        self.schedule_edits = Counter()
+        while time.monotonic() < end:
+            time.sleep(max(min(next_change, end) - time.monotonic(), 0))
+            if interval and time.monotonic() < end:
+                self.schedule_edits["done" if self.edit_schedule() else "failed"] += 1
+                next_change += interval
+        for worker in workers:
+            worker.join()
+        connection.close()
+        return clients, time.monotonic() - start
+
+    @staticmethod
+    def drive(client, feeders, heartbeat, start, end):
+        """
+        Run the feeders of one thread in the order their requests fall due. A feeder behind its due time
+        is sent at once, the delay is reported as lag.
+        """
+        due = [(start + random.uniform(0, heartbeat), feeder.number, feeder) for feeder in feeders]
+        heapq.heapify(due)
+        booted = set()
+        while due:
+            at, number, feeder = heapq.heappop(due)
+            if at >= end:
+                break
+            now = time.monotonic()
+            if at > now:
+                time.sleep(at - now)
+            else:
+                client.lags.append(now - at)
+            sent = max(at, now)
+
+            if number not in booted:
+                if feeder.boot(client):
+                    booted.add(number)
+                heapq.heappush(due, (at + heartbeat, number, feeder))
+            else:
+                if feeder.follow_ups:
+                    feeder.follow_ups.pop(0)(client)
+                else:
+                    feeder.heartbeat(client)
+                # Heartbeats keep their cadence, the requests they lead to are spaced from the actual send time
+                next_due = sent + FOLLOW_UP_DELAY if feeder.follow_ups else at + heartbeat
+                heapq.heappush(due, (next_due, number, feeder))
+
+    def scrape_queries(self, base_url, token):
+        """
+        Database queries and requests per view so far, {view: (queries, requests)}, read from the server's
+        request metrics
+        """
+        headers = {"Authorization": "Bearer %s" % token} if token else {}
+        try:
+            response = requests.get(base_url.rstrip("/") + "/metrics/", headers=headers, timeout=10)
+        except requests.RequestException as e:
+            self.stderr.write("Unable to read the request metrics: %r" % e)
+            return None
+        if response.status_code != 200:
+            self.stderr.write(
+                "Unable to read the request metrics (HTTP %d), pass --metrics-token to report the queries per request"
+                % response.status_code
+            )
+            return None
+
+        totals = defaultdict(lambda: [0.0, 0.0])
+        for kind, view, value in QUERY_METRIC.findall(response.text):
+            totals[view][0 if kind == "sum" else 1] = float(value)
+        return totals
+
+    def summarize(self, clients, elapsed, options, queries_before, queries_after):
+        endpoints = {}
+        for endpoint, view in ENDPOINTS.items():
+            timings = sorted(timing for client in clients for timing in client.timings[endpoint])
+            statuses = Counter()
+            for client in clients:
+                statuses.update(client.statuses[endpoint])
+            if not statuses:
+                continue
+
+            queries_per_request = None
+            if queries_before is not None and queries_after is not None:
+                queries = queries_after[view][0] - queries_before[view][0]
+                served = queries_after[view][1] - queries_before[view][1]
+                if served:
+                    queries_per_request = round(queries / served, 2)
+
+            requests_sent = sum(statuses.values())
+            endpoints[endpoint] = {
+                "view": view,
+                "requests": requests_sent,
+                "errors": requests_sent - statuses["200"] - statuses["304"],
+                "statuses": dict(statuses),
+                "throughput": round(requests_sent / elapsed, 2),
+                "p50_ms": self.milliseconds(percentile(timings, 0.5)),
+                "p95_ms": self.milliseconds(percentile(timings, 0.95)),
+                "p99_ms": self.milliseconds(percentile(timings, 0.99)),
+                "mean_ms": self.milliseconds(statistics.mean(timings) if timings else None),
+                "max_ms": self.milliseconds(timings[-1] if timings else None),
+                "db_queries_per_request": queries_per_request,
+            }
+
+        lags = sorted(lag for client in clients for lag in client.lags)
+        total = sum(endpoint["requests"] for endpoint in endpoints.values())
+        return {
+            "commit": self.git_commit(),
+            "started_at": (timezone.now() - datetime.timedelta(seconds=elapsed)).isoformat(),
+            "url": options["url"],
+            "database": connection.vendor,
+            "feeders": options["feeders"],
+            "heartbeat": options["heartbeat"],
+            "duration": round(elapsed, 2),
+            "concurrency": len(clients),
+            "schedule_changes": options["schedule_changes"],
+            "schedule_edits": dict(self.schedule_edits),
+            "requests": total,
+            "errors": sum(endpoint["errors"] for endpoint in endpoints.values()),
+            "throughput": round(total / elapsed, 2),
+            # How late the feeders' requests went out, a growing lag means the server or the client is saturated
+            "lag_p95_ms": self.milliseconds(percentile(lags, 0.95) if lags else 0.0),
+            "endpoints": endpoints,
+        }
+
+    @staticmethod
+    def milliseconds(seconds):
+        return None if seconds is None else round(seconds * 1000, 3)
+
+    @staticmethod
+    def git_commit():
+        try:
+            return subprocess.run(
+                ["git", "rev-parse", "HEAD"], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def report(self, results):
+        self.stdout.write(
+            "%d requests in %.1fs, %.1f requests/s, %d errors, lag p95 %.1fms"
+            % (
+                results["requests"],
+                results["duration"],
+                results["throughput"],
+                results["errors"],
+                results["lag_p95_ms"],
+            )
+        )
+        for endpoint, row in results["endpoints"].items():
+            self.stdout.write(
+                "%-22s %7d requests %8.1f/s  p50: %8.2fms  p95: %8.2fms  p99: %8.2fms  errors: %5d  queries: %s"
+                % (
+                    endpoint,
+                    row["requests"],
+                    row["throughput"],
+                    row["p50_ms"] or 0,
+                    row["p95_ms"] or 0,
+                    row["p99_ms"] or 0,
+                    row["errors"],
+                    "-" if row["db_queries_per_request"] is None else row["db_queries_per_request"],
+                )
+            )
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from app.pushover.stub import PushoverStub
+
+
+class Command(BaseCommand):
+    help = "Serve a local stand-in for the Pushover API, set PUSHOVER_API_URL to its URL for throughput tests"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8025)
+        parser.add_argument("--latency", type=float, default=100, help="Response time of each request (ms)")
+        parser.add_argument("--rate", type=float, default=None, help="Messages per second above which 429 is answered")
+        parser.add_argument("--app-limit", type=int, default=10000, help="Messages accepted before answering 429")
+        parser.add_argument("--failure-rate", type=float, default=0.0, help="Share of the messages answered an error")
+        parser.add_argument("--failure-status", type=int, default=500, help="Status code of the failed messages")
+        parser.add_argument("--retry-after", type=int, default=None, help="Retry-After of the failed messages (s)")
+
+    def handle(self, *args, **options):
+        stub = PushoverStub(
+            options["host"],
+            options["port"],
+            latency=options["latency"] / 1000,
+            rate=options["rate"],
+            app_limit=options["app_limit"],
+            failure_rate=options["failure_rate"],
+            failure_status=options["failure_status"],
+            retry_after=options["retry_after"],
+        )
+        self.stdout.write("Pushover stub listening on %s" % stub.url)
+        try:
+            stub.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stub.server.server_close()
+            self.stdout.write("%d messages accepted, %d rejected, %d failed" % (stub.sent, stub.rejected, stub.failed))
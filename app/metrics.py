@@ -0,0 +1,279 @@
+import atexit
+import bisect
+import hmac
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from functools import lru_cache
+
+from django.conf import settings
+
+log = logging.getLogger(__name__)
+
+# Histogram upper bounds, Prometheus style: a value v is counted in the first bucket with v <= bound
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+DB_DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+HISTOGRAMS = (
+    ("duration", "request_duration_seconds", "Wall time of the requests", DURATION_BUCKETS),
+    ("db_duration", "request_db_duration_seconds", "Time spent in database queries per request", DB_DURATION_BUCKETS),
+    ("queries", "request_db_queries", "Database queries per request", QUERY_COUNT_BUCKETS),
+)
+METRIC_PREFIX = "smart_petfeeder_"
+
+QUOTED = re.compile(r"'(?:[^']|'')*'")
+NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+PLACEHOLDERS = re.compile(r"(?:(?:%s|\?)\s*,\s*)+(?:%s|\?)")
+SPACES = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=1024)
+def fingerprint(sql):
+    """
+    Query text with its literals and IN lists collapsed, so the same statement with other values has the same
+    fingerprint
+    """
+    sql = QUOTED.sub("?", sql)
+    sql = NUMBER.sub("?", sql)
+    sql = PLACEHOLDERS.sub("...", sql)
+    return SPACES.sub(" ", sql).strip()[:300]
+
+
+class QueryRecorder:
+    """
+    Database execute wrapper counting the queries of a request, their time and the slowest one
+    """
+
+    __slots__ = ("queries", "elapsed", "slowest", "slowest_sql")
+
+    def __init__(self):
+        self.queries = 0
+        self.elapsed = 0.0
+        self.slowest = 0.0
+        self.slowest_sql = None
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.queries += 1
+            self.elapsed += elapsed
+            if elapsed > self.slowest:
+                self.slowest = elapsed
+                self.slowest_sql = sql
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # The last count is the +Inf bucket
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class ViewMetrics:
+    __slots__ = ("duration", "db_duration", "queries", "slow_queries")
+
+    def __init__(self):
+        self.duration = Histogram(DURATION_BUCKETS)
+        self.db_duration = Histogram(DB_DURATION_BUCKETS)
+        self.queries = Histogram(QUERY_COUNT_BUCKETS)
+        # {fingerprint: [requests it was the slowest query of, total seconds, max seconds]}
+        self.slow_queries = {}
+
+
+class RequestMetrics:
+    """
+    Per view request histograms of a worker process.
+
+    Recording a request only updates counters in memory. When a directory is given the worker writes its
+    totals to its own file in there every flush_interval seconds, and collect() adds up the files of all the
+    workers, so any worker can answer the Prometheus scrape.
+    """
+
+    def __init__(self, directory=None, flush_interval=None, slow_queries=None, clock=time.monotonic):
+        self.directory = directory if directory is not None else settings.REQUEST_METRICS_DIR
+        self.flush_interval = flush_interval if flush_interval is not None else settings.REQUEST_METRICS_FLUSH_INTERVAL
+        self.slow_queries = slow_queries if slow_queries is not None else settings.REQUEST_METRICS_SLOW_QUERIES
+        self.clock = clock
+        self.views = {}
+        self.lock = threading.Lock()
+        self.pid = None
+        self.path = None
+        self.last_flush = clock()
+
+    def record(self, view, duration, recorder):
+        with self.lock:
+            metrics = self.views.get(view)
+            if metrics is None:
+                metrics = self.views[view] = ViewMetrics()
+            metrics.duration.observe(duration)
+            metrics.db_duration.observe(recorder.elapsed)
+            metrics.queries.observe(recorder.queries)
+            if recorder.slowest_sql is not None:
+                self.add_slow_query(metrics.slow_queries, fingerprint(recorder.slowest_sql), recorder.slowest)
+
+        if self.directory and self.clock() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def add_slow_query(self, slow_queries, query, elapsed):
+        entry = slow_queries.get(query)
+        if entry is None:
+            if len(slow_queries) >= self.slow_queries:
+                fastest = min(slow_queries, key=lambda key: slow_queries[key][2])
+                if slow_queries[fastest][2] >= elapsed:
+                    return
+                del slow_queries[fastest]
+            entry = slow_queries[query] = [0, 0.0, 0.0]
+        entry[0] += 1
+        entry[1] += elapsed
+        entry[2] = max(entry[2], elapsed)
+
+    def reset(self):
+        with self.lock:
+            self.views = {}
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                view: {
+                    "duration": [metrics.duration.counts[:], metrics.duration.sum],
+                    "db_duration": [metrics.db_duration.counts[:], metrics.db_duration.sum],
+                    "queries": [metrics.queries.counts[:], metrics.queries.sum],
+                    "slow_queries": {query: entry[:] for query, entry in metrics.slow_queries.items()},
+                }
+                for view, metrics in self.views.items()
+            }
+
+    def flush(self):
+        """
+        Write the totals of this worker to its file, replaced atomically so a scrape never reads half of it
+        """
+        self.last_flush = self.clock()
+        if self.pid != os.getpid():
+            # First flush of a worker, forked workers must not share the file of the master
+            self.pid = os.getpid()
+            self.path = os.path.join(self.directory, "%d-%s.json" % (self.pid, uuid.uuid4().hex[:8]))
+            atexit.register(self.flush)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            temp_path = "%s.%d.tmp" % (self.path, threading.get_ident())
+            with open(temp_path, "w") as f:
+                json.dump(self.snapshot(), f)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            log.error("Unable to write the request metrics to %s: %r", self.path, e)
+
+    def collect(self):
+        """
+        Totals of every worker, {view: snapshot}. Files of the workers that exited are kept so the counters
+        never go down.
+        """
+        snapshots = [self.snapshot()]
+        if self.directory and os.path.isdir(self.directory):
+            for name in sorted(os.listdir(self.directory)):
+                path = os.path.join(self.directory, name)
+                if not name.endswith(".json") or path == self.path:
+                    continue
+                try:
+                    with open(path) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError) as e:
+                    log.warning("Unable to read the request metrics of %s: %r", path, e)
+        return merge_snapshots(snapshots, self.slow_queries)
+
+
+def merge_snapshots(snapshots, slow_queries):
+    merged = {}
+    for snapshot in snapshots:
+        for view, metrics in snapshot.items():
+            total = merged.get(view)
+            if total is None:
+                total = merged[view] = {name: [[0] * (len(bounds) + 1), 0.0] for name, _, _, bounds in HISTOGRAMS}
+                total["slow_queries"] = {}
+            for name, _, _, bounds in HISTOGRAMS:
+                counts, value_sum = metrics[name]
+                if len(counts) != len(bounds) + 1:
+                    # Written by a worker running other buckets, e.g. during a deploy
+                    continue
+                total[name][0] = [a + b for a, b in zip(total[name][0], counts)]
+                total[name][1] += value_sum
+            for query, (count, elapsed, slowest) in metrics["slow_queries"].items():
+                entry = total["slow_queries"].setdefault(query, [0, 0.0, 0.0])
+                entry[0] += count
+                entry[1] += elapsed
+                entry[2] = max(entry[2], slowest)
+
+    for total in merged.values():
+        slowest = sorted(total["slow_queries"].items(), key=lambda item: item[1][2], reverse=True)
+        total["slow_queries"] = dict(slowest[:slow_queries])
+    return merged
+
+
+def can_read_metrics(request):
+    """
+    Staff users and scrapers sending the REQUEST_METRICS_TOKEN bearer token can read the metrics
+    """
+    if request.user.is_authenticated and request.user.is_staff:
+        return True
+    token = settings.REQUEST_METRICS_TOKEN
+    authorization = request.headers.get("Authorization", "")
+    return bool(token) and hmac.compare_digest(authorization.encode(), ("Bearer %s" % token).encode())
+
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_prometheus(merged):
+    """
+    Merged metrics in the Prometheus text exposition format
+    """
+    lines = []
+    views = sorted(merged)
+    for name, metric, description, bounds in HISTOGRAMS:
+        metric = METRIC_PREFIX + metric
+        lines.append("# HELP %s %s by view" % (metric, description))
+        lines.append("# TYPE %s histogram" % metric)
+        for view in views:
+            counts, value_sum = merged[view][name]
+            label = escape_label(view)
+            cumulative = 0
+            for bound, count in zip(bounds + ("+Inf",), counts):
+                cumulative += count
+                lines.append('%s_bucket{view="%s",le="%s"} %d' % (metric, label, bound, cumulative))
+            lines.append('%s_sum{view="%s"} %r' % (metric, label, value_sum))
+            lines.append('%s_count{view="%s"} %d' % (metric, label, cumulative))
+
+    slow_metrics = (
+        ("slowest_query_total", "counter", "Requests the query was the slowest of", 0, "%d"),
+        ("slowest_query_seconds_total", "counter", "Time spent in the query when it was the slowest", 1, "%r"),
+        ("slowest_query_seconds_max", "gauge", "Longest run of the query", 2, "%r"),
+    )
+    for metric, kind, description, index, value_format in slow_metrics:
+        metric = METRIC_PREFIX + metric
+        lines.append("# HELP %s %s, by view and query fingerprint" % (metric, description))
+        lines.append("# TYPE %s %s" % (metric, kind))
+        for view in views:
+            for query, entry in merged[view]["slow_queries"].items():
+                lines.append(
+                    ('%s{view="%s",query="%s"} ' + value_format)
+                    % (metric, escape_label(view), escape_label(query), entry[index])
+                )
+    return "\n".join(lines) + "\n"
+
+
+request_metrics = RequestMetrics()
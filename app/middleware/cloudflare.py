@@ -1,17 +1,18 @@
 import logging
 
+from django.utils.deprecation import MiddlewareMixin
+
 log = logging.getLogger(__name__)
 
 
-class CloudflareMiddleware:
-    def __init__(self, get_response):
-        self.get_response = get_response
+class CloudflareMiddleware(MiddlewareMixin):
+    # MiddlewareMixin keeps the middleware chain async under ASGI, a sync-only middleware would run
+    # every async view (api/event/wait/) in a worker thread for the whole request
 
-    def __call__(self, request):
+    def process_request(self, request):
         try:
             ip = request.headers["CF-Connecting-IP"]
         except KeyError:
             ip = request.META["REMOTE_ADDR"]
         request.ip = ip
         request.META["REMOTE_ADDR"] = ip
-        return self.get_response(request)
@@ -0,0 +1,38 @@
+import time
+
+from django.db import connection
+from django.utils.deprecation import MiddlewareMixin
+
+from app.metrics import QueryRecorder, request_metrics
+
+
+class RequestMetricsMiddleware(MiddlewareMixin):
+    """
+    Records the wall time, database queries and slowest query of every request by view (see app.metrics).
+    Goes first in MIDDLEWARE so the time and queries of the other middleware are included.
+    """
+
+    metrics = request_metrics
+
+    def process_request(self, request):
+        recorder = QueryRecorder()
+        # The connection of the thread is looked up once, each lookup through django.db.connection costs
+        # several microseconds
+        wrappers = connection.execute_wrappers
+        wrappers.append(recorder)
+        request.query_recorder = (recorder, wrappers)
+        request.metrics_start = time.perf_counter()
+
+    def process_response(self, request, response):
+        if not hasattr(request, "query_recorder"):
+            return response
+        duration = time.perf_counter() - request.metrics_start
+        recorder, wrappers = request.query_recorder
+        try:
+            wrappers.remove(recorder)
+        except ValueError:
+            pass
+
+        match = request.resolver_match
+        self.metrics.record(match._func_path if match else "unresolved", duration, recorder)
+        return response
@@ -0,0 +1,66 @@
+# Generated by Django 4.0.4 on 2026-10-18 14:11
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0016_alter_feedinglog_feed_timestamp'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TelemetrySample',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ts', models.PositiveIntegerField()),
+                ('battery_voltage', models.SmallIntegerField(null=True)),
+                ('battery_soc', models.SmallIntegerField(null=True)),
+                ('battery_crate', models.SmallIntegerField(null=True)),
+                ('hopper_level', models.SmallIntegerField(null=True)),
+                ('on_power', models.BooleanField(default=True)),
+                ('device', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='app.device')),
+            ],
+            options={
+                'db_table': 'app_telemetry_sample',
+            },
+        ),
+        migrations.CreateModel(
+            name='TelemetryRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.PositiveIntegerField(choices=[(60, '1 minute'), (3600, '1 hour'), (86400, '1 day')])),
+                ('bucket', models.PositiveIntegerField()),
+                ('samples', models.PositiveIntegerField(default=0)),
+                ('on_power_samples', models.PositiveIntegerField(default=0)),
+                ('battery_voltage_min', models.SmallIntegerField(null=True)),
+                ('battery_voltage_avg', models.SmallIntegerField(null=True)),
+                ('battery_voltage_max', models.SmallIntegerField(null=True)),
+                ('battery_soc_min', models.SmallIntegerField(null=True)),
+                ('battery_soc_avg', models.SmallIntegerField(null=True)),
+                ('battery_soc_max', models.SmallIntegerField(null=True)),
+                ('battery_crate_avg', models.SmallIntegerField(null=True)),
+                ('hopper_level_min', models.SmallIntegerField(null=True)),
+                ('hopper_level_avg', models.SmallIntegerField(null=True)),
+                ('hopper_level_max', models.SmallIntegerField(null=True)),
+                ('device', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='app.device')),
+            ],
+            options={
+                'db_table': 'app_telemetry_rollup',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='telemetrysample',
+            index=models.Index(fields=['device', 'ts'], name='telemetry_sample_device_ts'),
+        ),
+        migrations.AddIndex(
+            model_name='telemetryrollup',
+            index=models.Index(fields=['resolution', 'bucket'], name='telemetry_rollup_resolution'),
+        ),
+        migrations.AddConstraint(
+            model_name='telemetryrollup',
+            constraint=models.UniqueConstraint(fields=('device', 'resolution', 'bucket'), name='telemetry_rollup_device_resolution_bucket'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 4.0.4 on 2026-10-18 14:23
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0017_telemetrysample_telemetryrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeedingScheduleRemoval',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('schedule_id', models.PositiveIntegerField()),
+                ('version', models.PositiveIntegerField()),
+            ],
+            options={
+                'db_table': 'app_feeding_schedule_removal',
+            },
+        ),
+        migrations.AddField(
+            model_name='feedingschedule',
+            name='created_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='feedingschedule',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='feedingschedule',
+            index=models.Index(fields=['device_owner', 'version'], name='feeding_schedule_owner_version'),
+        ),
+        migrations.AddField(
+            model_name='feedingscheduleremoval',
+            name='device_owner',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, to='app.deviceowner'),
+        ),
+        migrations.AddIndex(
+            model_name='feedingscheduleremoval',
+            index=models.Index(fields=['device_owner', 'version'], name='schedule_removal_owner_version'),
+        ),
+    ]
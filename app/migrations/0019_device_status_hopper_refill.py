@@ -0,0 +1,23 @@
+# Generated by Django 4.0.4 on 2026-10-18 14:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0018_feeding_schedule_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='devicestatus',
+            name='hopper_refill_level',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='devicestatus',
+            name='hopper_refilled_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.0.4 on 2026-10-18 14:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0019_device_status_hopper_refill'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feedinglog',
+            name='idempotency_key',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='feedinglog',
+            constraint=models.UniqueConstraint(fields=('device_owner', 'idempotency_key'), name='feeding_log_idempotency_key'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.0.4 on 2026-10-18 14:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0020_feeding_log_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeedingLogArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pet_name', models.CharField(default='Manual', max_length=80)),
+                ('feed_type', models.CharField(choices=[('M', 'Manual'), ('S', 'Scheduled'), ('R', 'Remote')], default='M', max_length=1)),
+                ('feed_amt', models.FloatField(default=0.5)),
+                ('feed_timestamp', models.DateTimeField(default=django.utils.timezone.now)),
+                ('idempotency_key', models.CharField(max_length=64, null=True)),
+                ('device_owner', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='app.deviceowner')),
+            ],
+            options={
+                'db_table': 'app_feeding_log_archive',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='feedinglogarchive',
+            index=models.Index(fields=['device_owner', '-feed_timestamp'], name='feeding_archive_owner_ts'),
+        ),
+    ]
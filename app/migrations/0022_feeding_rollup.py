@@ -0,0 +1,35 @@
+# Generated by Django 4.0.4 on 2026-10-18 14:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0021_feeding_log_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeedingRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pet_name', models.CharField(max_length=80)),
+                ('day', models.DateField()),
+                ('feed_amt', models.FloatField(default=0)),
+                ('feeds', models.PositiveIntegerField(default=0)),
+                ('manual_feeds', models.PositiveIntegerField(default=0)),
+                ('scheduled_feeds', models.PositiveIntegerField(default=0)),
+                ('remote_feeds', models.PositiveIntegerField(default=0)),
+                ('device_owner', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='app.deviceowner')),
+            ],
+            options={
+                'db_table': 'app_feeding_rollup',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='feedingrollup',
+            constraint=models.UniqueConstraint(fields=('device_owner', 'day', 'pet_name'), name='feeding_rollup_owner_day_pet'),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 4.0.4 on 2026-10-18 15:07
+
+from django.db import migrations, models
+from django.db.models import Max
+import django.db.models.deletion
+
+
+def remove_duplicate_device_status(apps, schema_editor):
+    # Keep the latest status row of each device before the column becomes unique
+    DeviceStatus = apps.get_model('app', 'DeviceStatus')
+    latest = DeviceStatus.objects.values('device_id').annotate(latest_id=Max('id')).values('latest_id')
+    DeviceStatus.objects.exclude(id__in=list(latest)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0022_feeding_rollup'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='device',
+            name='control_board_identifier',
+            field=models.CharField(db_index=True, max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='device',
+            name='secret_key',
+            field=models.CharField(db_index=True, max_length=16),
+        ),
+        migrations.RunPython(remove_duplicate_device_status, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='devicestatus',
+            name='device',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='app.device'),
+        ),
+        migrations.AddIndex(
+            model_name='deviceowner',
+            index=models.Index(fields=['user', 'device_key'], name='device_owner_user_key'),
+        ),
+        migrations.AddIndex(
+            model_name='devicestatus',
+            index=models.Index(fields=['last_ping'], name='device_status_last_ping'),
+        ),
+        migrations.AddIndex(
+            model_name='eventqueue',
+            index=models.Index(fields=['device_owner', 'status_code', 'created_at'], name='event_queue_owner_status'),
+        ),
+        migrations.AddIndex(
+            model_name='messagequeue',
+            index=models.Index(fields=['status_code', 'created_at'], name='message_queue_status_created'),
+        ),
+        migrations.AddIndex(
+            model_name='settings',
+            index=models.Index(fields=['user', 'name'], name='settings_user_name'),
+        ),
+    ]
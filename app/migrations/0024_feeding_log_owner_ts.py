@@ -0,0 +1,17 @@
+# Generated by Django 4.0.4 on 2026-10-18 15:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0023_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='feedinglog',
+            index=models.Index(fields=['device_owner', '-feed_timestamp'], name='feeding_log_owner_ts'),
+        ),
+    ]
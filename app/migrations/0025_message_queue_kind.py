@@ -0,0 +1,23 @@
+# Generated by Django 4.0.4 on 2026-10-18 15:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0024_feeding_log_owner_ts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagequeue',
+            name='kind',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+        migrations.AlterField(
+            model_name='messagequeue',
+            name='status_code',
+            field=models.CharField(choices=[('P', 'Pending'), ('C', 'Completed'), ('E', 'Error'), ('S', 'Superseded')], default='P', max_length=1),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.0.4 on 2026-10-18 15:38
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0025_message_queue_kind'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='messagequeue',
+            name='message_queue_status_created',
+        ),
+        migrations.AddField(
+            model_name='messagequeue',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='messagequeue',
+            name='next_attempt_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AlterField(
+            model_name='messagequeue',
+            name='status_code',
+            field=models.CharField(choices=[('P', 'Pending'), ('C', 'Completed'), ('E', 'Error'), ('S', 'Superseded'), ('D', 'Dead letter')], default='P', max_length=1),
+        ),
+        migrations.AddIndex(
+            model_name='messagequeue',
+            index=models.Index(fields=['status_code', 'next_attempt_at'], name='message_queue_status_due'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.0.4 on 2026-10-18 16:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0026_message_queue_retry'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='telemetrysample',
+            index=models.Index(fields=['ts', 'device'], name='telemetry_sample_ts_device'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.0.4 on 2026-10-18 16:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0027_telemetry_sample_ts'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='feedinglog',
+            index=models.Index(fields=['feed_timestamp'], name='feeding_log_ts'),
+        ),
+    ]
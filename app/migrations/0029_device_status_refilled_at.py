@@ -0,0 +1,17 @@
+# Generated by Django 4.0.4 on 2026-10-18 16:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0028_feeding_log_ts'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='devicestatus',
+            index=models.Index(fields=['hopper_refilled_at', 'device'], name='device_status_refilled_at'),
+        ),
+    ]
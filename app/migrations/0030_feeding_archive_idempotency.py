@@ -0,0 +1,17 @@
+# Generated by Django 4.0.4 on 2026-10-18 16:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0029_device_status_refilled_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='feedinglogarchive',
+            index=models.Index(fields=['device_owner', 'idempotency_key'], name='feeding_archive_idempotency'),
+        ),
+    ]
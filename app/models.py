@@ -1,6 +1,5 @@
 import logging
 from datetime import datetime
-from fractions import Fraction
 
 import pytz
 import qrcode
@@ -8,8 +7,8 @@ import qrcode.image.svg
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import models
-from django.db.models.signals import post_save
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 from django.utils.safestring import mark_safe
 from django.utils.timezone import now
@@ -63,8 +62,8 @@ class FeederModel(models.Model):
 
 
 class Device(models.Model):
-    control_board_identifier = models.CharField(max_length=20)
-    secret_key = models.CharField(max_length=16)
+    control_board_identifier = models.CharField(max_length=20, db_index=True)
+    secret_key = models.CharField(max_length=16, db_index=True)
     created_at = models.DateTimeField(auto_now=True)
 
     def activation_qrcode(self):
@@ -90,6 +89,7 @@ class DeviceOwner(models.Model):
 
     class Meta:
         db_table = "app_device_owner"
+        indexes = [models.Index(fields=["user", "device_key"], name="device_owner_user_key")]
 
 
 class Pet(models.Model):
@@ -112,6 +112,9 @@ class FeedingSchedule(models.Model):
     time = models.TimeField(default="06:00:00")
     local_time = models.TimeField(default="06:00:00")
     motor_timing = models.ForeignKey(MotorTiming, models.CASCADE, default=1)
+    # Schedule versions of the device owner at which the row was last changed and added (see app.schedule_sync)
+    version = models.PositiveIntegerField(default=0)
+    created_version = models.PositiveIntegerField(default=0)
 
     def utc_datetime(self):
         current = datetime.now()
@@ -125,6 +128,23 @@ class FeedingSchedule(models.Model):
 
     class Meta:
         db_table = "app_feeding_schedule"
+        indexes = [models.Index(fields=["device_owner", "version"], name="feeding_schedule_owner_version")]
+
+
+class FeedingScheduleRemoval(models.Model):
+    """
+    Feeding schedule row removed from a device owner's schedule, so schedule diffs can report it
+    """
+
+    # No database constraint: removals are recorded while a device owner is being deleted, they are
+    # cleaned up once the device owner is gone
+    device_owner = models.ForeignKey(DeviceOwner, models.DO_NOTHING, db_constraint=False)
+    schedule_id = models.PositiveIntegerField()
+    version = models.PositiveIntegerField()
+
+    class Meta:
+        db_table = "app_feeding_schedule_removal"
+        indexes = [models.Index(fields=["device_owner", "version"], name="schedule_removal_owner_version")]
 
 
 class FeedingLog(models.Model):
@@ -138,13 +158,70 @@ class FeedingLog(models.Model):
     feed_type = models.CharField(max_length=1, choices=FeedType.choices, default=FeedType.MANUAL)
     feed_amt = models.FloatField(default=0.5)
     feed_timestamp = models.DateTimeField(null=False, default=now)
+    # Generated by the feeder so a replayed upload is recorded once (see app.feeding_log.record_feedings)
+    idempotency_key = models.CharField(max_length=64, null=True)
 
     class Meta:
         db_table = "app_feeding_log"
+        constraints = [
+            models.UniqueConstraint(fields=["device_owner", "idempotency_key"], name="feeding_log_idempotency_key"),
+        ]
+        indexes = [
+            models.Index(fields=["device_owner", "-feed_timestamp"], name="feeding_log_owner_ts"),
+            # Rows older than the hot window, read by archive_feeding_log
+            models.Index(fields=["feed_timestamp"], name="feeding_log_ts"),
+        ]
 
     def convert_timezone(self, timezone):
-        dt = self.feed_timestamp
-        return dt.astimezone(pytz.timezone(timezone))
+        from .timezones import timestamp_to_local
+
+        return timestamp_to_local(self.feed_timestamp, timezone)
+
+
+class FeedingLogArchive(models.Model):
+    """
+    Feeding log rows older than FEEDING_LOG_HOT_DAYS, moved out of app_feeding_log with their id by the
+    archive_feeding_log command. Full history reads go through app.feeding_log.FeedingHistory.
+    """
+
+    device_owner = models.ForeignKey(DeviceOwner, models.CASCADE, db_index=False)
+    pet_name = models.CharField(max_length=80, default="Manual")
+    feed_type = models.CharField(max_length=1, choices=FeedingLog.FeedType.choices, default=FeedingLog.FeedType.MANUAL)
+    feed_amt = models.FloatField(default=0.5)
+    feed_timestamp = models.DateTimeField(null=False, default=now)
+    idempotency_key = models.CharField(max_length=64, null=True)
+
+    class Meta:
+        db_table = "app_feeding_log_archive"
+        indexes = [
+            models.Index(fields=["device_owner", "-feed_timestamp"], name="feeding_archive_owner_ts"),
+            # Replayed feeds are checked against the archived keys too
+            models.Index(fields=["device_owner", "idempotency_key"], name="feeding_archive_idempotency"),
+        ]
+
+    convert_timezone = FeedingLog.convert_timezone
+
+
+class FeedingRollup(models.Model):
+    """
+    Food dispensed by a feeder for a pet over one day of the user's timezone, maintained as feeds are
+    recorded (see app.feeding_log.rollup_feedings) and rebuilt by the backfill_feeding_rollups command
+    """
+
+    device_owner = models.ForeignKey(DeviceOwner, models.CASCADE, db_index=False)
+    pet_name = models.CharField(max_length=80)
+    day = models.DateField()
+    feed_amt = models.FloatField(default=0)
+    feeds = models.PositiveIntegerField(default=0)
+    manual_feeds = models.PositiveIntegerField(default=0)
+    scheduled_feeds = models.PositiveIntegerField(default=0)
+    remote_feeds = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        db_table = "app_feeding_rollup"
+        constraints = [
+            models.UniqueConstraint(fields=["device_owner", "day", "pet_name"], name="feeding_rollup_owner_day_pet"),
+        ]
 
 
 class Settings(models.Model):
@@ -154,6 +231,7 @@ class Settings(models.Model):
 
     class Meta:
         db_table = "app_settings"
+        indexes = [models.Index(fields=["user", "name"], name="settings_user_name")]
 
 
 class EventQueue(models.Model):
@@ -170,10 +248,13 @@ class EventQueue(models.Model):
 
     class Meta:
         db_table = "app_event_queue"
+        indexes = [
+            models.Index(fields=["device_owner", "status_code", "created_at"], name="event_queue_owner_status"),
+        ]
 
 
 class DeviceStatus(models.Model):
-    device = models.ForeignKey(Device, models.CASCADE)
+    device = models.OneToOneField(Device, models.CASCADE)
     control_board_revision = models.CharField(max_length=5, null=True)
     firmware_version = models.CharField(max_length=15, null=True, default="factory")
     last_boot = models.DateTimeField(auto_now_add=True)
@@ -182,6 +263,9 @@ class DeviceStatus(models.Model):
     battery_soc = models.FloatField(null=True, default=0.0)
     battery_crate = models.FloatField(null=True, default=0.0)
     hopper_level = models.FloatField(null=True, default=0.0)
+    # Level set by the last refill, the food dispensed since then is reconciled from the feeding log (see app.hopper)
+    hopper_refill_level = models.FloatField(null=True)
+    hopper_refilled_at = models.DateTimeField(null=True)
     has_event = models.BooleanField(default=False)
     on_power = models.BooleanField(default=True)
     is_hopper_low = models.BooleanField(default=False)
@@ -189,6 +273,11 @@ class DeviceStatus(models.Model):
 
     class Meta:
         db_table = "app_device_status"
+        indexes = [
+            models.Index(fields=["last_ping"], name="device_status_last_ping"),
+            # Refilled devices, read by reconcile_hopper_levels
+            models.Index(fields=["hopper_refilled_at", "device"], name="device_status_refilled_at"),
+        ]
 
 
 class MessageQueue(models.Model):
@@ -196,16 +285,28 @@ class MessageQueue(models.Model):
         PENDING = "P", "Pending"
         COMPLETED = "C", "Completed"
         ERROR = "E", "Error"
+        # Cancelled by a later message of the same feeder and alert, or merged away, never sent
+        SUPERSEDED = "S", "Superseded"
+        # Gave up after PUSHOVER_MAX_ATTEMPTS transient failures
+        DEAD_LETTER = "D", "Dead letter"
 
     device_owner = models.ForeignKey(DeviceOwner, models.CASCADE, null=True)
     user = models.ForeignKey(User, models.CASCADE)
     status_code = models.CharField(max_length=1, choices=StatusCode.choices, default=StatusCode.PENDING)
+    # Alert rule name or "feeding", for digesting (app.pushover.digest). None for one-off notices.
+    kind = models.CharField(max_length=32, null=True, blank=True)
+    # Failed sends so far, the pending message is retried from next_attempt_at on
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=now)
     title = models.CharField(max_length=255, null=True)
     message = models.CharField(max_length=255, null=True)
     priority = models.IntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [models.Index(fields=["status_code", "next_attempt_at"], name="message_queue_status_due")]
+
 
 class NotificationSettings(models.Model):
     user = models.ForeignKey(User, models.CASCADE)
@@ -280,6 +381,64 @@ class NotificationAlertTracking(models.Model):
     low_battery_alert = models.BooleanField(default=False)
 
 
+class TelemetrySample(models.Model):
+    """
+    Raw battery and hopper telemetry point, stored as scaled integers (see app.timeseries)
+    """
+
+    device = models.ForeignKey(Device, models.CASCADE, db_index=False)
+    ts = models.PositiveIntegerField()
+    battery_voltage = models.SmallIntegerField(null=True)
+    battery_soc = models.SmallIntegerField(null=True)
+    battery_crate = models.SmallIntegerField(null=True)
+    hopper_level = models.SmallIntegerField(null=True)
+    on_power = models.BooleanField(default=True)
+
+    class Meta:
+        db_table = "app_telemetry_sample"
+        indexes = [
+            models.Index(fields=["device", "ts"], name="telemetry_sample_device_ts"),
+            # Rollups and retention select by time across all devices
+            models.Index(fields=["ts", "device"], name="telemetry_sample_ts_device"),
+        ]
+
+
+class TelemetryRollup(models.Model):
+    """
+    Downsampled telemetry for one device over one bucket of a rollup tier
+    """
+
+    class Resolution(models.IntegerChoices):
+        MINUTE = 60, "1 minute"
+        HOUR = 3600, "1 hour"
+        DAY = 86400, "1 day"
+
+    device = models.ForeignKey(Device, models.CASCADE, db_index=False)
+    resolution = models.PositiveIntegerField(choices=Resolution.choices)
+    bucket = models.PositiveIntegerField()
+    samples = models.PositiveIntegerField(default=0)
+    on_power_samples = models.PositiveIntegerField(default=0)
+    battery_voltage_min = models.SmallIntegerField(null=True)
+    battery_voltage_avg = models.SmallIntegerField(null=True)
+    battery_voltage_max = models.SmallIntegerField(null=True)
+    battery_soc_min = models.SmallIntegerField(null=True)
+    battery_soc_avg = models.SmallIntegerField(null=True)
+    battery_soc_max = models.SmallIntegerField(null=True)
+    battery_crate_avg = models.SmallIntegerField(null=True)
+    hopper_level_min = models.SmallIntegerField(null=True)
+    hopper_level_avg = models.SmallIntegerField(null=True)
+    hopper_level_max = models.SmallIntegerField(null=True)
+
+    class Meta:
+        db_table = "app_telemetry_rollup"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["device", "resolution", "bucket"], name="telemetry_rollup_device_resolution_bucket"
+            ),
+        ]
+        indexes = [models.Index(fields=["resolution", "bucket"], name="telemetry_rollup_resolution")]
+
+
 # Automatically generate auth token by catching user's post_save signal
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
 def create_auth_token(sender, instance=None, created=False, **kwargs):
@@ -291,13 +450,61 @@ def create_auth_token(sender, instance=None, created=False, **kwargs):
 # Automatically add event to event queue by triggering post_save signal
 @receiver(post_save, sender=FeedingSchedule)
 def add_event_queue_feeding_schedule_save(sender, instance=None, created=False, **kwargs):
-    # eq = EventQueue.objects.filter(device_owner_id=instance.device_owner_id, event_code=300, status_code="P")
-    # if not len(eq):
-    log.info("in add_event_queue_feeding_schedule_save")
-    EventQueue.objects.get_or_create(device_owner_id=instance.device_owner_id, event_code=300, status_code="P")
-    status, is_created = DeviceStatus.objects.get_or_create(device_id=instance.device_id)
-    status.has_event = True
-    status.save()
+    from .device_events import device_events
+
+    device_events.add(instance.device_owner_id, 300, debounce=True)
+
+
+@receiver(pre_save, sender=FeedingSchedule)
+def remember_feeding_schedule_owner(sender, instance=None, **kwargs):
+    previous = None
+    if instance.id:
+        previous = FeedingSchedule.objects.filter(id=instance.id).values_list("device_owner_id", "device_id").first()
+    instance._previous_device_owner_id, instance._previous_device_id = previous or (None, None)
+
+
+@receiver(post_save, sender=FeedingSchedule)
+def version_feeding_schedule_save(sender, instance=None, created=False, **kwargs):
+    from .next_meal import rebuild_meal_indexes
+    from .schedule_sync import schedule_saved
+
+    schedule_saved(instance, created, getattr(instance, "_previous_device_owner_id", None))
+    device_ids = [instance.device_id, getattr(instance, "_previous_device_id", None)]
+    transaction.on_commit(lambda: rebuild_meal_indexes(device_ids))
+
+
+@receiver(post_delete, sender=FeedingSchedule)
+def version_feeding_schedule_delete(sender, instance=None, **kwargs):
+    from .next_meal import rebuild_meal_indexes
+    from .schedule_sync import schedules_removed
+
+    schedules_removed(instance.device_owner_id, [instance.id])
+    device_id = instance.device_id
+    transaction.on_commit(lambda: rebuild_meal_indexes([device_id]))
+
+
+@receiver(post_save, sender=Pet)
+def version_pet_feeding_schedules(sender, instance=None, created=False, **kwargs):
+    from .next_meal import rebuild_meal_indexes_of
+    from .schedule_sync import pet_changed
+
+    # The pet is nested in the schedule served to the feeders and named in the next meal
+    if not created:
+        pet_changed(instance.id)
+        pet_id = instance.id
+        transaction.on_commit(lambda: rebuild_meal_indexes_of(pet_id=pet_id))
+
+
+@receiver(post_save, sender=MotorTiming)
+def rebuild_motor_timing_meal_indexes(sender, instance=None, created=False, **kwargs):
+    from .next_meal import rebuild_meal_indexes_of
+    from .schedule_sync import motor_timing_changed
+
+    # Nested in the schedule served to the feeders, like the pet
+    if not created:
+        motor_timing_changed(instance.id)
+        motor_timing_id = instance.id
+        transaction.on_commit(lambda: rebuild_meal_indexes_of(motor_timing_id=motor_timing_id))
 
 
 # Cannot use this, it will cause problems when trying to remove a feeder (cyclic insertion, fk error)
@@ -315,51 +522,76 @@ def add_event_queue_feeding_schedule_save(sender, instance=None, created=False,
 
 @receiver(post_save, sender=Settings)
 def add_event_queue2(sender, instance=None, created=False, **kwargs):
-    devices = DeviceOwner.objects.filter(user_id=instance.user_id)
-    for device in devices:
-        EventQueue.objects.get_or_create(device_owner_id=device.id, event_code=400, status_code="P")
-        status, is_created = DeviceStatus.objects.get_or_create(device_id=device.device_id)
-        status.has_event = True
-        status.save()
+    from .device_events import device_events
+
+    for device_owner_id in DeviceOwner.objects.filter(user_id=instance.user_id).values_list("id", flat=True):
+        device_events.add(device_owner_id, 400)
 
 
 @receiver(post_save, sender=DeviceOwner)
 def add_event_queue3(sender, instance=None, created=False, **kwargs):
-    EventQueue.objects.get_or_create(device_owner_id=instance.id, event_code=400, status_code="P")
+    from .device_cache import device_owner_cache
+    from .device_events import device_events
+    from .hopper import invalidate_feeder
+
+    device_owner_cache.invalidate(instance)
+    invalidate_feeder(instance.id)
     if created:
         NotificationAlertTracking.objects.create(device_owner_id=instance.id)
-    status, is_created = DeviceStatus.objects.get_or_create(device_id=instance.device_id)
-    status.has_event = True
-    status.save(update_fields=["has_event"])
+        DeviceStatus.objects.get_or_create(device_id=instance.device_id)
+    device_events.add(instance.id, 400)
+
+
+@receiver(post_delete, sender=DeviceOwner)
+def invalidate_device_owner_cache(sender, instance=None, **kwargs):
+    from .device_cache import device_owner_cache
+    from .hopper import invalidate_feeder
+
+    device_owner_cache.invalidate(instance)
+    invalidate_feeder(instance.id)
+    FeedingScheduleRemoval.objects.filter(device_owner_id=instance.id).delete()
+
+
+# Wake the feeder's long-polling request once the pending event is committed
+@receiver(post_save, sender=EventQueue)
+def publish_event_queue(sender, instance=None, created=False, **kwargs):
+    from .event_channel import publish_event
+
+    if instance.status_code == "P":
+        transaction.on_commit(lambda: publish_event(instance.device_owner_id))
+
+
+@receiver(post_save, sender=FeederModel)
+def invalidate_feeder_model_capacity(sender, instance=None, created=False, **kwargs):
+    from .hopper import invalidate_feeder_model
+
+    if not created:
+        invalidate_feeder_model(instance.id)
 
 
 @receiver(post_save, sender=FeedingLog)
 def add_event_queue4(sender, instance=None, created=False, **kwargs):
+    from .feeding_log import FEEDING, feed_message, rollup_feedings
+    from .hopper import dispense, get_feeder
+
+    device = get_feeder(instance.device_owner_id)
+    if device is None:
+        log.warning("Device owner %s not found", instance.device_owner_id)
+        return
+    if created:
+        dispense(device["device_id"], device["hopper_capacity"], instance.feed_amt)
+        rollup_feedings(instance.device_owner_id, [instance], device["timezone"])
     try:
-        device = DeviceOwner.objects.get(id=instance.device_owner_id)
-        user_settings = NotificationSettings.objects.filter(user_id=device.user_id).first()
-        device_status = DeviceStatus.objects.get(device_id=device.device_id)
-        capacity = device.feeder_model.hopper_capacity
-        amount = (device_status.hopper_level * capacity) / 100
-        new_amount = amount - instance.feed_amt
-        device_status.hopper_level = (new_amount / capacity) * 100
-        device_status.save()
-        if user_settings.pushover_user_key != "" and (user_settings.manual_food or user_settings.auto_food):
-            message = ""
-            if instance.feed_type == "R" and user_settings.manual_food:
-                message = "%s cup was manually dispensed from a remote computer or mobile device." % (
-                    Fraction(instance.feed_amt)
-                )
-            elif instance.feed_type == "M" and user_settings.manual_food:
-                message = "%s cup was manually dispensed from the feeder." % (Fraction(instance.feed_amt))
-            elif user_settings.auto_food:
-                message = "%s cup was automatically dispensed for %s." % (
-                    Fraction(instance.feed_amt),
-                    instance.pet_name,
-                )
-            if message != "":
-                MessageQueue(
-                    device_owner_id=instance.device_owner_id, user_id=device.user_id, title=device.name, message=message
-                ).save()
+        user_settings = NotificationSettings.objects.get(user_id=device["user_id"])
     except ObjectDoesNotExist as e:
         log.warning("Object not found: %r", e)
+        return
+    message = feed_message(user_settings, instance.feed_type, instance.feed_amt, instance.pet_name)
+    if message != "":
+        MessageQueue(
+            device_owner_id=instance.device_owner_id,
+            user_id=device["user_id"],
+            title=device["name"],
+            message=message,
+            kind=FEEDING,
+        ).save()
@@ -0,0 +1,213 @@
+import logging
+from bisect import bisect_left
+from datetime import timedelta
+
+import numpy as np
+import pytz
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.utils import timezone
+
+from .models import FeedingSchedule
+
+log = logging.getLogger(__name__)
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+
+def minute_of_week(dt):
+    """
+    Minute of the week of a datetime, counted from Sunday 00:00 like the FeedingSchedule.dow bits
+    """
+    return (dt.isoweekday() % 7) * MINUTES_PER_DAY + dt.hour * 60 + dt.minute
+
+
+class MealIndex:
+    """
+    Active meals of a device sorted by the UTC minute of the week they are served at, one entry per
+    scheduled day
+    """
+
+    def __init__(self, entries=()):
+        entries = sorted(entries, key=lambda entry: (entry[0], entry[1]["id"]))
+        self.minutes = [minute for minute, meal in entries]
+        self.meals = [meal for minute, meal in entries]
+
+    def __len__(self):
+        return len(self.minutes)
+
+    def next_meal(self, minute):
+        """
+        Next meal at or after a minute of the week, wrapping around to next week.
+        Returns (minutes until the meal, meal) or None when nothing is scheduled.
+        """
+        if not self.minutes:
+            return None
+        i = bisect_left(self.minutes, minute)
+        if i == len(self.minutes):
+            i = 0
+        return (self.minutes[i] - minute) % MINUTES_PER_WEEK, self.meals[i]
+
+
+def build_meal_indexes(device_ids):
+    """
+    Meal indexes of the devices, from a single query
+    """
+    entries = {device_id: [] for device_id in device_ids}
+    schedules = (
+        FeedingSchedule.objects.filter(device_id__in=list(entries), active_flag=True)
+        .values_list(
+            "device_id",
+            "id",
+            "meal_name",
+            "dow",
+            "time",
+            "pet__name",
+            "motor_timing__feed_amount",
+            "motor_timing__motor_duration",
+            "motor_timing__interrupter_count",
+        )
+        .order_by()
+    )
+    for row in schedules:
+        device_id, schedule_id, meal_name, dow, time, pet_name, feed_amount, motor_duration, interrupter_count = row
+        meal = {
+            "id": schedule_id,
+            "meal_name": meal_name,
+            "time": time,
+            "pet_name": pet_name,
+            "feed_amount": feed_amount,
+            "motor_duration": motor_duration,
+            "interrupter_count": interrupter_count,
+        }
+        minute = time.hour * 60 + time.minute
+        for day in range(7):
+            if dow & (1 << day):
+                entries[device_id].append((day * MINUTES_PER_DAY + minute, meal))
+
+    return {device_id: MealIndex(device_entries) for device_id, device_entries in entries.items()}
+
+
+def _cache_key(device_id):
+    return "next-meal:%d" % device_id
+
+
+def _shared_cache():
+    # A per-process cache is not rebuilt in the other workers when a schedule changes
+    cache = caches["default"]
+    return None if isinstance(cache, LocMemCache) else cache
+
+
+def _cache_indexes(indexes):
+    shared = _shared_cache()
+    if shared is None:
+        return
+    shared.set_many(
+        {_cache_key(device_id): index for device_id, index in indexes.items()}, settings.NEXT_MEAL_CACHE_TIMEOUT
+    )
+
+
+def get_meal_indexes(device_ids):
+    """
+    Meal indexes of the devices from the cache, the missing ones are built together and cached.
+    Without a shared cache every index is built from the schedules.
+    """
+    device_ids = list(dict.fromkeys(device_ids))
+    shared = _shared_cache()
+    cached = shared.get_many([_cache_key(device_id) for device_id in device_ids]) if shared is not None else {}
+    indexes = {}
+    missing = []
+    for device_id in device_ids:
+        index = cached.get(_cache_key(device_id))
+        if index is None:
+            missing.append(device_id)
+        else:
+            indexes[device_id] = index
+
+    if missing:
+        built = build_meal_indexes(missing)
+        _cache_indexes(built)
+        indexes.update(built)
+    return indexes
+
+
+def rebuild_meal_indexes(device_ids):
+    device_ids = [device_id for device_id in dict.fromkeys(device_ids) if device_id is not None]
+    if not device_ids or _shared_cache() is None:
+        return
+    _cache_indexes(build_meal_indexes(device_ids))
+    log.debug("Rebuilt next meal index of devices %s", device_ids)
+
+
+def rebuild_meal_indexes_of(**schedule_filter):
+    """
+    Rebuild the meal indexes of the devices that have a schedule matching the filter, e.g. pet_id=1
+    """
+    device_ids = FeedingSchedule.objects.filter(**schedule_filter).values_list("device_id", flat=True).distinct()
+    rebuild_meal_indexes(list(device_ids))
+
+
+class FleetNextMeals:
+    """
+    Next meal of many devices as parallel NumPy arrays, sorted by device id
+    """
+
+    def __init__(self, device_ids, schedule_ids, minutes, now):
+        self.device_ids = device_ids
+        self.schedule_ids = schedule_ids
+        self.minutes = minutes
+        self.now = now.replace(second=0, microsecond=0)
+
+    def __len__(self):
+        return len(self.device_ids)
+
+    def as_dict(self):
+        """
+        {device_id: (feed datetime, schedule id)}
+        """
+        return {
+            device_id: (self.now + timedelta(minutes=minutes), schedule_id)
+            for device_id, schedule_id, minutes in zip(
+                self.device_ids.tolist(), self.schedule_ids.tolist(), self.minutes.tolist()
+            )
+        }
+
+    def feeds_per_minute(self, horizon=MINUTES_PER_DAY):
+        """
+        Number of devices feeding in each of the next horizon minutes, to anticipate load spikes
+        """
+        return np.bincount(self.minutes[self.minutes < horizon], minlength=horizon)
+
+
+def fleet_next_meals(device_ids=None, now=None):
+    """
+    Next meal of every device, or of the given devices, from a single query.
+
+    The active schedules are expanded into a (schedules x weekdays) array of minutes until each scheduled
+    feed, unscheduled days are masked out and the soonest entry of each device is picked with one sort.
+    """
+    now = (now or timezone.now()).astimezone(pytz.utc)
+    schedules = FeedingSchedule.objects.filter(active_flag=True, dow__gt=0)
+    if device_ids is not None:
+        schedules = schedules.filter(device_id__in=list(device_ids))
+    rows = list(schedules.values_list("device_id", "id", "dow", "time").order_by())
+
+    count = len(rows)
+    device = np.fromiter((row[0] for row in rows), dtype=np.int64, count=count)
+    schedule = np.fromiter((row[1] for row in rows), dtype=np.int64, count=count)
+    dow = np.fromiter((row[2] for row in rows), dtype=np.int64, count=count)
+    minute_of_day = np.fromiter((row[3].hour * 60 + row[3].minute for row in rows), dtype=np.int64, count=count)
+
+    days = np.arange(7)
+    scheduled = (dow[:, None] >> days) & 1 == 1
+    minutes = (days * MINUTES_PER_DAY + minute_of_day[:, None] - minute_of_week(now)) % MINUTES_PER_WEEK
+    minutes = np.where(scheduled, minutes, MINUTES_PER_WEEK).min(axis=1)
+
+    # Soonest schedule of each device, ties go to the lowest schedule id
+    order = np.lexsort((schedule, minutes, device))
+    device = device[order]
+    first = np.ones(count, dtype=bool)
+    first[1:] = device[1:] != device[:-1]
+    return FleetNextMeals(device[first], schedule[order][first], minutes[order][first], now)
@@ -1,66 +1,178 @@
-import time
+import asyncio
+import json
+import threading
+import weakref
 
-import requests
+import aiohttp
 from django.conf import settings
 
 
-class Pushover:
-    def __init__(self, api_key=None, base_url=None):
+class BasePushover:
+    """
+    Settings and request payloads shared by the sync and the asyncio client. A bucket
+    (app.pushover.ratelimit.TokenBucket) paces every request of the clients and threads it is shared with.
+    """
+
+    def __init__(self, api_key=None, base_url=None, pool_size=1, timeout=None, bucket=None):
         if settings.PUSHOVER_API_KEY:
             self.api_key = api_key if api_key else settings.PUSHOVER_API_KEY
         else:
             raise ValueError("PUSHOVER_API_KEY is not set")
 
-        self.base_url = base_url if base_url else "https://api.pushover.net"
-        self.last_sent = 0
-        self.session = requests.session()
+        self.base_url = base_url if base_url else settings.PUSHOVER_API_URL
+        self.timeout = timeout if timeout is not None else settings.PUSHOVER_TIMEOUT
+        self.pool_size = pool_size
+        self.bucket = bucket
 
-    def send_message(self, user_key, device, title, message, priority):
-        url = "%s/1/messages.json" % self.base_url
-
-        if user_key and device:
-            post_content = {
-                "token": self.api_key,
-                "user": user_key,
-                "device": device,
-                "title": title if title else "Untitled",
-                "message": message,
-                "priority": priority,
-            }
-        else:
+    def message_payload(self, user_key, device, title, message, priority):
+        if not (user_key and device):
             raise ValueError("user_key and device are required.")
-
-        current_time = int(time.time())
-
-        if self.last_sent != 0 and current_time < self.last_sent:
-            wait_time = 2 - (current_time - self.last_sent)
-            print("Friendly API protocol: waiting %d seconds\n" % wait_time)
-            time.sleep(wait_time)
-
-        r = self.session.request("POST", url, data=post_content)
-        self.last_sent = int(time.time())
-
-        return r
-
-    def validate_user(self, user_key):
-        url = "%s/1/users/validate.json" % self.base_url
-
-        if user_key:
-            post_content = {
-                "token": self.api_key,
-                "user": user_key,
-            }
-        else:
+        return {
+            "token": self.api_key,
+            "user": user_key,
+            "device": device,
+            "title": title if title else "Untitled",
+            "message": message,
+            "priority": priority,
+        }
+
+    def validate_payload(self, user_key):
+        if not user_key:
             raise ValueError("user_key is required.")
+        return {
+            "token": self.api_key,
+            "user": user_key,
+        }
+
+
+def _run_loop(loop):
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+    loop.close()
+
+
+def _shutdown(loop, client):
+    future = asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+    future.add_done_callback(lambda future: loop.call_soon_threadsafe(loop.stop))
+    return future
+
+
+class Pushover(BasePushover):
+    """
+    Sync client over AsyncPushover. The requests of every thread using it run on one event loop in a
+    background thread, started on the first request, and share its pool of pool_size keep-alive connections.
+    Requests fail with the errors of AsyncPushover (aiohttp.ClientError, asyncio.TimeoutError). Close it
+    with close() or use the client as a context manager.
+    """
+
+    def __init__(self, api_key=None, base_url=None, pool_size=None, timeout=None, bucket=None):
+        super().__init__(api_key, base_url, pool_size or settings.PUSHOVER_CONCURRENCY, timeout, bucket)
+        self.client = AsyncPushover(self.api_key, self.base_url, self.pool_size, self.timeout, self.bucket)
+        self.loop = None
+        self.lock = threading.Lock()
+        self._finalizer = None
+
+    def run(self, coroutine):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=_run_loop, args=(self.loop,), name="pushover", daemon=True).start()
+                # The loop and its connections are released with the client if it is not closed
+                self._finalizer = weakref.finalize(self, _shutdown, self.loop, self.client)
+            loop = self.loop
+        return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
 
-        current_time = int(time.time())
-
-        if self.last_sent != 0 and current_time < self.last_sent:
-            wait_time = 2 - (current_time - self.last_sent)
-            print("Friendly API protocol: waiting %d seconds\n" % wait_time)
-            time.sleep(wait_time)
-
-        r = self.session.request("POST", url, data=post_content)
-        self.last_sent = int(time.time())
+    def send_message(self, user_key, device, title, message, priority):
+        return self.run(self.client.send_message(user_key, device, title, message, priority))
 
-        return r
+    def validate_user(self, user_key):
+        return self.run(self.client.validate_user(user_key))
+
+    def send_many(self, messages, concurrency=None):
+        """
+        Send (user_key, device, title, message, priority) tuples with AsyncPushover.send_many, from code not
+        running in an event loop
+        """
+        return self.run(self.client.send_many(messages, concurrency))
+
+    def close(self):
+        with self.lock:
+            if self.loop is not None:
+                self._finalizer().result()
+                self.loop = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AsyncResponse:
+    """
+    Status, headers and body of a response read in full, named as in requests.Response
+    """
+
+    def __init__(self, status_code, reason, headers, text):
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AsyncPushover(BasePushover):
+    """
+    Pushover client for asyncio. The tasks of one event loop share its pool of pool_size keep-alive
+    connections, opened on the first request. Close it with aclose() or use the client as an async context
+    manager.
+    """
+
+    def __init__(self, api_key=None, base_url=None, pool_size=None, timeout=None, bucket=None):
+        super().__init__(api_key, base_url, pool_size or settings.PUSHOVER_CONCURRENCY, timeout, bucket)
+        self.session = None
+
+    async def post(self, path, data):
+        if self.session is None:
+            # aiohttp binds the session to the running loop, it cannot be created in __init__
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        if self.bucket is not None:
+            await self.bucket.acquire_async()
+        async with self.session.post(self.base_url + path, data=data) as r:
+            return AsyncResponse(r.status, r.reason, r.headers, await r.text())
+
+    async def send_message(self, user_key, device, title, message, priority):
+        return await self.post("/1/messages.json", self.message_payload(user_key, device, title, message, priority))
+
+    async def validate_user(self, user_key):
+        return await self.post("/1/users/validate.json", self.validate_payload(user_key))
+
+    async def send_many(self, messages, concurrency=None):
+        """
+        Send (user_key, device, title, message, priority) tuples, at most concurrency (the pool size) at a
+        time. Returns the responses in the order of the messages, or the exception a message failed with
+        (aiohttp.ClientError, asyncio.TimeoutError, ...).
+        """
+        semaphore = asyncio.Semaphore(concurrency or self.pool_size)
+
+        async def send(message):
+            async with semaphore:
+                return await self.send_message(*message)
+
+        return await asyncio.gather(*(send(message) for message in messages), return_exceptions=True)
+
+    async def aclose(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
@@ -0,0 +1,98 @@
+from ..alerts import RULES
+
+DIGEST_TITLE = "Smart Pet Feeder"
+# Longest message accepted by the Pushover API
+MAX_MESSAGE_LENGTH = 1024
+
+RULES_BY_NAME = {rule.name: rule for rule in RULES if rule.message is not None}
+
+
+class Digest:
+    """
+    Pending messages of one user merged into one notification, and the messages cancelled by later ones
+    """
+
+    def __init__(self, user_id, messages, superseded):
+        self.user_id = user_id
+        self.messages = messages
+        self.superseded = superseded
+
+    @property
+    def title(self):
+        if len(self.messages) == 1:
+            return self.messages[0].title
+        return DIGEST_TITLE
+
+    @property
+    def message(self):
+        if len(self.messages) == 1:
+            return self.messages[0].message
+        text = "\n".join(summarize(self.messages))
+        if len(text) > MAX_MESSAGE_LENGTH:
+            text = text[: MAX_MESSAGE_LENGTH - 1] + "…"
+        return text
+
+    @property
+    def priority(self):
+        return max(message.priority for message in self.messages)
+
+
+def supersede(messages):
+    """
+    Split the messages of one user, oldest first, into the ones still to send and the superseded ones.
+
+    The alerts of one feeder that toggle the same flag (offline and back online, power lost and restored,
+    ...) form a chain. When the chain ends in the state it started from, e.g. offline followed by back
+    online, all its messages cancel out, otherwise only the last one is sent.
+    """
+    chains = {}
+    for message in messages:
+        rule = RULES_BY_NAME.get(message.kind)
+        if rule is not None and message.device_owner_id is not None:
+            chains.setdefault((message.device_owner_id, rule.flag), []).append(message)
+
+    superseded = set()
+    for chain in chains.values():
+        # A rule only fires when its flag differs from its value, so the chain started from the opposite
+        started_from = not RULES_BY_NAME[chain[0].kind].value
+        if RULES_BY_NAME[chain[-1].kind].value == started_from:
+            superseded.update(message.id for message in chain)
+        else:
+            superseded.update(message.id for message in chain[:-1])
+
+    return (
+        [message for message in messages if message.id not in superseded],
+        [message for message in messages if message.id in superseded],
+    )
+
+
+def summarize(messages):
+    """
+    Lines of a digest: the alerts of the same kind from several feeders share a summary line, the other
+    messages are listed with the name of their feeder
+    """
+    by_kind = {}
+    for message in messages:
+        by_kind.setdefault(message.kind, []).append(message)
+
+    lines = []
+    for kind, group in by_kind.items():
+        rule = RULES_BY_NAME.get(kind)
+        names = list(dict.fromkeys(message.title for message in group))
+        if rule is not None and rule.summary is not None and len(names) > 1 and len(names) == len(group):
+            lines.append(rule.summary.format(count=len(names), names=", ".join(names)))
+        else:
+            lines.extend(
+                "%s: %s" % (message.title, message.message) if message.title else message.message for message in group
+            )
+    return lines
+
+
+def digest_messages(messages):
+    """
+    Digests of the pending messages, one per user, the messages ordered oldest first
+    """
+    by_user = {}
+    for message in messages:
+        by_user.setdefault(message.user_id, []).append(message)
+    return [Digest(user_id, *supersede(user_messages)) for user_id, user_messages in by_user.items()]
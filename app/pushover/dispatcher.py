@@ -0,0 +1,246 @@
+import asyncio
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import aiohttp
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Case, F, Min, Value, When
+from django.utils import timezone
+
+from ..models import MessageQueue, NotificationSettings
+from .client import Pushover
+from .digest import digest_messages
+from .ratelimit import SharedTokenBucket
+
+log = logging.getLogger(__name__)
+
+# Seconds the sending stops after a 429 without a usable X-Limit-App-Reset header
+RATE_LIMITED_PAUSE = 60
+# End of the current pause as a timestamp, shared with the dispatchers of the other tasks and workers
+PAUSED_UNTIL_KEY = "pushover:paused-until"
+# Tokens of the rate shared by the dispatchers of every task and worker
+RATE_KEY = "pushover:rate"
+
+SENT = MessageQueue.StatusCode.COMPLETED
+FAILED = MessageQueue.StatusCode.ERROR
+# Left pending for a later batch
+RETRY = MessageQueue.StatusCode.PENDING
+SUPERSEDED = MessageQueue.StatusCode.SUPERSEDED
+DEAD_LETTER = MessageQueue.StatusCode.DEAD_LETTER
+# Transient failure (5xx, no connection), left pending until the backoff has passed
+DEFERRED = "deferred"
+
+
+def backoff(attempts, retry_after=None):
+    """
+    Seconds before the next attempt of a message that failed attempts times: exponential from
+    PUSHOVER_RETRY_BACKOFF up to PUSHOVER_RETRY_BACKOFF_MAX, jittered down to half so the messages failed
+    together are not retried together, and no earlier than the Retry-After of the response
+    """
+    delay = min(settings.PUSHOVER_RETRY_BACKOFF * 2 ** (attempts - 1), settings.PUSHOVER_RETRY_BACKOFF_MAX)
+    return max(random.uniform(delay / 2, delay), retry_after or 0)
+
+
+def get_retry_after(response):
+    try:
+        return max(int(response.headers["Retry-After"]), 0)
+    except (KeyError, ValueError):
+        return None
+
+
+class PushoverDispatcher:
+    """
+    Sends the pending MessageQueue rows to Pushover.
+
+    The pending messages of a user are held until the oldest has waited the digest window, then merged
+    into one notification (app.pushover.digest). A batch of users is claimed with SELECT ... FOR UPDATE
+    SKIP LOCKED (where the database supports it) and leased to the dispatcher by moving the next attempt
+    of its messages PUSHOVER_CLAIM_TIMEOUT ahead, so concurrent dispatchers, e.g. the beat task and a
+    per-user task, never send the same message twice. The claim is committed before the digests are sent
+    and the statuses are written in a second short transaction, no lock is held during the HTTP calls.
+    The notification settings of the batch are read with one query and the digests are sent by a thread
+    pool over one pooled HTTP client, paced by a token bucket shared through the cache by every worker.
+
+    Only the messages due (next_attempt_at) are claimed. A transient failure delays the messages of the
+    digest by an exponential backoff, after PUSHOVER_MAX_ATTEMPTS they are moved to the dead letter status.
+    A rejected message (4xx) fails at once.
+    """
+
+    def __init__(self, pushover=None, bucket=None, batch_size=None, concurrency=None):
+        self.batch_size = batch_size or settings.PUSHOVER_BATCH_SIZE
+        self.concurrency = concurrency or settings.PUSHOVER_CONCURRENCY
+        self.pushover = pushover or Pushover(pool_size=self.concurrency)
+        self.bucket = bucket or SharedTokenBucket(settings.PUSHOVER_RATE, settings.PUSHOVER_BURST, key=RATE_KEY)
+
+    def run(self, user_id=None, max_seconds=None, window=None):
+        """
+        Send batches until no message is due or max_seconds have passed, returns {status: messages}
+        """
+        max_seconds = max_seconds if max_seconds is not None else settings.PUSHOVER_DISPATCH_MAX_SECONDS
+        window = window if window is not None else settings.PUSHOVER_DIGEST_WINDOW
+        deadline = time.monotonic() + max_seconds
+        totals = {SENT: 0, FAILED: 0, RETRY: 0, SUPERSEDED: 0, DEAD_LETTER: 0}
+        paused = cache.get(PAUSED_UNTIL_KEY, 0) - time.time()
+        if paused > 0:
+            if paused >= max_seconds:
+                log.info("Pushover rate limited for %ds, nothing sent", paused)
+                return totals
+            self.bucket.pause(paused)
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="pushover") as executor:
+            while time.monotonic() < deadline:
+                cutoff = timezone.now() - timedelta(seconds=window) if window else None
+                counts = self.dispatch_batch(executor, user_id, deadline, cutoff)
+                for status, count in counts.items():
+                    totals[status] += count
+                # Stop on an empty batch, or when rate limited past the batch
+                if not counts or self.bucket.paused_for() > 0:
+                    break
+        return totals
+
+    def claim(self, user_id=None, cutoff=None):
+        """
+        Lock the due messages of the batch_size users waiting longest, whose oldest due message was queued
+        before cutoff
+        """
+        pending = MessageQueue.objects.filter(
+            status_code=MessageQueue.StatusCode.PENDING, next_attempt_at__lte=timezone.now()
+        )
+        if user_id is not None:
+            pending = pending.filter(user_id=user_id)
+        # MySQL does not support LIMIT in an IN subquery, the users are read first
+        users = pending.values("user_id").annotate(oldest=Min("created_at"))
+        if cutoff is not None:
+            users = users.filter(oldest__lte=cutoff)
+        user_ids = [row["user_id"] for row in users.order_by("oldest", "user_id")[: self.batch_size]]
+        if not user_ids:
+            return []
+        skip_locked = connection.features.has_select_for_update_skip_locked
+        messages = pending.filter(user_id__in=user_ids).select_for_update(skip_locked=skip_locked)
+        return list(messages.order_by("created_at", "id"))
+
+    def dispatch_batch(self, executor, user_id=None, deadline=None, cutoff=None):
+        with transaction.atomic():
+            messages = self.claim(user_id, cutoff)
+            if not messages:
+                return {}
+            # Leased until the statuses are written, or sent again by a later dispatch if this one dies
+            lease = timezone.now() + timedelta(seconds=settings.PUSHOVER_CLAIM_TIMEOUT)
+            MessageQueue.objects.filter(id__in=[message.id for message in messages]).update(next_attempt_at=lease)
+            notification_settings = {
+                row.user_id: row
+                for row in NotificationSettings.objects.filter(
+                    user_id__in={message.user_id for message in messages}
+                ).order_by("id")
+            }
+
+        digests = digest_messages(messages)
+        results = {SUPERSEDED: [message.id for digest in digests for message in digest.superseded]}
+        digests = [digest for digest in digests if digest.messages]
+        outcomes = executor.map(
+            lambda digest: self.send(digest, notification_settings.get(digest.user_id), deadline), digests
+        )
+        deferred = []
+        for digest, (status, retry_after) in zip(digests, outcomes):
+            if status == DEFERRED:
+                deferred.append((digest, retry_after))
+            else:
+                results.setdefault(status, []).extend(message.id for message in digest.messages)
+
+        with transaction.atomic():
+            now = timezone.now()
+            for status in (SENT, FAILED, SUPERSEDED):
+                if results.get(status):
+                    MessageQueue.objects.filter(id__in=results[status]).update(status_code=status, updated_at=now)
+            if results.get(RETRY):
+                # Not attempted, due again at once
+                MessageQueue.objects.filter(id__in=results[RETRY]).update(next_attempt_at=now, updated_at=now)
+            if deferred:
+                retried, results[DEAD_LETTER] = self.defer(deferred, now)
+                results.setdefault(RETRY, []).extend(retried)
+        return {status: len(results.get(status, [])) for status in (SENT, FAILED, RETRY, SUPERSEDED, DEAD_LETTER)}
+
+    def defer(self, deferred, now):
+        """
+        Count the failed attempt of the deferred digests, with one UPDATE for the retried messages and one
+        for the dead letters. The messages of a digest are retried together. Returns their ids.
+        """
+        retried, dead = [], []
+        whens = []
+        for digest, retry_after in deferred:
+            ids = [message.id for message in digest.messages]
+            attempts = max(message.attempts for message in digest.messages) + 1
+            if attempts >= settings.PUSHOVER_MAX_ATTEMPTS:
+                log.warning("Notification for user_id %s not sent after %d attempts.", digest.user_id, attempts)
+                dead.extend(ids)
+            else:
+                next_attempt_at = now + timedelta(seconds=backoff(attempts, retry_after))
+                whens.append(When(id__in=ids, then=Value(next_attempt_at)))
+                retried.extend(ids)
+
+        if retried:
+            MessageQueue.objects.filter(id__in=retried).update(
+                attempts=F("attempts") + 1,
+                next_attempt_at=Case(*whens, default=F("next_attempt_at")),
+                updated_at=now,
+            )
+        if dead:
+            MessageQueue.objects.filter(id__in=dead).update(
+                status_code=DEAD_LETTER, attempts=F("attempts") + 1, updated_at=now
+            )
+        return retried, dead
+
+    def send(self, message, user_settings, deadline=None):
+        """
+        Send a message or a digest, returns the status of its messages and the Retry-After of the response
+        """
+        if user_settings is None:
+            log.warning("Notification for user_id %s not sent. No notification settings.", message.user_id)
+            return FAILED, None
+        if user_settings.pushover_user_key == "" or user_settings.pushover_devices == "":
+            log.info("Notification for user_id %s not sent. Pushover was not configured.", message.user_id)
+            return FAILED, None
+
+        timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+        if not self.bucket.acquire(timeout):
+            return RETRY, None
+        try:
+            r = self.pushover.send_message(
+                user_settings.pushover_user_key,
+                user_settings.pushover_devices,
+                message.title,
+                message.message,
+                message.priority,
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log.warning("Unable to reach Pushover: %r", e)
+            return DEFERRED, None
+
+        if r.headers.get("X-Limit-App-Remaining") == "0":
+            self.pause_until_reset(r)
+        if r.status_code == 429:
+            log.warning("Pushover rate limit reached, the pending messages are sent later")
+            self.pause_until_reset(r)
+            return RETRY, None
+        if r.status_code >= 500:
+            log.warning("Error returned from Pushover: %s - %s, retrying later", r.status_code, r.reason)
+            return DEFERRED, get_retry_after(r)
+        if r.status_code != 200:
+            log.warning("Error returned from Pushover: %s - %s", r.status_code, r.reason)
+            return FAILED, None
+        return SENT, None
+
+    def pause_until_reset(self, response):
+        pause = get_retry_after(response)
+        if pause is None:
+            try:
+                pause = int(response.headers["X-Limit-App-Reset"]) - time.time()
+            except (KeyError, ValueError):
+                pause = RATE_LIMITED_PAUSE
+        pause = max(pause, 1)
+        self.bucket.pause(pause)
+        cache.set(PAUSED_UNTIL_KEY, time.time() + pause, timeout=int(pause) + 1)
@@ -0,0 +1,109 @@
+import asyncio
+import threading
+import time
+
+from django.core.cache import cache as default_cache
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket: rate tokens per second, at most burst of them saved up. acquire() blocks until
+    a token is available, acquire_async() awaits it without blocking the event loop, so one bucket can pace
+    threads and asyncio tasks together. pause() holds every caller back, e.g. after the API answered 429.
+    """
+
+    def __init__(self, rate, burst=None, clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1)
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.burst
+        self.updated = clock()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """
+        Seconds until a token is available, taking it when it is available now
+        """
+        with self.lock:
+            now = self.clock()
+            if now < self.paused_until:
+                return self.paused_until - now
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self, timeout=None):
+        """
+        Take a token, waiting for it at most timeout seconds. Returns False when it timed out.
+        """
+        deadline = None if timeout is None else self.clock() + timeout
+        while True:
+            wait = self.wait_time()
+            if wait == 0:
+                return True
+            if deadline is not None and self.clock() + wait > deadline:
+                return False
+            self.sleep(wait)
+
+    async def acquire_async(self, timeout=None):
+        """
+        Take a token, awaiting it at most timeout seconds. Returns False when it timed out.
+        """
+        deadline = None if timeout is None else self.clock() + timeout
+        while True:
+            wait = self.wait_time()
+            if wait == 0:
+                return True
+            if deadline is not None and self.clock() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+
+    def paused_for(self):
+        with self.lock:
+            return max(self.paused_until - self.clock(), 0)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, self.clock() + seconds)
+            self.tokens = 0
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    Token bucket shared through the cache by the processes using the same key, e.g. the dispatchers of every
+    Celery worker. The tokens are counted per window of burst / rate seconds with the atomic cache.incr(), so
+    together they take at most burst tokens per window, the rate on average. The cache must be shared (Redis)
+    for the processes to share the rate, with a per-process cache (LocMemCache) each one gets the full rate.
+    """
+
+    def __init__(self, rate, burst=None, key="token-bucket", cache=None, clock=time.time, sleep=time.sleep):
+        super().__init__(rate, burst, clock, sleep)
+        self.key = key
+        self.cache = cache if cache is not None else default_cache
+        self.window = self.burst / self.rate
+
+    def wait_time(self):
+        now = self.clock()
+        with self.lock:
+            if now < self.paused_until:
+                return self.paused_until - now
+        window = int(now // self.window)
+        key = "%s:%d" % (self.key, window)
+        # Kept past the end of its window, an incr() on it never misses
+        if self.cache.add(key, 1, timeout=int(self.window) + 2):
+            taken = 1
+        else:
+            taken = self.cache.incr(key)
+        if taken <= self.burst:
+            return 0.0
+        return (window + 1) * self.window - now
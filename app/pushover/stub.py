@@ -0,0 +1,135 @@
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from .ratelimit import TokenBucket
+
+
+class PushoverStubHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so the pooled connections of the client are reused as with the real API
+    protocol_version = "HTTP/1.1"
+    # The headers and the body are written separately, without TCP_NODELAY the body waits for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        stub = self.server.stub
+        length = int(self.headers.get("Content-Length", 0))
+        form = {name: values[0] for name, values in parse_qs(self.rfile.read(length).decode()).items()}
+        if stub.latency:
+            time.sleep(stub.latency)
+
+        if self.path == "/1/messages.json":
+            status, body = stub.message(form)
+        elif self.path == "/1/users/validate.json":
+            status, body = stub.validate(form)
+        else:
+            status, body = 404, {"status": 0, "errors": ["not found"]}
+        self.respond(status, body)
+
+    def respond(self, status, body):
+        stub = self.server.stub
+        content = json.dumps(dict(body, request=uuid.uuid4().hex)).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        if status >= 500 and stub.retry_after is not None:
+            self.send_header("Retry-After", str(stub.retry_after))
+        self.send_header("X-Limit-App-Limit", str(stub.app_limit))
+        self.send_header("X-Limit-App-Remaining", str(max(stub.app_limit - stub.sent, 0)))
+        self.send_header("X-Limit-App-Reset", str(stub.reset_at))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PushoverStubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Room for a whole connection pool opening at once, the default backlog of 5 drops the connects
+    request_queue_size = 128
+
+
+class PushoverStub:
+    """
+    Local stand-in for the Pushover message API, for throughput tests of the dispatcher.
+
+    Messages are accepted after latency seconds, like a round trip to the real API. Above rate messages per
+    second, or once app_limit messages were accepted, the stub answers 429. The next fail_next messages, and
+    failure_rate of the others, are answered failure_status with a Retry-After of retry_after seconds. The
+    accepted messages are kept in messages.
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        latency=0.0,
+        rate=None,
+        app_limit=10000,
+        failure_rate=0.0,
+        fail_next=0,
+        failure_status=500,
+        retry_after=None,
+    ):
+        self.latency = latency
+        self.bucket = TokenBucket(rate) if rate else None
+        self.app_limit = app_limit
+        self.failure_rate = failure_rate
+        self.fail_next = fail_next
+        self.failure_status = failure_status
+        self.retry_after = retry_after
+        self.failed = 0
+        self.reset_at = int(time.time()) + 30 * 86400
+        self.messages = []
+        self.sent = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+        self.server = PushoverStubServer((host, port), PushoverStubHandler)
+        self.server.stub = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return "http://%s:%d" % (host, port)
+
+    def message(self, form):
+        missing = [name for name in ("token", "user", "message") if not form.get(name)]
+        if missing:
+            return 400, {"status": 0, "errors": ["%s is invalid" % name for name in missing]}
+        with self.lock:
+            if self.sent >= self.app_limit or (self.bucket and self.bucket.wait_time() > 0):
+                self.rejected += 1
+                return 429, {"status": 0, "errors": ["message limit reached"]}
+            if self.fail_next or (self.failure_rate and random.random() < self.failure_rate):
+                self.fail_next = max(self.fail_next - 1, 0)
+                self.failed += 1
+                return self.failure_status, {"status": 0, "errors": ["internal error"]}
+            self.sent += 1
+            self.messages.append(form)
+        return 200, {"status": 1}
+
+    def validate(self, form):
+        if not form.get("user"):
+            return 400, {"status": 0, "errors": ["user key is invalid"]}
+        return 200, {"status": 1, "devices": ["phone"]}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="pushover-stub", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,192 @@
+import logging
+
+from django.db import transaction
+from django.db.models import IntegerField, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from .models import DeviceOwner, FeedingSchedule, FeedingScheduleRemoval
+
+log = logging.getLogger(__name__)
+
+
+def _max_version(model):
+    return Coalesce(
+        Subquery(
+            model.objects.filter(device_owner_id=OuterRef("id"))
+            .order_by()
+            .values("device_owner_id")
+            .annotate(max_version=Max("version"))
+            .values("max_version")
+        ),
+        0,
+        output_field=IntegerField(),
+    )
+
+
+def schedule_version(device_owner_id):
+    """
+    Current schedule version of a device owner: the latest version of its schedule rows and removals
+    """
+    row = (
+        DeviceOwner.objects.filter(id=device_owner_id)
+        .annotate(rows_version=_max_version(FeedingSchedule), removals_version=_max_version(FeedingScheduleRemoval))
+        .values_list("rows_version", "removals_version")
+        .first()
+    )
+    return max(row) if row else 0
+
+
+def next_version(device_owner_id):
+    """
+    Lock the schedule of a device owner until the end of the transaction and return its next version.
+    Writers of the same schedule are serialized, so a version is never handed out twice and a reader
+    never sees a version before all the rows stamped with it are committed.
+    """
+    list(DeviceOwner.objects.select_for_update().filter(id=device_owner_id).values_list("id"))
+    return schedule_version(device_owner_id) + 1
+
+
+def schedules_removed(device_owner_id, schedule_ids):
+    with transaction.atomic():
+        version = next_version(device_owner_id)
+        FeedingScheduleRemoval.objects.bulk_create(
+            [
+                FeedingScheduleRemoval(device_owner_id=device_owner_id, schedule_id=schedule_id, version=version)
+                for schedule_id in schedule_ids
+            ]
+        )
+    return version
+
+
+def schedule_saved(schedule, created, previous_device_owner_id=None):
+    moved = previous_device_owner_id is not None and previous_device_owner_id != schedule.device_owner_id
+    with transaction.atomic():
+        if moved:
+            schedules_removed(previous_device_owner_id, [schedule.id])
+        version = next_version(schedule.device_owner_id)
+        updates = {"version": version}
+        if created or moved:
+            updates["created_version"] = version
+        FeedingSchedule.objects.filter(id=schedule.id).update(**updates)
+
+    for name, value in updates.items():
+        setattr(schedule, name, value)
+    return version
+
+
+def pet_changed(pet_id):
+    owner_ids = (
+        FeedingSchedule.objects.filter(pet_id=pet_id)
+        .order_by("device_owner_id")
+        .values_list("device_owner_id", flat=True)
+    )
+    for device_owner_id in list(dict.fromkeys(owner_ids)):
+        with transaction.atomic():
+            version = next_version(device_owner_id)
+            FeedingSchedule.objects.filter(device_owner_id=device_owner_id, pet_id=pet_id).update(version=version)
+
+
+def motor_timing_changed(motor_timing_id):
+    """
+    New schedule version for the device owners using a motor timing, nested in the schedule rows like the
+    pet: its schedule rows, and all the rows of the owners using it for manual feeds
+    """
+    owner_ids = set(
+        FeedingSchedule.objects.filter(motor_timing_id=motor_timing_id).values_list("device_owner_id", flat=True)
+    )
+    manual_owner_ids = set(
+        DeviceOwner.objects.filter(manual_motor_timing_id=motor_timing_id).values_list("id", flat=True)
+    )
+    for device_owner_id in sorted(owner_ids | manual_owner_ids):
+        with transaction.atomic():
+            version = next_version(device_owner_id)
+            rows = FeedingSchedule.objects.filter(device_owner_id=device_owner_id)
+            if device_owner_id not in manual_owner_ids:
+                rows = rows.filter(motor_timing_id=motor_timing_id)
+            rows.update(version=version)
+
+
+def rebase_schedules(user_id, timezone_name, posix_tz):
+    """
+    Move the feeding schedules of a user to a new timezone: the UTC times are recomputed from the
+    local times in one pass and written with bulk_update, bypassing the per-row save signals. Every
+    feeder of the user gets one settings (400) event and the feeders whose schedule changed one
+    schedule (300) event. Returns the number of re-based schedules.
+    """
+    from .next_meal import rebuild_meal_indexes
+    from .timezones import local_times_to_utc
+    from .utils import queue_events, update_settings
+
+    with transaction.atomic():
+        update_settings({"timezone": timezone_name, "tz_esp32": posix_tz}, user_id)
+        owner_ids = list(DeviceOwner.objects.filter(user_id=user_id).order_by("id").values_list("id", flat=True))
+        schedules = list(
+            FeedingSchedule.objects.filter(device_owner__user_id=user_id)
+            .only("id", "device_id", "device_owner_id", "time", "local_time", "version")
+            .order_by("id")
+        )
+        utc_times = local_times_to_utc([schedule.local_time for schedule in schedules], timezone_name)
+        changed = []
+        for schedule, utc_time in zip(schedules, utc_times):
+            if schedule.time != utc_time:
+                schedule.time = utc_time
+                changed.append(schedule)
+
+        versions = {}
+        for device_owner_id in sorted({schedule.device_owner_id for schedule in changed}):
+            versions[device_owner_id] = next_version(device_owner_id)
+        for schedule in changed:
+            schedule.version = versions[schedule.device_owner_id]
+        FeedingSchedule.objects.bulk_update(changed, ["time", "version"], batch_size=500)
+
+        queue_events(
+            [(device_owner_id, 400) for device_owner_id in owner_ids]
+            + [(device_owner_id, 300) for device_owner_id in versions]
+        )
+        device_ids = [schedule.device_id for schedule in changed]
+        transaction.on_commit(lambda: rebuild_meal_indexes(device_ids))
+
+    log.info(
+        "Re-based %d of %d feeding schedules of user %s to %s", len(changed), len(schedules), user_id, timezone_name
+    )
+    return len(changed)
+
+
+def schedule_diff(device_owner_id, since, version, serialize):
+    """
+    Schedule rows added, changed and removed since a version. A client without a version (or ahead of
+    the server, e.g. after a restore) gets a reset with all active rows as added.
+    """
+    if since <= 0 or since > version:
+        rows = FeedingSchedule.objects.filter(device_owner_id=device_owner_id, active_flag=True)
+        return {
+            "version": version,
+            "since": 0,
+            "reset": True,
+            "added": serialize(rows.select_related("pet", "motor_timing").order_by("local_time")),
+            "changed": [],
+            "removed": [],
+        }
+
+    rows = list(
+        FeedingSchedule.objects.filter(device_owner_id=device_owner_id, version__gt=since)
+        .select_related("pet", "motor_timing")
+        .order_by("local_time")
+    )
+    active = [row for row in rows if row.active_flag]
+    active_ids = {row.id for row in active}
+    removed = [row.id for row in rows if not row.active_flag]
+    removed += (
+        FeedingScheduleRemoval.objects.filter(device_owner_id=device_owner_id, version__gt=since)
+        .exclude(schedule_id__in=active_ids)
+        .order_by("version")
+        .values_list("schedule_id", flat=True)
+    )
+    return {
+        "version": version,
+        "since": since,
+        "reset": False,
+        "added": serialize([row for row in active if row.created_version > since]),
+        "changed": serialize([row for row in active if row.created_version <= since]),
+        "removed": list(dict.fromkeys(removed)),
+    }
@@ -1,124 +1,89 @@
 import datetime
-import time
 
 from celery.utils.log import get_logger
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.core.exceptions import ObjectDoesNotExist
 from django.utils import timezone
 
 from smart_petfeeder.celery import app
 
-from .models import (
-    DeviceOwner,
-    DeviceStatus,
-    MessageQueue,
-    NotificationAlertTracking,
-    NotificationSettings,
-)
-from .pushover.client import Pushover
+from .models import DeviceStatus
+from .alerts import OFFLINE, process_alerts
+from .device_context import load_device_contexts
+from .device_events import device_events
+from .feeding_log import archive_feeding_log, backfill_feeding_rollups
+from .hopper import reconcile_hopper_levels
+from .next_meal import fleet_next_meals
+from .pushover.dispatcher import PushoverDispatcher
+from .timeseries import enforce_retention, rollup_telemetry
 
 log = get_logger(__name__)
 
 
 @app.task(name="app.tasks.send_pushover_notification", soft_time_limit=300)
 def send_pushover_notification(user_id):
-    try:
-        settings = NotificationSettings.objects.get(user_id=user_id)
-    except ObjectDoesNotExist as e:
-        log.exception("Exception raised: %r", e)
-        return
-
-    messages = MessageQueue.objects.filter(user_id=user_id, status_code="P").order_by(
-        "created_at"
-    )
-
-    pushover = Pushover()
-
-    for message in messages:
-        r = pushover.send_message(
-            settings.pushover_user_key,
-            settings.pushover_devices,
-            message.title,
-            message.message,
-            0,
-        )
-        if r.status_code != 200:
-            log.warning(
-                "Error returned from Pushover: %s - %s", r.status_code, r.reason
-            )
-            message.status_code = "E"
-        else:
-            message.status_code = "C"
-        message.save()
-        time.sleep(0.5)
-
-    log.info("Sending pushover notification for user_id: %s", user_id)
+    # Sent right away, the user just changed their notification settings
+    counts = PushoverDispatcher().run(user_id=user_id, window=0)
+    log.info("Sent %d pushover notifications for user_id %s, %d failed", counts["C"], user_id, counts["E"])
 
 
 @app.task(name="app.tasks.check_pushover_message_queue", soft_time_limit=300)
 def check_pushover_message_queue():
-    pushover = Pushover()
-
-    messages = MessageQueue.objects.filter(status_code="P").order_by("created_at")[:5]
-
-    for message in messages:
-        try:
-            user = NotificationSettings.objects.get(user_id=message.user_id)
-            if user.pushover_user_key != "" and user.pushover_devices != "":
-                log.info("Sending pushover notification for user_id: %s", user.user_id)
-                r = pushover.send_message(
-                    user.pushover_user_key,
-                    user.pushover_devices,
-                    message.title,
-                    message.message,
-                    0,
-                )
-                if r.status_code != 200:
-                    log.warning(
-                        "Error returned from Pushover: %s - %s", r.status_code, r.reason
-                    )
-                    message.status_code = "E"
-                else:
-                    message.status_code = "C"
-            else:
-                log.info(
-                    "Notification for user_id %s not sent. Pushover was not configured."
-                    % user.user_id
-                )
-                message.status_code = "E"
-            message.save()
-            time.sleep(0.5)
-        except Exception as e:
-            log.warning("Exception error: %r", e)
+    counts = PushoverDispatcher().run()
+    log.info(
+        "Sent %d pushover notifications, %d failed, %d superseded, %d dead letters, %d left pending",
+        counts["C"],
+        counts["E"],
+        counts["S"],
+        counts["D"],
+        counts["P"],
+    )
 
 
 @app.task(name="app.tasks.check_offline_status", soft_time_limit=300)
 def check_offline_status():
-    devices = DeviceStatus.objects.filter(
-        last_ping__lt=timezone.now() - datetime.timedelta(minutes=5)
-    )
-    for device in devices:
-        try:
-            device_owner = DeviceOwner.objects.get(device_id=device.device_id)
-            notification_settings = NotificationSettings.objects.get(
-                user_id=device_owner.user_id
-            )
-            alert_tracking = NotificationAlertTracking.objects.get(
-                device_owner_id=device_owner.id
-            )
-            if (
-                notification_settings.feeder_offline
-                and not alert_tracking.offline_alert
-                and notification_settings.pushover_user_key != ""
-            ):
-                MessageQueue(
-                    device_owner_id=device_owner.id,
-                    user_id=device_owner.user_id,
-                    title=device_owner.name,
-                    message="Your feeder is currently offline, possibly lost an internet connection or it was powered off.",
-                ).save()
-                alert_tracking.offline_alert = True
-                alert_tracking.save()
-        except ObjectDoesNotExist as e:
-            log.info("record not found: %s" % e)
-    pass
+    # The devices are found from the last_ping index, not by joining every device owner to its status
+    offline = DeviceStatus.objects.filter(last_ping__lt=timezone.now() - datetime.timedelta(minutes=5))
+    contexts = load_device_contexts(device_id__in=offline.values("device_id"))
+    changes = process_alerts(contexts, OFFLINE)
+    log.info("Checked %d offline devices, %d new offline alerts", len(contexts), len(changes))
+
+
+@app.task(name="app.tasks.forecast_feed_load", soft_time_limit=300)
+def forecast_feed_load():
+    # Feeders of the whole fleet dispensing in each of the next minutes, to see the load spikes coming
+    feeds = fleet_next_meals().feeds_per_minute(settings.FEED_LOAD_FORECAST_MINUTES)
+    peak = int(feeds.argmax())
+    log.info("%d scheduled feeds in the next %d minutes", feeds.sum(), len(feeds))
+    if feeds[peak] >= settings.FEED_LOAD_WARNING:
+        log.warning("%d feeders are scheduled to dispense in %d minutes", feeds[peak], peak)
+    return feeds.tolist()
+
+
+@app.task(name="app.tasks.flush_device_events", soft_time_limit=60)
+def flush_device_events(tokens):
+    device_events.flush_debounced(tokens)
+
+
+@app.task(name="app.tasks.reconcile_hopper_levels", soft_time_limit=300)
+def reconcile_device_hopper_levels():
+    reconcile_hopper_levels()
+
+
+@app.task(name="app.tasks.archive_feeding_log", soft_time_limit=3600, time_limit=3900)
+def archive_old_feeding_log():
+    archived = archive_feeding_log()
+    log.info("Archived %d feeding log rows", archived)
+
+
+@app.task(name="app.tasks.backfill_feeding_rollups", soft_time_limit=3600, time_limit=3900)
+def rebuild_feeding_rollups(user_id=None):
+    written = backfill_feeding_rollups(user_id=user_id)
+    log.info("Rebuilt %d feeding rollups of user %s", written, user_id)
+
+
+@app.task(name="app.tasks.rollup_device_telemetry", soft_time_limit=300)
+def rollup_device_telemetry():
+    counts = rollup_telemetry()
+    deleted = enforce_retention()
+    log.info("Telemetry rollups: %s, expired: %s", counts, deleted)
@@ -0,0 +1,158 @@
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, connections
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
+
+from .models import DeviceStatus, TelemetrySample
+
+log = logging.getLogger(__name__)
+
+# Heartbeat fields that are buffered and coalesced instead of written on every ping.
+# last_ping goes last: MySQL evaluates the SET list left to right, so the CASE conditions on
+# last_ping must see the old value.
+TELEMETRY_FIELDS = ["battery_voltage", "battery_soc", "battery_crate", "on_power", "last_ping"]
+
+
+class TelemetryBuffer:
+    """
+    Coalesces heartbeat telemetry per device and writes it back to DeviceStatus in bulk.
+
+    Only the latest values of each device are kept (last write wins). A flush writes all pending
+    devices with one UPDATE per chunk, guarded by last_ping so an older buffer from another worker
+    never overwrites newer values.
+    """
+
+    def __init__(self, interval=None, chunk_size=None, clock=time.monotonic, background=True):
+        self.interval = interval if interval is not None else settings.TELEMETRY_COALESCE_INTERVAL
+        self.chunk_size = chunk_size if chunk_size is not None else settings.TELEMETRY_FLUSH_CHUNK_SIZE
+        self.clock = clock
+        self.background = background
+        self.pending = {}
+        self.samples = []
+        self.lock = threading.Lock()
+        self.flusher = None
+        self.last_flush = clock()
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def record(self, device_id, values):
+        with self.lock:
+            self.pending[device_id] = values
+        if self.background:
+            self.start_flusher()
+
+    def add_sample(self, sample):
+        with self.lock:
+            self.samples.append(sample)
+        if self.background:
+            self.start_flusher()
+
+    def touch(self, device_id):
+        """
+        Move the buffered last_ping of the device forward, returns False when nothing is buffered for it
+        """
+        with self.lock:
+            values = self.pending.get(device_id)
+            if values is not None:
+                values["last_ping"] = timezone.now()
+        return values is not None
+
+    def is_due(self):
+        return self.clock() - self.last_flush >= self.interval
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            samples, self.samples = self.samples, []
+            self.last_flush = self.clock()
+
+        if samples:
+            TelemetrySample.objects.bulk_create(samples, batch_size=self.chunk_size)
+
+        device_ids = list(pending)
+        rows = 0
+        for i in range(0, len(device_ids), self.chunk_size):
+            rows += write_telemetry(
+                {device_id: pending[device_id] for device_id in device_ids[i : i + self.chunk_size]}
+            )
+        return rows
+
+    def start_flusher(self):
+        if self.flusher is not None:
+            return
+        with self.lock:
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self.run_flusher, name="telemetry-flusher", daemon=True)
+                self.flusher.start()
+                atexit.register(self.flush)
+
+    def run_flusher(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                close_old_connections()
+                self.flush()
+            except Exception as e:
+                log.exception("Unable to flush device telemetry: %r", e)
+            finally:
+                connections.close_all()
+
+
+def write_telemetry(pending):
+    """
+    Write {device_id: {field: value}} to DeviceStatus in a single UPDATE statement
+    """
+    if not pending:
+        return 0
+
+    updates = {}
+    for name in TELEMETRY_FIELDS:
+        field = DeviceStatus._meta.get_field(name)
+        whens = [
+            When(device_id=device_id, last_ping__lte=values["last_ping"], then=Value(values[name], output_field=field))
+            for device_id, values in pending.items()
+            if name in values
+        ]
+        if whens:
+            updates[name] = Case(*whens, default=F(name), output_field=field)
+
+    return DeviceStatus.objects.filter(device_id__in=list(pending)).update(**updates)
+
+
+def save_heartbeat(device_status, changed_fields=()):
+    """
+    Persist a heartbeat. Telemetry is coalesced when TELEMETRY_COALESCE_INTERVAL is set, any other changed
+    field is written right away. Only the touched columns are written, never hopper_level or has_event.
+    """
+    if device_status.pk is None:
+        device_status.save()
+        return
+
+    if telemetry_buffer.enabled:
+        telemetry_buffer.record(
+            device_status.device_id, {name: getattr(device_status, name) for name in TELEMETRY_FIELDS}
+        )
+        update_fields = [name for name in changed_fields if name not in TELEMETRY_FIELDS]
+    else:
+        update_fields = list(dict.fromkeys([*changed_fields, "last_ping"]))
+
+    if update_fields:
+        device_status.save(update_fields=update_fields + ["updated_at"])
+
+
+def record_ping(device_id):
+    # Keep the buffered telemetry of the device, only move its last_ping forward
+    if telemetry_buffer.enabled and telemetry_buffer.touch(device_id):
+        return True
+
+    return DeviceStatus.objects.filter(device_id=device_id).update(last_ping=timezone.now()) > 0
+
+
+telemetry_buffer = TelemetryBuffer()
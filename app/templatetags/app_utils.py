@@ -1,5 +1,6 @@
 from django import template
 
+from app.timezones import utc_time_to_local
 from app.utils import xss_token
 
 register = template.Library()
@@ -13,3 +14,8 @@ def bitwise_and(value, arg):
 @register.filter
 def xss_tokenize(value, arg):
     return xss_token(arg, value)
+
+
+@register.filter
+def local_time(value, arg):
+    return utc_time_to_local(value, arg)
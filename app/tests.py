@@ -1,3 +1,1230 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import tempfile
+import time
+from unittest import mock
 
-# Create your tests here.
+import aiohttp
+import pytz
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import Client, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .alerts import HEARTBEAT, OFFLINE, evaluate, save_changes
+from .next_meal import MealIndex, fleet_next_meals, get_meal_indexes
+from .device_context import load_device_contexts
+from .device_events import device_events
+from .feeding_log import (
+    archive_feeding_log,
+    backfill_feeding_rollups,
+    feeding_consumption,
+    feeding_history,
+    record_feedings,
+)
+from .hopper import reconcile_hopper_levels, refill
+from .metrics import QueryRecorder, RequestMetrics, fingerprint, request_metrics
+from .models import (
+    ControlBoardModel,
+    Device,
+    DeviceOwner,
+    DeviceStatus,
+    EventQueue,
+    FeederModel,
+    FeedingLog,
+    FeedingLogArchive,
+    FeedingRollup,
+    FeedingSchedule,
+    FirmwareUpdate,
+    MessageQueue,
+    MotorTiming,
+    NotificationAlertTracking,
+    NotificationSettings,
+    Pet,
+    PosixTimezone,
+    Settings,
+    TelemetryRollup,
+    TelemetrySample,
+)
+from .pushover.client import AsyncPushover, Pushover
+from .pushover.digest import DIGEST_TITLE, RULES_BY_NAME, digest_messages
+from .pushover.dispatcher import PAUSED_UNTIL_KEY, PushoverDispatcher, backoff
+from .pushover.ratelimit import SharedTokenBucket, TokenBucket
+from .pushover.stub import PushoverStub
+from .schedule_sync import rebase_schedules
+from .tasks import check_offline_status, flush_device_events, forecast_feed_load
+from .utils import get_next_feeding
+from .telemetry import TelemetryBuffer
+from .timeseries import encode, enforce_retention, query_telemetry, rollup_telemetry
+from .timezones import (
+    local_time_to_utc,
+    local_times_to_utc,
+    timestamps_to_local,
+    transition_table,
+    utc_times_to_local,
+    warm_transition_tables,
+)
+
+
+def use_shared_cache(test):
+    """
+    Point the default cache of a test to a file based cache, which the workers would share like Redis
+    """
+    directory = tempfile.TemporaryDirectory()
+    test.addCleanup(directory.cleanup)
+    shared = override_settings(
+        CACHES={
+            "default": {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": directory.name}
+        }
+    )
+    shared.enable()
+    test.addCleanup(shared.disable)
+
+
+class TelemetryBufferTest(TestCase):
+    def setUp(self):
+        self.device = Device.objects.create(
+            control_board_identifier="ESP32-abcd-0123abcd", secret_key="0123456789abcde"
+        )
+        self.status = DeviceStatus.objects.create(device=self.device, hopper_level=75.0, has_event=True)
+
+    def telemetry(self, last_ping, battery_soc):
+        return {
+            "battery_voltage": 4.0,
+            "battery_soc": battery_soc,
+            "battery_crate": -0.5,
+            "on_power": False,
+            "last_ping": last_ping,
+        }
+
+    def test_flush_writes_latest_values_once(self):
+        buffer = TelemetryBuffer(interval=10, chunk_size=100, clock=lambda: 0, background=False)
+        now = timezone.now()
+        buffer.record(self.device.id, self.telemetry(now, 90.0))
+        buffer.record(self.device.id, self.telemetry(now + datetime.timedelta(seconds=5), 85.0))
+
+        with self.assertNumQueries(1):
+            rows = buffer.flush()
+
+        status = DeviceStatus.objects.get(id=self.status.id)
+        self.assertEqual(rows, 1)
+        self.assertEqual(status.battery_soc, 85.0)
+        self.assertFalse(status.on_power)
+        self.assertEqual(status.hopper_level, 75.0)
+        self.assertTrue(status.has_event)
+
+    def test_older_telemetry_does_not_overwrite_newer(self):
+        buffer = TelemetryBuffer(interval=10, chunk_size=100, clock=lambda: 0, background=False)
+        now = timezone.now()
+        DeviceStatus.objects.filter(id=self.status.id).update(last_ping=now, battery_soc=50.0)
+        buffer.record(self.device.id, self.telemetry(now - datetime.timedelta(seconds=5), 90.0))
+
+        buffer.flush()
+
+        self.assertEqual(DeviceStatus.objects.get(id=self.status.id).battery_soc, 50.0)
+
+
+class TelemetryRollupTest(TestCase):
+    # 2022-06-01 00:00:00 UTC
+    start = 1654041600
+
+    def setUp(self):
+        self.device = Device.objects.create(
+            control_board_identifier="ESP32-abcd-0123abcd", secret_key="0123456789abcde"
+        )
+        TelemetrySample.objects.bulk_create(
+            [
+                TelemetrySample(
+                    device=self.device,
+                    ts=self.start + minute * 60 + 15,
+                    battery_voltage=encode("battery_voltage", 4.0 - minute * 0.001),
+                    battery_soc=encode("battery_soc", 100 - minute * 0.01),
+                    battery_crate=encode("battery_crate", 0.0),
+                    hopper_level=encode("hopper_level", 80.0),
+                    on_power=minute % 2 == 0,
+                )
+                for minute in range(3 * 24 * 60)
+            ]
+        )
+
+    def test_rollup_tiers(self):
+        now = self.start + 3 * 86400 + 3600
+
+        # each run rolls up at most TELEMETRY_ROLLUP_MAX_BUCKETS minutes and what the finer tier covers
+        self.assertEqual(rollup_telemetry(now=now), {"minute": 1440, "hour": 24, "day": 1})
+        self.assertEqual(rollup_telemetry(now=now), {"minute": 1440, "hour": 24, "day": 1})
+        self.assertEqual(rollup_telemetry(now=now), {"minute": 1440, "hour": 24, "day": 1})
+        self.assertEqual(rollup_telemetry(now=now), {"minute": 0, "hour": 0, "day": 0})
+
+        self.assertEqual(TelemetryRollup.objects.filter(resolution=60).count(), 3 * 24 * 60)
+        self.assertEqual(TelemetryRollup.objects.filter(resolution=3600).count(), 3 * 24)
+        day = TelemetryRollup.objects.get(resolution=86400, bucket=self.start)
+        self.assertEqual(day.samples, 24 * 60)
+        self.assertEqual(day.on_power_samples, 12 * 60)
+        self.assertEqual(day.battery_voltage_max, 4000)
+        self.assertEqual(day.hopper_level_avg, 800)
+
+    def test_query_reads_coarsest_covering_tier(self):
+        now = self.start + 3 * 86400 + 3600
+        for i in range(4):
+            rollup_telemetry(now=now)
+
+        with self.assertNumQueries(1):
+            hourly = query_telemetry(self.device.id, self.start, self.start + 2 * 86400, now=now)
+        minutes = query_telemetry(self.device.id, self.start, self.start + 3600, now=now)
+
+        self.assertEqual(hourly["resolution"], 3600)
+        self.assertEqual(len(hourly["points"]), 48)
+        self.assertEqual(hourly["points"][0]["battery_voltage_max"], 4.0)
+        self.assertEqual(minutes["resolution"], 60)
+        self.assertEqual(len(minutes["points"]), 60)
+
+    def test_retention(self):
+        rollup_telemetry(now=self.start + 3 * 86400 + 3600)
+
+        deleted = enforce_retention(now=self.start + 4 * 86400)
+
+        self.assertEqual(deleted["raw"], 2 * 24 * 60)
+        self.assertEqual(TelemetrySample.objects.count(), 24 * 60)
+
+
+class OfflineAlertTest(TestCase):
+    def setUp(self):
+        motor_timing = MotorTiming.objects.create(feed_amount=0.25, motor_duration=1000, interrupter_count=7)
+        feeder_model = FeederModel.objects.create(brand_name="Petnet", model_name="SmartFeeder", hopper_capacity=20)
+        for i in range(3):
+            user = User.objects.create_user(username="owner-%d" % i, password="secret")
+            NotificationSettings.objects.create(
+                user=user, pushover_user_key="u%d" % i, pushover_devices="", feeder_offline=True
+            )
+            device = Device.objects.create(control_board_identifier="ESP32-abcd-%08d" % i, secret_key="0123456789abcde")
+            DeviceOwner.objects.create(
+                device=device,
+                user=user,
+                name="Feeder %d" % i,
+                device_key="%032d" % i,
+                feeder_model=feeder_model,
+                manual_motor_timing=motor_timing,
+            )
+        DeviceStatus.objects.update(last_ping=timezone.now() - datetime.timedelta(minutes=10))
+
+    def test_offline_devices_are_alerted_in_constant_queries(self):
+        # device contexts, alert flags in a savepoint, messages
+        with self.assertNumQueries(5):
+            check_offline_status()
+
+        self.assertEqual(NotificationAlertTracking.objects.filter(offline_alert=True).count(), 3)
+        self.assertEqual(MessageQueue.objects.count(), 3)
+
+        with self.assertNumQueries(1):
+            check_offline_status()
+        self.assertEqual(MessageQueue.objects.count(), 3)
+
+    def test_devices_without_battery_readings_are_alerted(self):
+        DeviceStatus.objects.update(battery_soc=None, battery_crate=None, battery_voltage=None)
+        NotificationSettings.objects.update(low_battery=True, power_disconnected=True)
+
+        check_offline_status()
+        self.assertEqual(MessageQueue.objects.filter(kind="offline").count(), 3)
+
+        # Back online on battery power
+        DeviceStatus.objects.update(on_power=False)
+        changes = [evaluate(context, HEARTBEAT) for context in load_device_contexts()]
+        self.assertEqual([message.kind for message in changes[0].messages], ["back_online", "power_loss"])
+
+    def test_concurrently_alerted_device_is_not_alerted_twice(self):
+        changes = [evaluate(context, OFFLINE) for context in load_device_contexts()]
+        NotificationAlertTracking.objects.filter(id=changes[0].alert_tracking.id).update(offline_alert=True)
+
+        saved = save_changes(changes)
+
+        self.assertEqual(saved, changes[1:])
+        self.assertEqual(NotificationAlertTracking.objects.filter(offline_alert=True).count(), 3)
+        self.assertEqual(MessageQueue.objects.count(), 2)
+
+
+class NextMealTest(TestCase):
+    # Dates in UTC, 2022-06-04 is a Saturday
+    saturday_night = datetime.datetime(2022, 6, 4, 23, 30, tzinfo=datetime.timezone.utc)
+
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user(username="owner", password="secret")
+        motor_timing = MotorTiming.objects.create(feed_amount=0.25, motor_duration=1000, interrupter_count=7)
+        feeder_model = FeederModel.objects.create(brand_name="Petnet", model_name="SmartFeeder", hopper_capacity=20)
+        self.device = Device.objects.create(
+            control_board_identifier="ESP32-abcd-0123abcd", secret_key="0123456789abcde"
+        )
+        self.device_owner = DeviceOwner.objects.create(
+            device=self.device,
+            user=user,
+            name="Kitchen",
+            device_key="0123456789abcdef0123456789abcdef",
+            feeder_model=feeder_model,
+            manual_motor_timing=motor_timing,
+        )
+        self.pet = Pet.objects.create(user=user, name="Tom")
+        # Monday and Wednesday at 07:00
+        self.breakfast = FeedingSchedule.objects.create(
+            device=self.device,
+            device_owner=self.device_owner,
+            pet=self.pet,
+            meal_name="Breakfast",
+            dow=2 + 8,
+            time="07:00:00",
+            motor_timing=motor_timing,
+        )
+
+    def test_index_wraps_around_the_week(self):
+        meal = {"id": 1}
+        index = MealIndex([(1 * 1440 + 420, meal), (3 * 1440 + 420, meal)])
+
+        self.assertEqual(index.next_meal(1 * 1440 + 420), (0, meal))
+        self.assertEqual(index.next_meal(2 * 1440), (1440 + 420, meal))
+        self.assertEqual(index.next_meal(6 * 1440 + 1410), (30 + 1440 + 420, meal))
+        self.assertIsNone(MealIndex().next_meal(0))
+
+    def test_next_meal_more_than_a_day_away(self):
+        next_meal = get_next_feeding(self.device.id, now=self.saturday_night)
+
+        self.assertEqual(next_meal["meal_name"], "Breakfast")
+        self.assertEqual(next_meal["day"], "on Monday")
+        self.assertEqual(next_meal["size"], "1/4")
+
+        tuesday = get_next_feeding(self.device.id, now=self.saturday_night + datetime.timedelta(days=3))
+        self.assertEqual(tuesday["day"], "tomorrow")
+
+    def test_day_is_relative_to_the_users_timezone(self):
+        # Saturday 23:30 UTC is already Sunday in Tokyo, Monday 07:00 UTC is Monday afternoon there
+        next_meal = get_next_feeding(self.device.id, "Asia/Tokyo", now=self.saturday_night)
+
+        self.assertEqual(next_meal["day"], "tomorrow")
+        self.assertEqual(next_meal["feed_time_tz"], "16:00:00")
+
+    def test_lookup_uses_the_cached_index(self):
+        use_shared_cache(self)
+        get_meal_indexes([self.device.id])
+
+        with self.assertNumQueries(0):
+            get_next_feeding(self.device.id, now=self.saturday_night)
+
+    def test_index_is_rebuilt_from_schedule_changes(self):
+        use_shared_cache(self)
+        get_meal_indexes([self.device.id])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.breakfast.dow = 1
+            self.breakfast.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.pet.name = "Thomas"
+            self.pet.save()
+
+        with self.assertNumQueries(0):
+            next_meal = get_next_feeding(self.device.id, now=self.saturday_night)
+        self.assertEqual(next_meal["day"], "tomorrow")
+        self.assertEqual(next_meal["pet_name"], "Thomas")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.breakfast.delete()
+        self.assertEqual(get_next_feeding(self.device.id, now=self.saturday_night)["has_meal"], 0)
+
+    def test_per_process_cache_is_not_used(self):
+        # Another worker saving the schedule could not rebuild the index cached in this process
+        get_meal_indexes([self.device.id])
+        FeedingSchedule.objects.filter(id=self.breakfast.id).update(dow=1)
+
+        with self.assertNumQueries(1):
+            next_meal = get_next_feeding(self.device.id, now=self.saturday_night)
+        self.assertEqual(next_meal["day"], "tomorrow")
+
+    def test_fleet_next_meals(self):
+        other_device = Device.objects.create(
+            control_board_identifier="ESP32-abcd-ffffffff", secret_key="0123456789abcde"
+        )
+        # Sunday and Saturday at 23:45, and an unscheduled meal that never comes
+        for dow in (1 + 64, 0):
+            FeedingSchedule.objects.create(
+                device=other_device,
+                device_owner=self.device_owner,
+                pet=self.pet,
+                meal_name="Late snack",
+                dow=dow,
+                time="23:45:00",
+                motor_timing=self.breakfast.motor_timing,
+            )
+
+        with self.assertNumQueries(1):
+            fleet = fleet_next_meals(now=self.saturday_night)
+
+        next_meals = fleet.as_dict()
+        monday_breakfast = datetime.datetime(2022, 6, 6, 7, 0, tzinfo=datetime.timezone.utc)
+        self.assertEqual(next_meals[self.device.id], (monday_breakfast, self.breakfast.id))
+        self.assertEqual(next_meals[other_device.id][0], self.saturday_night + datetime.timedelta(minutes=15))
+        self.assertEqual(fleet.feeds_per_minute(60).tolist()[15], 1)
+        self.assertEqual(len(fleet_next_meals([self.device.id], now=self.saturday_night)), 1)
+
+    @override_settings(FEED_LOAD_FORECAST_MINUTES=30, FEED_LOAD_WARNING=1)
+    def test_feed_load_forecast(self):
+        soon = timezone.now().astimezone(pytz.utc) + datetime.timedelta(minutes=10)
+        self.breakfast.dow = 127
+        self.breakfast.time = soon.time()
+        self.breakfast.save()
+
+        with self.assertLogs("app.tasks", "WARNING") as logs:
+            feeds = forecast_feed_load()
+
+        self.assertEqual(len(feeds), 30)
+        self.assertEqual(feeds[10], 1)
+        self.assertEqual(sum(feeds), 1)
+        self.assertIn("1 feeders are scheduled to dispense in 10 minutes", logs.output[0])
+
+
+class TimezoneTest(TestCase):
+    zones = ("America/New_York", "Europe/London", "Australia/Lord_Howe", "Asia/Kolkata", "UTC")
+    # DST start and end days of the zones in 2022, and a day without a transition
+    days = (
+        datetime.date(2022, 3, 13),
+        datetime.date(2022, 3, 27),
+        datetime.date(2022, 4, 3),
+        datetime.date(2022, 6, 15),
+        datetime.date(2022, 10, 2),
+        datetime.date(2022, 10, 30),
+        datetime.date(2022, 11, 6),
+    )
+    times = [datetime.time(minute // 60, minute % 60) for minute in range(0, 24 * 60, 15)]
+
+    def test_times_match_pytz(self):
+        for name in self.zones:
+            tz = pytz.timezone(name)
+            for day in self.days:
+                expected = [
+                    datetime.datetime.combine(day, t, tzinfo=pytz.utc).astimezone(tz).time() for t in self.times
+                ]
+                self.assertEqual(utc_times_to_local(self.times, name, on=day), expected, (name, day))
+
+                # Repeated local times resolve to standard time and skipped ones keep it, like localize()
+                expected = [
+                    tz.localize(datetime.datetime.combine(day, t)).astimezone(pytz.utc).time() for t in self.times
+                ]
+                self.assertEqual(local_times_to_utc(self.times, name, on=day), expected, (name, day))
+
+    def test_timestamps_match_pytz(self):
+        start = datetime.datetime(2021, 12, 31, 12, 0, tzinfo=pytz.utc)
+        timestamps = [start + datetime.timedelta(minutes=97 * i) for i in range(6000)]
+        for name in self.zones:
+            tz = pytz.timezone(name)
+            for converted, timestamp in zip(timestamps_to_local(timestamps, name), timestamps):
+                expected = timestamp.astimezone(tz)
+                self.assertEqual(converted, timestamp)
+                self.assertEqual(converted.replace(tzinfo=None), expected.replace(tzinfo=None))
+
+    def test_warm_up_builds_the_posix_timezone_tables(self):
+        PosixTimezone.objects.create(timezone="America/Chicago", posix_tz="CST6CDT,M3.2.0,M11.1.0")
+        PosixTimezone.objects.create(timezone="Not/AZone", posix_tz="")
+        transition_table.cache_clear()
+
+        self.assertEqual(warm_transition_tables(), 1)
+        self.assertEqual(transition_table.cache_info().currsize, 1)
+
+        # The tables of the current year are the ones the conversions look up
+        misses = transition_table.cache_info().misses
+        utc_times_to_local([datetime.time(12, 0)], "America/Chicago")
+        timestamps_to_local([timezone.now()], "America/Chicago")
+        self.assertEqual(transition_table.cache_info().misses, misses)
+        self.assertEqual(transition_table("America/Chicago", 2022).offsets, [-6 * 3600, -5 * 3600, -6 * 3600])
+
+
+class ScheduleRebaseTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="owner", password="secret")
+        motor_timing = MotorTiming.objects.create(feed_amount=0.25, motor_duration=1000, interrupter_count=7)
+        feeder_model = FeederModel.objects.create(brand_name="Petnet", model_name="SmartFeeder", hopper_capacity=20)
+        pet = Pet.objects.create(user=self.user, name="Tom")
+        self.owners = []
+        for i in range(3):
+            device = Device.objects.create(control_board_identifier="ESP32-abcd-%08x" % i, secret_key="0123456789abcde")
+            owner = DeviceOwner.objects.create(
+                device=device,
+                user=self.user,
+                device_key="%032x" % i,
+                feeder_model=feeder_model,
+                manual_motor_timing=motor_timing,
+            )
+            self.owners.append(owner)
+            for hour in (7, 12, 18):
+                FeedingSchedule.objects.create(
+                    device=device,
+                    device_owner=owner,
+                    pet=pet,
+                    dow=127,
+                    time="%02d:30:00" % hour,
+                    local_time="%02d:30:00" % hour,
+                    motor_timing=motor_timing,
+                )
+        # The last feeder has no schedule in this test
+        FeedingSchedule.objects.filter(device_owner=self.owners[2]).delete()
+        EventQueue.objects.update(status_code="C")
+
+    def pending_events(self):
+        return sorted(EventQueue.objects.filter(status_code="P").values_list("device_owner_id", "event_code"))
+
+    def test_rebase_in_bulk(self):
+        with self.captureOnCommitCallbacks(execute=True), self.assertNumQueries(16):
+            rebased = rebase_schedules(self.user.id, "Asia/Kolkata", "IST-5:30")
+
+        self.assertEqual(rebased, 6)
+        for schedule in FeedingSchedule.objects.all():
+            self.assertEqual(schedule.time, local_time_to_utc(schedule.local_time, "Asia/Kolkata"))
+        self.assertEqual(
+            self.pending_events(),
+            [(self.owners[0].id, 300), (self.owners[0].id, 400), (self.owners[1].id, 300), (self.owners[1].id, 400)]
+            + [(self.owners[2].id, 400)],
+        )
+        self.assertEqual(DeviceStatus.objects.filter(has_event=True).count(), 3)
+        self.assertEqual(
+            dict(
+                Settings.objects.filter(user=self.user, name__in=["timezone", "tz_esp32"]).values_list("name", "value")
+            ),
+            {"timezone": "Asia/Kolkata", "tz_esp32": "IST-5:30"},
+        )
+
+        # Nothing left to re-base and the settings events are still pending
+        self.assertEqual(rebase_schedules(self.user.id, "Asia/Kolkata", "IST-5:30"), 0)
+        self.assertEqual(len(self.pending_events()), 5)
+
+
+class DeviceEventCollectorTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user(username="owner", password="secret")
+        motor_timing = MotorTiming.objects.create(feed_amount=0.25, motor_duration=1000, interrupter_count=7)
+        self.device = Device.objects.create(
+            control_board_identifier="ESP32-abcd-0123abcd", secret_key="0123456789abcde"
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            self.device_owner = DeviceOwner.objects.create(
+                device=self.device,
+                user=user,
+                device_key="0123456789abcdef0123456789abcdef",
+                manual_motor_timing=motor_timing,
+            )
+            self.schedule = FeedingSchedule.objects.create(
+                device=self.device,
+                device_owner=self.device_owner,
+                pet=Pet.objects.create(user=user, name="Tom"),
+                dow=127,
+                motor_timing=motor_timing,
+            )
+        EventQueue.objects.update(status_code="C")
+
+    def pending_events(self):
+        return sorted(EventQueue.objects.filter(status_code="P").values_list("device_owner_id", "event_code"))
+
+    def test_events_of_a_transaction_are_flushed_once(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            for meal_name in ("Breakfast", "Lunch", "Dinner"):
+                self.schedule.meal_name = meal_name
+                self.schedule.save()
+            self.device_owner.save()
+            self.device_owner.save()
+
+        batches = [callback for callback in callbacks if callback.__class__.__name__ == "EventBatch"]
+        self.assertEqual(len(batches), 1)
+        # pending events, event insert, device ids, status ids, has_event update
+        with self.assertNumQueries(5):
+            batches[0]()
+
+        self.assertEqual(self.pending_events(), [(self.device_owner.id, 300), (self.device_owner.id, 400)])
+        self.assertTrue(DeviceStatus.objects.get(device=self.device).has_event)
+
+    def test_pending_events_are_not_queued_again(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.device_owner.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.device_owner.save()
+
+        self.assertEqual(self.pending_events(), [(self.device_owner.id, 400)])
+
+    @override_settings(DEVICE_EVENT_DEBOUNCE=5)
+    def test_rapid_schedule_edits_are_debounced(self):
+        use_shared_cache(self)
+        with mock.patch.object(flush_device_events, "apply_async") as apply_async:
+            for meal_name in ("Breakfast", "Lunch", "Dinner"):
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.schedule.meal_name = meal_name
+                    self.schedule.save()
+            with self.captureOnCommitCallbacks(execute=True):
+                device_events.add(self.device_owner.id, 400)
+
+        # Settings events are not debounced
+        self.assertEqual(self.pending_events(), [(self.device_owner.id, 400)])
+        self.assertEqual(apply_async.call_count, 3)
+        self.assertEqual(apply_async.call_args.kwargs["countdown"], 5)
+
+        # Only the flush scheduled by the last edit queues the schedule event
+        first, second, last = apply_async.call_args_list
+        flush_device_events(*first.kwargs["args"])
+        flush_device_events(*second.kwargs["args"])
+        self.assertEqual(self.pending_events(), [(self.device_owner.id, 400)])
+        flush_device_events(*last.kwargs["args"])
+        self.assertEqual(self.pending_events(), [(self.device_owner.id, 300), (self.device_owner.id, 400)])
+
+    @override_settings(DEVICE_EVENT_DEBOUNCE=5)
+    def test_flush_without_token_is_superseded(self):
+        use_shared_cache(self)
+        with mock.patch.object(flush_device_events, "apply_async") as apply_async:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.schedule.save()
+
+        cache.clear()
+        flush_device_events(*apply_async.call_args.kwargs["args"])
+        self.assertEqual(self.pending_events(), [])
+
+    @override_settings(DEVICE_EVENT_DEBOUNCE=5)
+    def test_per_process_cache_is_not_debounced(self):
+        with mock.patch.object(flush_device_events, "apply_async") as apply_async:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.schedule.save()
+
+        apply_async.assert_not_called()
+        self.assertEqual(self.pending_events(), [(self.device_owner.id, 300)])
+
+
+class HopperLevelTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user(username="owner", password="secret")
+        NotificationSettings.objects.create(user=user, pushover_user_key="", pushover_devices="")
+        motor_timing = MotorTiming.objects.create(feed_amount=0.25, motor_duration=1000, interrupter_count=7)
+        feeder_model = FeederModel.objects.create(brand_name="Petnet", model_name="SmartFeeder", hopper_capacity=20)
+        self.owners = []
+        for i in range(2):
+            device = Device.objects.create(control_board_identifier="ESP32-abcd-%08x" % i, secret_key="0123456789abcde")
+            self.owners.append(
+                DeviceOwner.objects.create(
+                    device=device,
+                    user=user,
+                    device_key="%032x" % i,
+                    feeder_model=feeder_model,
+                    manual_motor_timing=motor_timing,
+                )
+            )
+        DeviceStatus.objects.update(hopper_level=50)
+
+    def hopper_level(self, owner):
+        return DeviceStatus.objects.get(device_id=owner.device_id).hopper_level
+
+    def feed(self, owner, amount, **kwargs):
+        return FeedingLog.objects.create(device_owner=owner, feed_type="S", feed_amt=amount, **kwargs)
+
+    def test_feed_decrements_the_hopper_in_the_database(self):
+        owner = self.owners[0]
+        stale_status = DeviceStatus.objects.get(device_id=owner.device_id)
+        self.feed(owner, 0.5)
+
+        # feeding log insert, feeder, hopper and rollup UPDATEs and notification settings
+        with self.assertNumQueries(5):
+            self.feed(owner, 1.5)
+        self.assertAlmostEqual(self.hopper_level(owner), 40)
+
+        # a heartbeat holding the row from before the feeds only writes its own columns
+        stale_status.battery_soc = 75
+        stale_status.save(update_fields=["battery_soc", "updated_at"])
+        self.assertAlmostEqual(self.hopper_level(owner), 40)
+
+        self.feed(owner, 100)
+        self.assertEqual(self.hopper_level(owner), 0)
+
+    def test_shared_cache_keeps_the_feeder_until_it_changes(self):
+        use_shared_cache(self)
+        owner = self.owners[0]
+        self.feed(owner, 0.5)
+
+        # feeding log insert, hopper and rollup UPDATEs and notification settings, the feeder is cached
+        with self.assertNumQueries(4):
+            self.feed(owner, 1.5)
+        self.assertAlmostEqual(self.hopper_level(owner), 40)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            owner.feeder_model.hopper_capacity = 10
+            owner.feeder_model.save()
+        self.feed(owner, 1)
+        self.assertAlmostEqual(self.hopper_level(owner), 30)
+
+    def test_reconcile_from_the_last_refill(self):
+        first, second = self.owners
+        self.feed(first, 4, feed_timestamp=timezone.now() - datetime.timedelta(days=1))
+        refill(first.device_id, 90)
+        refill(second.device_id, 60)
+        self.feed(first, 2)
+        self.feed(first, 1)
+        DeviceStatus.objects.update(hopper_level=12)
+
+        # device ids, then one UPDATE per batch
+        with self.assertNumQueries(3):
+            self.assertEqual(reconcile_hopper_levels(batch_size=1), 2)
+
+        self.assertAlmostEqual(self.hopper_level(first), 90 - 3 * 100 / 20)
+        self.assertAlmostEqual(self.hopper_level(second), 60)
+
+    def test_reconcile_counts_the_archived_feeds(self):
+        owner = self.owners[0]
+        refill(owner.device_id, 90)
+        DeviceStatus.objects.filter(device_id=owner.device_id).update(
+            hopper_refilled_at=timezone.now() - datetime.timedelta(days=settings.FEEDING_LOG_HOT_DAYS + 10)
+        )
+        self.feed(owner, 4, feed_timestamp=timezone.now() - datetime.timedelta(days=settings.FEEDING_LOG_HOT_DAYS + 5))
+        self.feed(owner, 1)
+        archive_feeding_log()
+
+        reconcile_hopper_levels()
+
+        self.assertAlmostEqual(self.hopper_level(owner), 90 - 5 * 100 / 20)
+
+
+class FeedingLogArchiveTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user(username="owner", password="secret")
+        motor_timing = MotorTiming.objects.create(feed_amount=0.25, motor_duration=1000, interrupter_count=7)
+        device = Device.objects.create(control_board_identifier="ESP32-abcd-0123abcd", secret_key="0123456789abcde")
+        self.device_owner = DeviceOwner.objects.create(
+            device=device, user=user, device_key="0123456789abcdef0123456789abcdef", manual_motor_timing=motor_timing
+        )
+        now = timezone.now()
+        # A feed every 10 days over 200 days, newest first
+        FeedingLog.objects.bulk_create(
+            [
+                FeedingLog(
+                    device_owner=self.device_owner, feed_amt=0.25, feed_timestamp=now - datetime.timedelta(days=days)
+                )
+                for days in range(0, 200, 10)
+            ]
+        )
+        self.expected = list(FeedingLog.objects.order_by("-feed_timestamp").values_list("id", flat=True))
+
+    def test_old_rows_are_moved_to_the_archive(self):
+        self.assertEqual(archive_feeding_log(batch_size=4), 11)
+        self.assertEqual(archive_feeding_log(), 0)
+
+        self.assertEqual(FeedingLog.objects.count(), 9)
+        self.assertEqual(FeedingLogArchive.objects.count(), 11)
+        cutoff = timezone.now() - datetime.timedelta(days=90)
+        self.assertFalse(FeedingLog.objects.filter(feed_timestamp__lt=cutoff).exists())
+        self.assertEqual(
+            sorted(FeedingLog.objects.values_list("id", flat=True))
+            + sorted(FeedingLogArchive.objects.values_list("id", flat=True)),
+            sorted(self.expected),
+        )
+
+    def test_history_reads_the_archive_only_past_the_recent_rows(self):
+        archive_feeding_log()
+        history = feeding_history(device_owner__user_id=self.device_owner.user_id)
+
+        # hot count and hot page
+        with self.assertNumQueries(2):
+            self.assertEqual([row.id for row in history[0:5]], self.expected[:5])
+        with self.assertNumQueries(1):
+            self.assertEqual([row.id for row in history[5:9]], self.expected[5:9])
+        # the rest of the recent rows and the newest archived ones
+        with self.assertNumQueries(2):
+            self.assertEqual([row.id for row in history[5:12]], self.expected[5:12])
+        self.assertEqual([row.id for row in history[15:30]], self.expected[15:])
+
+        self.assertEqual(history.count(), 20)
+        with self.assertNumQueries(0):
+            self.assertEqual(len(history), 20)
+        self.assertEqual(history[10].device_owner, self.device_owner)
+
+
+class FeedingRollupTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user(username="owner", password="secret")
+        Settings.objects.create(user=user, name="timezone", value="America/New_York")
+        motor_timing = MotorTiming.objects.create(feed_amount=0.25, motor_duration=1000, interrupter_count=7)
+        device = Device.objects.create(control_board_identifier="ESP32-abcd-0123abcd", secret_key="0123456789abcde")
+        self.device_owner = DeviceOwner.objects.create(
+            device=device, user=user, device_key="0123456789abcdef0123456789abcdef", manual_motor_timing=motor_timing
+        )
+
+    def feed(self, hour, feed_type="S", feed_amt=0.25, pet_name="Rex"):
+        # Hours from Friday 2022-06-03 00:00 in New York
+        return {
+            "pet_name": pet_name,
+            "feed_type": feed_type,
+            "feed_amt": feed_amt,
+            "feed_timestamp": datetime.datetime(2022, 6, 3, 4, tzinfo=pytz.utc) + datetime.timedelta(hours=hour),
+        }
+
+    def rollups(self):
+        return list(
+            FeedingRollup.objects.order_by("day", "pet_name").values_list(
+                "day", "pet_name", "feed_amt", "feeds", "manual_feeds", "scheduled_feeds", "remote_feeds"
+            )
+        )
+
+    def test_feeds_are_rolled_up_per_local_day(self):
+        FeedingLog.objects.create(device_owner=self.device_owner, **self.feed(7))
+        FeedingLog.objects.create(device_owner=self.device_owner, **self.feed(23, feed_type="R", feed_amt=0.5))
+        FeedingLog.objects.create(device_owner=self.device_owner, **self.feed(24))
+        manual = self.feed(12, feed_type="M")
+        del manual["pet_name"]
+        record_feedings(
+            self.device_owner.id,
+            [dict(manual, idempotency_key="a"), dict(self.feed(31), idempotency_key="b")],
+        )
+
+        expected = [
+            (datetime.date(2022, 6, 3), "Manual", 0.25, 1, 1, 0, 0),
+            (datetime.date(2022, 6, 3), "Rex", 0.75, 2, 0, 1, 1),
+            (datetime.date(2022, 6, 4), "Rex", 0.5, 2, 0, 2, 0),
+        ]
+        self.assertEqual(self.rollups(), expected)
+
+        # Rebuilt from the archive as well as the recent rows
+        archive_feeding_log(before=datetime.datetime(2022, 6, 3, 20, tzinfo=pytz.utc))
+        FeedingRollup.objects.all().delete()
+        self.assertEqual(backfill_feeding_rollups(batch_size=1), 3)
+        self.assertEqual(self.rollups(), expected)
+
+    def test_consumption_is_read_from_the_rollups(self):
+        record_feedings(
+            self.device_owner.id,
+            [dict(self.feed(hour), idempotency_key=str(hour)) for hour in range(0, 24 * 10, 12)],
+        )
+
+        with self.assertNumQueries(1):
+            days = feeding_consumption(self.device_owner.user_id, datetime.date(2022, 6, 5), datetime.date(2022, 6, 6))
+        self.assertEqual(
+            [(row["period"], row["feed_amt"], row["feeds"]) for row in days],
+            [(datetime.date(2022, 6, 5), 0.5, 2), (datetime.date(2022, 6, 6), 0.5, 2)],
+        )
+
+        weeks = feeding_consumption(
+            self.device_owner.user_id, datetime.date(2022, 6, 1), datetime.date(2022, 6, 30), period="week"
+        )
+        # ISO weeks starting on Monday
+        self.assertEqual(
+            [(row["period"], row["feeds"]) for row in weeks],
+            [(datetime.date(2022, 5, 30), 6), (datetime.date(2022, 6, 6), 14)],
+        )
+
+
+class FeederPagesTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="owner", password="secret")
+        Settings.objects.create(user=self.user, name="timezone", value="America/New_York")
+        self.motor_timing = MotorTiming.objects.create(feed_amount=0.25, motor_duration=1000, interrupter_count=7)
+        self.feeder_model = FeederModel.objects.create(
+            brand_name="Petnet", model_name="SmartFeeder", hopper_capacity=20
+        )
+        self.pet = Pet.objects.create(user=self.user, name="Tom")
+        board = ControlBoardModel.objects.create(name="ESP32", revision="1.1", description="ESP32 rev 1.1")
+        FirmwareUpdate.objects.create(version="1.0.0", control_board=board)
+        self.firmware = FirmwareUpdate.objects.create(version="1.1.0", control_board=board, description="Fixes")
+        self.client = Client()
+        self.client.force_login(self.user)
+
+    def add_feeders(self, count):
+        now = timezone.now()
+        for i in range(count):
+            device = Device.objects.create(control_board_identifier="ESP32-abcd-%08x" % i, secret_key="%015d" % i)
+            DeviceStatus.objects.update_or_create(device=device, defaults={"control_board_revision": "1.1"})
+            owner = DeviceOwner.objects.create(
+                device=device,
+                user=self.user,
+                name="Feeder %d" % i,
+                feeder_model=self.feeder_model,
+                manual_motor_timing=self.motor_timing,
+            )
+            FeedingSchedule.objects.create(
+                device=device,
+                device_owner=owner,
+                pet=self.pet,
+                meal_name="Breakfast",
+                dow=127,
+                time="11:00:00",
+                motor_timing=self.motor_timing,
+            )
+            FeedingLog.objects.bulk_create(
+                [
+                    FeedingLog(device_owner=owner, feed_amt=0.25, feed_timestamp=now - datetime.timedelta(hours=hours))
+                    for hours in range(7)
+                ]
+            )
+
+    def test_dashboard_queries_do_not_grow_with_the_feeders(self):
+        self.add_feeders(1)
+        self.client.get("/dashboard/")
+        # session, user, settings, device owners, meal indexes, latest feeds and the social accounts of the menu
+        with self.assertNumQueries(7):
+            self.client.get("/dashboard/")
+
+        self.add_feeders(7)
+        self.client.get("/dashboard/")
+        with self.assertNumQueries(7):
+            response = self.client.get("/dashboard/")
+
+        self.assertEqual(response.context["num_feeders"], 8)
+        for info in response.context["info"]:
+            feedings = FeedingLog.objects.filter(device_owner=info["device"]).order_by("-feed_timestamp")[:5]
+            self.assertEqual(
+                [row["feed_timestamp"] for row in info["feedings"]], [row.feed_timestamp for row in feedings]
+            )
+            self.assertEqual(info["next_meal"]["meal_name"], "Breakfast")
+
+    def test_feeders_queries_do_not_grow_with_the_feeders(self):
+        self.add_feeders(8)
+        self.client.get("/feeders/")
+        # session, user, settings, device owners, meal indexes, firmware updates and the social accounts of the menu
+        with self.assertNumQueries(7):
+            response = self.client.get("/feeders/")
+
+        self.assertEqual(response.context["num_feeders"], 8)
+        self.assertContains(response, "ESP32-abcd-00000007")
+        self.assertContains(response, "Petnet")
+        for info in response.context["info"]:
+            self.assertEqual(info["firmware_update"], {"version": "1.1.0", "description": "Fixes"})
+
+
+class RequestMetricsTest(TestCase):
+    def setUp(self):
+        request_metrics.reset()
+        self.addCleanup(request_metrics.reset)
+        self.user = User.objects.create_user(username="owner", password="secret")
+        Settings.objects.create(user=self.user, name="timezone", value="UTC")
+        self.client = Client()
+        self.client.force_login(self.user)
+
+    def test_requests_are_recorded_by_view(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get("/dashboard/")
+        num_queries = len(queries)
+        self.client.get("/dashboard/")
+
+        metrics = request_metrics.views["app.views.dashboard"]
+        self.assertEqual(sum(metrics.duration.counts), 2)
+        self.assertEqual(metrics.queries.sum, 2 * num_queries)
+        self.assertGreater(metrics.db_duration.sum, 0)
+        self.assertEqual(sum(entry[0] for entry in metrics.slow_queries.values()), 2)
+
+    def test_metrics_endpoint(self):
+        self.client.get("/dashboard/")
+        self.assertEqual(self.client.get("/metrics/").status_code, 403)
+
+        with override_settings(REQUEST_METRICS_TOKEN="s3cret"):
+            self.assertEqual(self.client.get("/metrics/", HTTP_AUTHORIZATION="Bearer wrong").status_code, 403)
+            response = self.client.get("/metrics/", HTTP_AUTHORIZATION="Bearer s3cret")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/plain; version=0.0.4; charset=utf-8")
+        body = response.content.decode()
+        self.assertIn('smart_petfeeder_request_duration_seconds_bucket{view="app.views.dashboard",le="+Inf"} 1', body)
+        self.assertIn('smart_petfeeder_request_db_queries_count{view="app.views.dashboard"} 1', body)
+        self.assertIn('smart_petfeeder_slowest_query_total{view="app.views.dashboard",query="SELECT', body)
+
+        self.user.is_staff = True
+        self.user.save()
+        self.assertEqual(self.client.get("/metrics/").status_code, 200)
+
+    def test_workers_are_added_up(self):
+        def recorder(queries, slowest, sql):
+            recorder = QueryRecorder()
+            recorder.queries, recorder.elapsed, recorder.slowest, recorder.slowest_sql = queries, slowest, slowest, sql
+            return recorder
+
+        with tempfile.TemporaryDirectory() as directory:
+            workers = [RequestMetrics(directory=directory, flush_interval=0, slow_queries=2) for i in range(2)]
+            workers[0].record("api.views.heartbeat", 0.004, recorder(3, 0.002, "SELECT * FROM pet WHERE id = 1"))
+            workers[0].record("api.views.heartbeat", 0.2, recorder(3, 0.1, "SELECT * FROM feeder WHERE id = 1"))
+            # The second worker has not flushed yet, its own totals are read from memory
+            workers[1].flush_interval = 3600
+            workers[1].record("api.views.heartbeat", 0.03, recorder(40, 0.05, "SELECT * FROM feeder WHERE id = 2"))
+            workers[1].record("api.views.heartbeat", 0.03, recorder(40, 0.01, "SELECT * FROM device WHERE id = 2"))
+
+            merged = workers[1].collect()
+
+        heartbeat = merged["api.views.heartbeat"]
+        self.assertEqual(heartbeat["duration"][0], [1, 0, 0, 2, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0])
+        self.assertEqual(heartbeat["queries"][0], [0, 0, 0, 2, 0, 0, 0, 2, 0, 0, 0])
+        self.assertAlmostEqual(heartbeat["db_duration"][1], 0.162)
+        # Only the slowest fingerprints are kept
+        slow_queries = heartbeat["slow_queries"]
+        self.assertEqual(list(slow_queries), ["SELECT * FROM feeder WHERE id = ?", "SELECT * FROM device WHERE id = ?"])
+        self.assertEqual([entry[0] for entry in slow_queries.values()], [2, 1])
+        self.assertAlmostEqual(slow_queries["SELECT * FROM feeder WHERE id = ?"][1], 0.15)
+
+    def test_fingerprint(self):
+        self.assertEqual(
+            fingerprint("SELECT *  FROM t WHERE id IN (%s, %s, %s) AND name = 'it''s'\n LIMIT 21"),
+            "SELECT * FROM t WHERE id IN (...) AND name = ? LIMIT ?",
+        )
+
+
+class PushoverDispatcherTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.stub = PushoverStub().start()
+        self.addCleanup(self.stub.stop)
+        self.users = []
+        for i in range(3):
+            user = User.objects.create_user(username="user%d" % i)
+            NotificationSettings.objects.create(user=user, pushover_user_key="key%d" % i, pushover_devices="phone")
+            self.users.append(user)
+
+    def dispatcher(self, **kwargs):
+        kwargs.setdefault("bucket", TokenBucket(1000, 1000))
+        return PushoverDispatcher(Pushover(api_key="app-token", base_url=self.stub.url, pool_size=4), **kwargs)
+
+    def queue(self, user, count, **kwargs):
+        MessageQueue.objects.bulk_create(
+            [MessageQueue(user=user, title="Kitchen", message="Message %d" % i, **kwargs) for i in range(count)]
+        )
+
+    def test_sends_the_pending_messages_in_batches(self):
+        for user in self.users:
+            self.queue(user, 3)
+        NotificationSettings.objects.filter(user=self.users[2]).update(pushover_user_key="")
+
+        # Per batch of 2 users, whatever their number of messages: savepoint, users, claim, lease, notification
+        # settings and release, then savepoint, an UPDATE per status and release. The last batch finds no user.
+        with self.assertNumQueries(9 + 9 + 3):
+            counts = self.dispatcher(batch_size=2, concurrency=4).run(window=0)
+
+        self.assertEqual(counts, {"C": 6, "E": 3, "P": 0, "S": 0, "D": 0})
+        # One digest per user
+        self.assertEqual(sorted(message["user"] for message in self.stub.messages), ["key0", "key1"])
+        self.assertEqual(self.stub.messages[0]["title"], DIGEST_TITLE)
+        self.assertEqual(self.stub.messages[0]["message"], "Kitchen: Message 0\nKitchen: Message 1\nKitchen: Message 2")
+        self.assertEqual(MessageQueue.objects.filter(user=self.users[2], status_code="E").count(), 3)
+        self.assertFalse(MessageQueue.objects.filter(status_code="P").exists())
+
+    def test_messages_wait_for_the_digest_window(self):
+        self.queue(self.users[0], 1)
+        self.queue(self.users[1], 1)
+        MessageQueue.objects.filter(user=self.users[0]).update(
+            created_at=timezone.now() - datetime.timedelta(minutes=2)
+        )
+
+        self.assertEqual(self.dispatcher().run(window=60), {"C": 1, "E": 0, "P": 0, "S": 0, "D": 0})
+        self.assertEqual(self.stub.messages[0]["message"], "Message 0")
+        self.assertEqual(MessageQueue.objects.get(user=self.users[1]).status_code, "P")
+
+    def test_sends_the_messages_of_one_user(self):
+        self.queue(self.users[0], 2)
+        self.queue(self.users[1], 2)
+
+        self.assertEqual(
+            self.dispatcher().run(user_id=self.users[1].id, window=0), {"C": 2, "E": 0, "P": 0, "S": 0, "D": 0}
+        )
+        self.assertEqual(MessageQueue.objects.filter(user=self.users[0], status_code="P").count(), 2)
+
+    def test_superseded_alerts_are_not_sent(self):
+        feeder_model = FeederModel.objects.create(brand_name="Petnet", model_name="SmartFeeder", hopper_capacity=20)
+        motor_timing = MotorTiming.objects.create(feed_amount=0.25, motor_duration=1000, interrupter_count=7)
+        device = Device.objects.create(control_board_identifier="ESP32-abcd-00000001", secret_key="0123456789abcde")
+        device_owner = DeviceOwner.objects.create(
+            device=device,
+            user=self.users[0],
+            name="Kitchen",
+            device_key="%032d" % 1,
+            feeder_model=feeder_model,
+            manual_motor_timing=motor_timing,
+        )
+        for kind in ("offline", "back_online"):
+            self.queue(self.users[0], 1, device_owner=device_owner, kind=kind)
+
+        self.assertEqual(self.dispatcher().run(window=0), {"C": 0, "E": 0, "P": 0, "S": 2, "D": 0})
+        self.assertEqual(self.stub.messages, [])
+        self.assertEqual(MessageQueue.objects.filter(status_code="S").count(), 2)
+
+    def test_claimed_messages_are_leased_while_sent(self):
+        self.queue(self.users[0], 2)
+        other = self.dispatcher()
+        claimed = []
+
+        def claim_and_digest(messages):
+            # Between the claim and the sends, another dispatcher skips the leased messages
+            claimed.append(other.claim())
+            return digest_messages(messages)
+
+        with mock.patch("app.pushover.dispatcher.digest_messages", claim_and_digest):
+            self.assertEqual(self.dispatcher().run(window=0), {"C": 2, "E": 0, "P": 0, "S": 0, "D": 0})
+
+        self.assertEqual(claimed, [[]])
+
+    def test_rate_limited_messages_are_left_pending(self):
+        self.stub.app_limit = 2
+        for user in self.users:
+            self.queue(user, 2)
+
+        counts = self.dispatcher(batch_size=3, concurrency=1).run(window=0)
+
+        self.assertEqual(counts, {"C": 4, "E": 0, "P": 2, "S": 0, "D": 0})
+        self.assertEqual(MessageQueue.objects.filter(status_code="P").count(), 2)
+        # The app limit resets in a month, the next dispatch does not try before
+        self.assertGreater(cache.get(PAUSED_UNTIL_KEY), time.time() + 86400)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.dispatcher().run(window=0), {"C": 0, "E": 0, "P": 0, "S": 0, "D": 0})
+
+    def test_server_errors_are_retried_with_backoff(self):
+        self.stub.fail_next = 1
+        self.stub.retry_after = 120
+        self.queue(self.users[0], 2)
+
+        self.assertEqual(self.dispatcher().run(window=0), {"C": 0, "E": 0, "P": 2, "S": 0, "D": 0})
+        for message in MessageQueue.objects.all():
+            self.assertEqual(message.attempts, 1)
+            self.assertGreaterEqual(message.next_attempt_at, timezone.now() + datetime.timedelta(seconds=115))
+        # Not due yet
+        self.assertEqual(self.dispatcher().run(window=0), {"C": 0, "E": 0, "P": 0, "S": 0, "D": 0})
+
+        MessageQueue.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(self.dispatcher().run(window=0), {"C": 2, "E": 0, "P": 0, "S": 0, "D": 0})
+        self.assertEqual(len(self.stub.messages), 1)
+
+    @override_settings(PUSHOVER_MAX_ATTEMPTS=2)
+    def test_messages_failing_repeatedly_are_dead_lettered(self):
+        self.stub.failure_rate = 1
+        self.queue(self.users[0], 1)
+
+        self.assertEqual(self.dispatcher().run(window=0), {"C": 0, "E": 0, "P": 1, "S": 0, "D": 0})
+        MessageQueue.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(self.dispatcher().run(window=0), {"C": 0, "E": 0, "P": 0, "S": 0, "D": 1})
+
+        message = MessageQueue.objects.get()
+        self.assertEqual((message.status_code, message.attempts), ("D", 2))
+
+    def test_rejected_messages_fail(self):
+        self.queue(self.users[0], 1)
+        MessageQueue.objects.update(message="")
+
+        self.assertEqual(self.dispatcher().run(window=0), {"C": 0, "E": 1, "P": 0, "S": 0, "D": 0})
+
+    @override_settings(PUSHOVER_RETRY_BACKOFF=30, PUSHOVER_RETRY_BACKOFF_MAX=3600)
+    def test_backoff(self):
+        for attempts, low, high in [(1, 15, 30), (2, 30, 60), (3, 60, 120), (8, 1800, 3600), (20, 1800, 3600)]:
+            for i in range(20):
+                self.assertTrue(low <= backoff(attempts) <= high)
+        self.assertEqual(backoff(1, retry_after=300), 300)
+
+    def test_token_bucket(self):
+        clock = [0.0]
+        bucket = TokenBucket(rate=2, burst=3, clock=lambda: clock[0])
+
+        self.assertEqual([bucket.wait_time() for i in range(4)], [0, 0, 0, 0.5])
+        clock[0] = 0.5
+        self.assertEqual(bucket.wait_time(), 0)
+        bucket.pause(10)
+        self.assertEqual(bucket.wait_time(), 10)
+        self.assertFalse(bucket.acquire(timeout=5))
+
+    def test_shared_token_bucket(self):
+        clock = [0.0]
+        first, second = (SharedTokenBucket(rate=2, burst=3, key="test-rate", clock=lambda: clock[0]) for i in range(2))
+
+        # 3 tokens per 1.5s window, whichever bucket takes them
+        self.assertEqual([first.wait_time(), second.wait_time(), first.wait_time()], [0, 0, 0])
+        self.assertEqual(second.wait_time(), 1.5)
+        clock[0] = 1.5
+        self.assertEqual(second.wait_time(), 0)
+
+    def test_digest(self):
+        def message(id, title, kind, text=None, device_owner_id=None):
+            rule = RULES_BY_NAME.get(kind)
+            return MessageQueue(
+                id=id,
+                user_id=1,
+                device_owner_id=device_owner_id or id,
+                title=title,
+                kind=kind,
+                message=text or rule.message,
+            )
+
+        messages = [
+            message(1, "Kitchen", "offline"),
+            message(2, "Garage", "offline"),
+            message(3, "Porch", "offline"),
+            message(4, "Attic", "offline"),
+            message(5, "Attic", "back_online", device_owner_id=4),
+            message(6, "Kitchen", "feeding", "1/4 cup was manually dispensed from the feeder.", device_owner_id=1),
+            message(7, "Garage", "power_loss", device_owner_id=2),
+            message(8, "Garage", "power_restore", device_owner_id=2),
+            message(9, "Garage", "power_loss", device_owner_id=2),
+        ]
+
+        [digest] = digest_messages(messages)
+
+        self.assertEqual([message.id for message in digest.messages], [1, 2, 3, 6, 9])
+        self.assertEqual([message.id for message in digest.superseded], [4, 5, 7, 8])
+        self.assertEqual(digest.title, DIGEST_TITLE)
+        self.assertEqual(
+            digest.message.split("\n"),
+            [
+                "3 feeders went offline: Kitchen, Garage, Porch",
+                "Kitchen: 1/4 cup was manually dispensed from the feeder.",
+                "Garage: Power has been disconnected from your feeder. It is currently running on battery.",
+            ],
+        )
+
+        [digest] = digest_messages(messages[3:6])
+        self.assertEqual((digest.title, digest.message), ("Kitchen", "1/4 cup was manually dispensed from the feeder."))
+
+
+class PushoverClientTest(TestCase):
+    def setUp(self):
+        self.stub = PushoverStub(latency=0.05).start()
+        self.addCleanup(self.stub.stop)
+
+    def messages(self, count):
+        return [("key%d" % i, "phone", "Kitchen", "Message %d" % i, 0) for i in range(count)]
+
+    def send_many(self, messages, **kwargs):
+        async def send():
+            async with AsyncPushover(api_key="app-token", base_url=self.stub.url, **kwargs) as pushover:
+                return await pushover.send_many(messages)
+
+        start = time.perf_counter()
+        responses = asyncio.run(send())
+        return responses, time.perf_counter() - start
+
+    def test_send_many_shares_the_connection_pool(self):
+        responses, elapsed = self.send_many(self.messages(20), pool_size=10)
+
+        self.assertEqual([r.status_code for r in responses], [200] * 20)
+        self.assertEqual(
+            sorted(message["user"] for message in self.stub.messages), sorted("key%d" % i for i in range(20))
+        )
+        # Two round trips of 10 concurrent requests, one by one would take a second
+        self.assertLess(elapsed, 0.5)
+
+    def test_send_many_returns_the_failures_in_order(self):
+        self.stub.fail_next = 1
+        responses = self.send_many(self.messages(1) + [("", "phone", "Kitchen", "No user key", 0)], pool_size=1)[0]
+
+        self.assertEqual(responses[0].status_code, 500)
+        self.assertIsInstance(responses[1], ValueError)
+
+    def test_bucket_paces_the_tasks(self):
+        responses, elapsed = self.send_many(self.messages(11), pool_size=11, bucket=TokenBucket(rate=50, burst=1))
+
+        self.assertEqual([r.status_code for r in responses], [200] * 11)
+        # One token at once, the 10 others at 50 per second
+        self.assertGreaterEqual(elapsed, 0.19)
+
+    def test_sync_client(self):
+        with Pushover(api_key="app-token", base_url=self.stub.url) as pushover:
+            self.assertEqual(pushover.validate_user("key0").json()["status"], 1)
+            self.assertEqual([r.status_code for r in pushover.send_many(self.messages(4), concurrency=4)], [200] * 4)
+            self.assertEqual(self.stub.sent, 4)
+        self.assertIsNone(pushover.loop)
+
+        # Errors of the asyncio client
+        self.stub.stop()
+        with Pushover(api_key="app-token", base_url=self.stub.url) as pushover:
+            with self.assertRaises(aiohttp.ClientError):
+                pushover.send_message(*self.messages(1)[0])
@@ -0,0 +1,241 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Avg, Case, Count, F, IntegerField, Max, Min, Sum, When
+
+from .models import TelemetryRollup, TelemetrySample
+from .telemetry import telemetry_buffer
+
+log = logging.getLogger(__name__)
+
+# Telemetry values are stored as small integers: millivolts, 0.1% and 0.01 C
+SCALES = {
+    "battery_voltage": 1000,
+    "battery_soc": 10,
+    "battery_crate": 100,
+    "hopper_level": 10,
+}
+SMALLINT_MIN, SMALLINT_MAX = -32768, 32767
+
+# Rollup tiers, finest first, with the name of the TELEMETRY_RETENTION entry of each tier
+TIERS = [
+    (TelemetryRollup.Resolution.MINUTE, "minute"),
+    (TelemetryRollup.Resolution.HOUR, "hour"),
+    (TelemetryRollup.Resolution.DAY, "day"),
+]
+
+# Aggregated columns of a rollup row per telemetry value
+MIN_MAX_FIELDS = ["battery_voltage", "battery_soc", "hopper_level"]
+AVG_FIELDS = ["battery_voltage", "battery_soc", "battery_crate", "hopper_level"]
+
+
+def encode(name, value):
+    if value is None:
+        return None
+    return max(SMALLINT_MIN, min(SMALLINT_MAX, round(value * SCALES[name])))
+
+
+def decode(name, value):
+    if value is None:
+        return None
+    return value / SCALES[name]
+
+
+def record_sample(device_status):
+    """
+    Append a raw telemetry point for the device, at most once per TELEMETRY_SAMPLE_INTERVAL
+    """
+    interval = settings.TELEMETRY_SAMPLE_INTERVAL
+    if interval <= 0 or device_status.pk is None:
+        return False
+    if not cache.add("telemetry-sample:%d" % device_status.device_id, 1, interval):
+        return False
+
+    sample = TelemetrySample(
+        device_id=device_status.device_id,
+        ts=int(device_status.last_ping.timestamp()),
+        on_power=bool(device_status.on_power),
+        **{name: encode(name, getattr(device_status, name)) for name in SCALES},
+    )
+    if telemetry_buffer.enabled:
+        telemetry_buffer.add_sample(sample)
+    else:
+        sample.save()
+    return True
+
+
+def _floor(ts, resolution):
+    return ts - ts % resolution
+
+
+def _from_samples(resolution, start, end):
+    # Aggregates are aliased with "agg_" so they don't shadow the rollup columns they are read from
+    aggregates = {
+        "agg_samples": Count("id"),
+        "agg_on_power_samples": Sum(Case(When(on_power=True, then=1), default=0, output_field=IntegerField())),
+    }
+    for name in MIN_MAX_FIELDS:
+        aggregates["agg_%s_min" % name] = Min(name)
+        aggregates["agg_%s_max" % name] = Max(name)
+    for name in AVG_FIELDS:
+        aggregates["agg_%s_avg" % name] = Avg(name)
+
+    return (
+        TelemetrySample.objects.filter(ts__gte=start, ts__lt=end)
+        .annotate(rollup_bucket=F("ts") - F("ts") % resolution)
+        .values("device_id", "rollup_bucket")
+        .annotate(**aggregates)
+        .order_by()
+    )
+
+
+def _from_rollups(source_resolution, resolution, start, end):
+    aggregates = {
+        "agg_samples": Sum("samples"),
+        "agg_on_power_samples": Sum("on_power_samples"),
+    }
+    for name in MIN_MAX_FIELDS:
+        aggregates["agg_%s_min" % name] = Min("%s_min" % name)
+        aggregates["agg_%s_max" % name] = Max("%s_max" % name)
+    for name in AVG_FIELDS:
+        # Sample weighted average of the finer buckets that have a value
+        avg = "%s_avg" % name
+        aggregates["agg_%s_weighted" % name] = Sum(F(avg) * F("samples"), output_field=IntegerField())
+        aggregates["agg_%s_weight" % name] = Sum(
+            Case(When(**{"%s__isnull" % avg: False}, then=F("samples")), default=0, output_field=IntegerField())
+        )
+
+    return (
+        TelemetryRollup.objects.filter(resolution=source_resolution, bucket__gte=start, bucket__lt=end)
+        .annotate(rollup_bucket=F("bucket") - F("bucket") % resolution)
+        .values("device_id", "rollup_bucket")
+        .annotate(**aggregates)
+        .order_by()
+    )
+
+
+def _rollup_row(resolution, row):
+    rollup = TelemetryRollup(
+        device_id=row["device_id"],
+        resolution=resolution,
+        bucket=row["rollup_bucket"],
+        samples=row["agg_samples"] or 0,
+        on_power_samples=row["agg_on_power_samples"] or 0,
+    )
+    for name in MIN_MAX_FIELDS:
+        setattr(rollup, "%s_min" % name, row["agg_%s_min" % name])
+        setattr(rollup, "%s_max" % name, row["agg_%s_max" % name])
+    for name in AVG_FIELDS:
+        if "agg_%s_avg" % name in row:
+            avg = row["agg_%s_avg" % name]
+        else:
+            weight = row["agg_%s_weight" % name]
+            avg = row["agg_%s_weighted" % name] / weight if weight else None
+        setattr(rollup, "%s_avg" % name, round(avg) if avg is not None else None)
+    return rollup
+
+
+def rollup_tier(resolution, source_resolution=None, now=None, max_buckets=None):
+    """
+    Downsample the closed buckets of a tier that have not been rolled up yet, from raw samples
+    or from the next finer tier
+    """
+    now = int(now if now is not None else time.time())
+    max_buckets = max_buckets if max_buckets else settings.TELEMETRY_ROLLUP_MAX_BUCKETS
+    end = _floor(now - settings.TELEMETRY_ROLLUP_LAG, resolution)
+
+    # Start at the first source point after the last rolled up bucket, skipping gaps without data
+    last = TelemetryRollup.objects.filter(resolution=resolution).aggregate(last=Max("bucket"))["last"]
+    after = last + resolution if last is not None else 0
+    if source_resolution is None:
+        first = TelemetrySample.objects.filter(ts__gte=after).aggregate(first=Min("ts"))["first"]
+    else:
+        first = TelemetryRollup.objects.filter(resolution=source_resolution, bucket__gte=after).aggregate(
+            first=Min("bucket")
+        )["first"]
+    start = _floor(first, resolution) if first is not None else end
+
+    if source_resolution is not None:
+        # Only buckets the finer tier has fully rolled up
+        source_last = TelemetryRollup.objects.filter(resolution=source_resolution).aggregate(last=Max("bucket"))["last"]
+        end = min(end, _floor(source_last + source_resolution, resolution) if source_last is not None else start)
+
+    end = min(end, start + resolution * max_buckets)
+    if start >= end:
+        return 0
+
+    if source_resolution is None:
+        rows = _from_samples(resolution, start, end)
+    else:
+        rows = _from_rollups(source_resolution, resolution, start, end)
+
+    rollups = [_rollup_row(resolution, row) for row in rows]
+    with transaction.atomic():
+        TelemetryRollup.objects.filter(resolution=resolution, bucket__gte=start, bucket__lt=end).delete()
+        TelemetryRollup.objects.bulk_create(rollups, batch_size=1000)
+
+    log.info("Rolled up %d telemetry buckets of %ds from %d to %d", len(rollups), resolution, start, end)
+    return len(rollups)
+
+
+def rollup_telemetry(now=None):
+    counts = {}
+    source_resolution = None
+    for resolution, name in TIERS:
+        counts[name] = rollup_tier(resolution, source_resolution, now=now)
+        source_resolution = resolution
+    return counts
+
+
+def enforce_retention(now=None):
+    now = int(now if now is not None else time.time())
+    retention = settings.TELEMETRY_RETENTION
+    deleted = {"raw": TelemetrySample.objects.filter(ts__lt=now - retention["raw"]).delete()[0]}
+    for resolution, name in TIERS:
+        deleted[name] = TelemetryRollup.objects.filter(
+            resolution=resolution, bucket__lt=now - retention[name]
+        ).delete()[0]
+    return deleted
+
+
+def select_tier(start, end, now=None, max_points=None):
+    """
+    Finest rollup tier that still holds the start of the window and returns at most max_points buckets,
+    otherwise the coarsest tier. Raw samples are never read.
+    """
+    now = int(now if now is not None else time.time())
+    max_points = max_points if max_points else settings.TELEMETRY_QUERY_MAX_POINTS
+    for resolution, name in TIERS:
+        if start >= now - settings.TELEMETRY_RETENTION[name] and (end - start) / resolution <= max_points:
+            return resolution
+    return TIERS[-1][0]
+
+
+def query_telemetry(device_id, start, end, now=None, max_points=None):
+    resolution = select_tier(start, end, now=now, max_points=max_points)
+    rows = (
+        TelemetryRollup.objects.filter(
+            device_id=device_id, resolution=resolution, bucket__gte=_floor(start, resolution), bucket__lt=end
+        )
+        .order_by("bucket")
+        .values()
+    )
+
+    points = []
+    for row in rows:
+        point = {
+            "ts": row["bucket"],
+            "samples": row["samples"],
+            "on_power_ratio": row["on_power_samples"] / row["samples"] if row["samples"] else None,
+        }
+        for name in MIN_MAX_FIELDS:
+            point["%s_min" % name] = decode(name, row["%s_min" % name])
+            point["%s_max" % name] = decode(name, row["%s_max" % name])
+        for name in AVG_FIELDS:
+            point["%s_avg" % name] = decode(name, row["%s_avg" % name])
+        points.append(point)
+
+    return {"resolution": int(resolution), "start": start, "end": end, "points": points}
@@ -0,0 +1,174 @@
+import datetime
+import logging
+from bisect import bisect_right
+from calendar import timegm
+from functools import lru_cache
+
+import pytz
+from django.db import DatabaseError
+from django.utils import timezone
+
+log = logging.getLogger(__name__)
+
+SECONDS_PER_DAY = 86400
+
+
+@lru_cache(maxsize=None)
+def get_zone(name):
+    return pytz.timezone(name)
+
+
+@lru_cache(maxsize=None)
+def fixed_offset(seconds):
+    return datetime.timezone(datetime.timedelta(seconds=seconds))
+
+
+def _epoch(dt):
+    return timegm(dt.utctimetuple()) if getattr(dt, "tzinfo", None) else timegm(dt.timetuple())
+
+
+class TransitionTable:
+    """
+    UTC offsets of a timezone over one year: the UTC instants (epoch seconds) at which the offset
+    changes and the offset in seconds from each of them on
+    """
+
+    def __init__(self, name, year):
+        self.name = name
+        self.year = year
+        self.start = timegm((year, 1, 1, 0, 0, 0))
+        self.end = timegm((year + 1, 1, 1, 0, 0, 0))
+
+        zone = get_zone(name)
+        transitions = getattr(zone, "_utc_transition_times", None)
+        if not transitions:
+            # Zones without DST rules (UTC, StaticTzInfo)
+            self.transitions = [self.start]
+            self.offsets = [int(zone.utcoffset(datetime.datetime(year, 1, 1)).total_seconds())]
+            self.dst = [False]
+            return
+
+        instants = [timegm(dt.timetuple()) if dt.year > 1 else -(2**63) for dt in transitions]
+        first = max(bisect_right(instants, self.start) - 1, 0)
+        last = bisect_right(instants, self.end)
+        infos = zone._transition_info[first:last]
+        self.transitions = [max(instant, self.start) for instant in instants[first:last]]
+        self.offsets = [int(utcoffset.total_seconds()) for utcoffset, dst, tzname in infos]
+        self.dst = [bool(dst) for utcoffset, dst, tzname in infos]
+
+    def _index(self, ts):
+        return max(bisect_right(self.transitions, ts) - 1, 0)
+
+    def offset(self, ts):
+        """
+        UTC offset in seconds at a UTC timestamp of the year
+        """
+        return self.offsets[self._index(ts)]
+
+    def local_offset(self, local_ts):
+        """
+        UTC offset in seconds of a local wall clock timestamp. Like pytz localize() with is_dst=False,
+        a time repeated when DST ends resolves to standard time and a time skipped when DST starts
+        keeps the standard offset.
+        """
+        i = self._index(local_ts - self.offset(local_ts))
+        candidates = range(max(i - 1, 0), min(i + 2, len(self.offsets)))
+        valid = [j for j in candidates if self._index(local_ts - self.offsets[j]) == j]
+        if len(valid) == 1:
+            return self.offsets[valid[0]]
+        # Ambiguous (two valid offsets) or skipped (none): prefer standard time
+        options = valid or [j for j in candidates if j <= i]
+        standard = [j for j in options if not self.dst[j]]
+        return self.offsets[(standard or options)[0]]
+
+
+@lru_cache(maxsize=1024)
+def transition_table(name, year):
+    # The year is always given, so the warm-up and the lookups share the cache keys
+    return TransitionTable(name, year)
+
+
+def warm_transition_tables(year=None):
+    """
+    Build the transition tables of every zone users can pick (PosixTimezone) for the year (the current
+    one by default), called when a server process starts so requests only do table lookups
+    """
+    from .models import PosixTimezone
+
+    year = year or timezone.now().year
+
+    try:
+        names = list(PosixTimezone.objects.values_list("timezone", flat=True).distinct())
+    except DatabaseError:
+        log.exception("Could not load the timezones to warm up")
+        return 0
+    count = 0
+    for name in names:
+        try:
+            transition_table(name, year)
+            count += 1
+        except pytz.UnknownTimeZoneError:
+            log.warning("Unknown timezone %s", name)
+    return count
+
+
+def _table_for(name, ts):
+    year = datetime.datetime.utcfromtimestamp(ts).year
+    return transition_table(name, year)
+
+
+def utc_times_to_local(times, name, on=None):
+    """
+    Convert UTC times of day to the zone's local times of day, on the given date (today by default)
+    """
+    day = _epoch(on or timezone.now().date())
+    table = _table_for(name, day)
+    local_times = []
+    for t in times:
+        ts = day + t.hour * 3600 + t.minute * 60 + t.second
+        local_times.append(_time_of_day(ts + table.offset(ts)))
+    return local_times
+
+
+def local_times_to_utc(times, name, on=None):
+    """
+    Convert local times of day in the zone to UTC times of day, on the given date (today by default)
+    """
+    day = _epoch(on or timezone.now().date())
+    table = _table_for(name, day)
+    utc_times = []
+    for t in times:
+        local_ts = day + t.hour * 3600 + t.minute * 60 + t.second
+        utc_times.append(_time_of_day(local_ts - table.local_offset(local_ts)))
+    return utc_times
+
+
+def timestamps_to_local(datetimes, name):
+    """
+    Convert aware datetimes to the zone, as datetimes with a fixed offset tzinfo
+    """
+    local_datetimes = []
+    table = None
+    for dt in datetimes:
+        ts = _epoch(dt)
+        if table is None or not table.start <= ts < table.end:
+            table = _table_for(name, ts)
+        local_datetimes.append(dt.astimezone(fixed_offset(table.offset(ts))))
+    return local_datetimes
+
+
+def utc_time_to_local(t, name, on=None):
+    return utc_times_to_local([t], name, on)[0]
+
+
+def local_time_to_utc(t, name, on=None):
+    return local_times_to_utc([t], name, on)[0]
+
+
+def timestamp_to_local(dt, name):
+    return timestamps_to_local([dt], name)[0]
+
+
+def _time_of_day(ts):
+    seconds = ts % SECONDS_PER_DAY
+    return datetime.time(seconds // 3600, seconds % 3600 // 60, seconds % 60)
@@ -27,6 +27,7 @@ from .views import (
     help_page,
     index,
     manual_feed,
+    metrics,
     pushover_verify,
     remove_feeder,
     remove_pet,
@@ -65,4 +66,5 @@ urlpatterns = [
     path("setup/", setup, name="setup"),
     path("help/", help_page, name="help"),
     path("manual-feed/<int:device_owner_id>/", manual_feed, name="manual-feed"),
+    path("metrics/", metrics, name="metrics"),
 ]
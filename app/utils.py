@@ -1,7 +1,7 @@
 import hashlib
 import json
 import time
-from datetime import date, datetime
+from datetime import datetime, timedelta
 from fractions import Fraction
 
 import psutil
@@ -9,13 +9,17 @@ import pytz
 from django.conf import settings
 from django.core import serializers
 from django.core.exceptions import ObjectDoesNotExist
-from django.db.models import F
+from django.db import transaction
+from django.db.models import Exists, Max, OuterRef, Q
 from django.utils import timezone
 from PIL import Image
 
 from smart_petfeeder.settings import DEBUG
 
-from .models import Device, DeviceOwner, DeviceStatus, EventQueue, FeedingSchedule, Settings
+from .models import Device, DeviceOwner, DeviceStatus, EventQueue, Settings
+from .next_meal import get_meal_indexes, minute_of_week
+from .telemetry import record_ping, telemetry_buffer
+from .timezones import timestamps_to_local, utc_time_to_local
 
 
 def uptime(boot_time):
@@ -26,51 +30,39 @@ def weekday_sun_zero(isoweekday):
     return 0 if isoweekday == 7 else isoweekday
 
 
-def get_next_feeding(device_id, the_timezone="UTC"):
-    current_tz = pytz.timezone(the_timezone)
-    dow = weekday_sun_zero(datetime.now().isoweekday())
-    current_time = datetime.now().time()
-    dow_bit = 2**dow
-    day = "today"
-    rs = (
-        FeedingSchedule.objects.annotate(dow_filter=F("dow").bitand(dow_bit))
-        .filter(
-            dow_filter__gt=0,
-            time__range=[current_time, "23:59:59"],
-            active_flag=1,
-            device_id=device_id,
-        )
-        .order_by("time")
-        .first()
-    )
-    if rs is None:
-        dow = 0 if dow == 6 else dow + 1
-        dow_bit = 2**dow
-        rs = (
-            FeedingSchedule.objects.annotate(dow_filter=F("dow").bitand(dow_bit))
-            .filter(
-                dow_filter__gt=0,
-                active_flag=1,
-                device_id=device_id,
-            )
-            .order_by("time")
-            .first()
-        )
-        day = "tomorrow"
-
-    if rs:
+def get_next_feeding(device_id, the_timezone="UTC", now=None, index=None):
+    """
+    Next scheduled meal of the device from its meal index, looking ahead a whole week
+    """
+    now = now or timezone.now()
+    if index is None:
+        index = get_meal_indexes([device_id])[device_id]
+
+    next_meal = index.next_meal(minute_of_week(now.astimezone(pytz.utc)))
+    if next_meal:
+        minutes, meal = next_meal
+        feed_datetime = now.replace(second=0, microsecond=0) + timedelta(minutes=minutes)
+        local_feed, local_now = timestamps_to_local([feed_datetime, now], the_timezone)
+        days = (local_feed.date() - local_now.date()).days
+        if days == 0:
+            day = "today"
+        elif days == 1:
+            day = "tomorrow"
+        else:
+            day = local_feed.strftime("on %A")
+
         data = {
             "device_id": device_id,
             "has_meal": 1,
-            "meal_id": rs.id,
-            "meal_name": rs.meal_name,
-            "pet_name": rs.pet.name,
-            "size": str(Fraction(rs.motor_timing.feed_amount)),
-            "duration": rs.motor_timing.motor_duration,
-            "interrupter_count": rs.motor_timing.interrupter_count,
-            "feed_time": rs.time,
-            "feed_time_utc": str(rs.time),
-            "feed_time_tz": str(convert_time_to_timezone(rs.time, the_timezone)),
+            "meal_id": meal["id"],
+            "meal_name": meal["meal_name"],
+            "pet_name": meal["pet_name"],
+            "size": str(Fraction(meal["feed_amount"])),
+            "duration": meal["motor_duration"],
+            "interrupter_count": meal["interrupter_count"],
+            "feed_time": meal["time"],
+            "feed_time_utc": str(meal["time"]),
+            "feed_time_tz": str(convert_time_to_timezone(meal["time"], the_timezone)),
             "day": day,
         }
     else:
@@ -80,7 +72,7 @@ def get_next_feeding(device_id, the_timezone="UTC"):
             "meal_id": 0,
             "meal_name": "No scheduled meal",
             "pet_name": "",
-            "size": "today or tomorrow",
+            "size": "this week",
             "duration": "",
             "interrupter_count": "",
             "feed_time": "",
@@ -91,16 +83,27 @@ def get_next_feeding(device_id, the_timezone="UTC"):
 
     if DEBUG:
         data["debug"] = {
-            "current_time": current_time,
+            "current_time": now.time(),
             "timezone": the_timezone,
         }
 
     return data
 
 
+def get_next_feedings(device_ids, the_timezone="UTC"):
+    """
+    Next scheduled meal of each device, {device_id: next meal}
+    """
+    now = timezone.now()
+    indexes = get_meal_indexes(device_ids)
+    return {
+        device_id: get_next_feeding(device_id, the_timezone, now=now, index=index)
+        for device_id, index in indexes.items()
+    }
+
+
 def convert_time_to_timezone(utctime, the_timezone):
-    dt = datetime.combine(date.today(), utctime, tzinfo=pytz.UTC)
-    return dt.astimezone(pytz.timezone(the_timezone)).time()
+    return utc_time_to_local(utctime, the_timezone)
 
 
 def seconds_to_days(time):
@@ -130,27 +133,99 @@ def get_settings(user_id=None):
 
 
 def update_ping(device_id):
-    try:
-        device_status = DeviceStatus.objects.get(device_id=device_id)
-        device_status.last_ping = timezone.now()
-    except ObjectDoesNotExist:
-        device_status = DeviceStatus(device_id=device_id)
+    if not record_ping(device_id):
+        DeviceStatus.objects.get_or_create(device_id=device_id)
 
-    device_status.save()
 
+def update_has_event_tasks(device_id, ping=False):
+    """
+    Recompute has_event of the device in a single UPDATE, optionally recording a ping as well
+    """
+    now = timezone.now()
+    updates = {"has_event": Exists(EventQueue.objects.filter(device_owner__device_id=device_id, status_code="P"))}
+    if ping and not (telemetry_buffer.enabled and telemetry_buffer.touch(device_id)):
+        updates["last_ping"] = now
+    DeviceStatus.objects.filter(device_id=device_id).update(updated_at=now, **updates)
+
+
+def queue_events(events):
+    """
+    Queue pending events for many device owners at once, events is an iterable of
+    (device_owner_id, event_code). Like the signal receivers, an event already pending for the owner
+    is not queued again. The devices get has_event set and the long-polling feeders are woken up.
+    """
+    from .event_channel import publish_event
+
+    events = set(events)
+    if not events:
+        return 0
+    owner_ids = {device_owner_id for device_owner_id, event_code in events}
+    pending = set(
+        EventQueue.objects.filter(
+            device_owner_id__in=owner_ids,
+            event_code__in={event_code for device_owner_id, event_code in events},
+            status_code="P",
+        ).values_list("device_owner_id", "event_code")
+    )
+    new_events = sorted(events - pending)
+    EventQueue.objects.bulk_create(
+        [
+            EventQueue(device_owner_id=device_owner_id, event_code=event_code)
+            for device_owner_id, event_code in new_events
+        ]
+    )
+
+    device_ids = set(DeviceOwner.objects.filter(id__in=owner_ids).values_list("device_id", flat=True))
+    with_status = set(DeviceStatus.objects.filter(device_id__in=device_ids).values_list("device_id", flat=True))
+    DeviceStatus.objects.filter(device_id__in=with_status).update(has_event=True, updated_at=timezone.now())
+    DeviceStatus.objects.bulk_create(
+        [DeviceStatus(device_id=device_id, has_event=True) for device_id in sorted(device_ids - with_status)],
+        ignore_conflicts=True,
+    )
+
+    for device_owner_id in sorted({device_owner_id for device_owner_id, event_code in new_events}):
+        transaction.on_commit(lambda device_owner_id=device_owner_id: publish_event(device_owner_id))
+    return len(new_events)
+
+
+# Events that only tell the feeder to sync its schedule (300) or settings (400): the latest one stands for the
+# older ones of its code. The others carry their own payload, e.g. a manual feed (100), and are delivered and
+# completed one by one.
+COALESCED_EVENT_CODES = (300, 400)
 
-def update_has_event_tasks(device_id):
-    event = EventQueue.objects.filter(device_owner__device_id=device_id, status_code="P")
-    try:
-        status = DeviceStatus.objects.get(device_id=device_id)
-        if event.exists():
-            status.has_event = True
-        else:
-            status.has_event = False
-        status.save()
 
-    except ObjectDoesNotExist:
-        pass
+def pending_events(device_id, limit=None):
+    """
+    Pending events of the device, oldest first. Only the latest event of each coalesced event code is
+    returned, completing it completes the older ones of the same code (see complete_events).
+    """
+    pending = EventQueue.objects.filter(device_owner__device_id=device_id, status_code="P")
+    latest = (
+        pending.filter(event_code__in=COALESCED_EVENT_CODES)
+        .values("event_code")
+        .annotate(latest_id=Max("id"))
+        .values("latest_id")
+    )
+    events = (
+        pending.filter(Q(id__in=latest) | ~Q(event_code__in=COALESCED_EVENT_CODES))
+        .order_by("created_at", "id")
+        .values()
+    )
+    if limit:
+        events = events[:limit]
+    return list(events)
+
+
+def complete_events(device_id, ids):
+    """
+    Complete the given pending events of the device, and the older pending events of a coalesced code
+    they superseded, in one UPDATE. Returns the number of completed events.
+    """
+    pending = EventQueue.objects.filter(device_owner__device_id=device_id, status_code="P")
+    superseding = pending.filter(
+        id__in=ids, event_code__in=COALESCED_EVENT_CODES, event_code=OuterRef("event_code"), id__gte=OuterRef("id")
+    )
+    return pending.filter(Q(id__in=ids) | Exists(superseding)).update(status_code="C", updated_at=timezone.now())
 
 
 def get_device_id(device_key=None, user_id=None):
@@ -174,6 +249,19 @@ def update_setting(key, value, user_id=None):
         return False
 
 
+def update_settings(values, user_id):
+    """
+    Write several settings of a user without the per-row post_save signal, the caller queues the events
+    """
+    existing = {setting.name: setting for setting in Settings.objects.filter(user_id=user_id, name__in=values)}
+    for setting in existing.values():
+        setting.value = values[setting.name]
+    Settings.objects.bulk_update(existing.values(), ["value"])
+    Settings.objects.bulk_create(
+        [Settings(user_id=user_id, name=name, value=value) for name, value in values.items() if name not in existing]
+    )
+
+
 def xss_token(action, key):
     s = "%s%s-%d" % (settings.SECRET_KEY, action, int(key))
     encoded_str = s.encode()
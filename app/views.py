@@ -7,21 +7,24 @@ import uuid
 from itertools import chain
 from time import sleep
 
-import pytz
 from django.conf import settings
 from django.conf.urls.static import static
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import ObjectDoesNotExist
-from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseRedirect, JsonResponse
 from django.shortcuts import redirect, render
 from django.template.defaultfilters import filesizeformat
 from django.utils import timezone
 from PIL import Image
 
-from app.tasks import send_pushover_notification
+from app.tasks import rebuild_feeding_rollups, send_pushover_notification
 
+from .device_events import device_events
+from .feeder_overview import get_user_settings, load_feeder_overview
 from .forms import PetForm
+from .hopper import invalidate_user_feeders, refill
+from .metrics import can_read_metrics, render_prometheus, request_metrics
 from .models import (
     AnimalSize,
     AnimalType,
@@ -31,9 +34,7 @@ from .models import (
     DeviceOwner,
     DeviceStatus,
     EventQueue,
-    FirmwareUpdate,
     FeederModel,
-    FeedingLog,
     FeedingSchedule,
     MessageQueue,
     MotorTiming,
@@ -43,16 +44,12 @@ from .models import (
     Settings,
 )
 from .pushover.client import Pushover
+from .schedule_sync import rebase_schedules
+from .timezones import local_time_to_utc
 from .utils import (
-    battery_time,
     generate_device_key,
-    get_next_feeding,
     is_device_registered,
     resize_and_crop,
-    seconds_to_days,
-    update_has_event_tasks,
-    update_setting,
-    uptime,
     xss_token,
 )
 
@@ -79,44 +76,9 @@ def index(request):
 
 @login_required
 def dashboard(request):
-    s = Settings.objects.filter(user_id=request.user.id).values()
-    user_settings = {row["name"]: row["value"] for row in s}
+    user_settings = get_user_settings(request)
     timezone = user_settings["timezone"] if "timezone" in user_settings else "UTC"
-    devices = DeviceOwner.objects.filter(user_id=request.user.id).order_by("name")
-    devices_owned = []
-
-    for i in devices:
-        devices_owned.append(i.device_id)
-
-    device_info = []
-    i = 0
-
-    for device in devices:
-        device_status = DeviceStatus.objects.get(device_id=device.device_id)
-
-        online = True
-        last_ping = uptime(device_status.last_ping)
-        if last_ping > 500:
-            online = False
-
-        log.debug("Last ping: %d" % last_ping)
-        next_meal = get_next_feeding(device.device_id, user_settings["timezone"])
-        feedings = FeedingLog.objects.filter(device_owner__device_id=device.device_id).order_by("-feed_timestamp")[:5]
-
-        crate_time = battery_time(device_status.battery_soc, device_status.battery_crate)
-
-        device_info.append(
-            {
-                "uptime": seconds_to_days(uptime(device_status.last_boot)),
-                "next_meal": next_meal,
-                "feedings": feedings,
-                "device": device,
-                "online": "Online" if online else "Offline",
-                "device_status": device_status,
-                "crate_time": str(datetime.timedelta(seconds=crate_time)),
-            }
-        )
-        i += 1
+    device_info = load_feeder_overview(request.user.id, timezone, feedings=5)
 
     data = {
         "title": "Smart PetFeeder Home Page",
@@ -230,18 +192,7 @@ def remove_schedule(request):
             try:
                 schedule = FeedingSchedule.objects.get(id=schedule_id, device__deviceowner__user_id=request.user.id)
                 messages.success(request, "Feeding time was successfully removed.")
-                try:
-                    eq = EventQueue.objects.filter(
-                        device_owner_id=schedule.device_owner_id, event_code=300, status_code="P"
-                    )
-                    if not len(eq):
-                        event_queue = EventQueue(
-                            device_owner_id=schedule.device_owner_id, event_code=300, status_code="P"
-                        )
-                        event_queue.save()
-                        update_has_event_tasks(schedule.device_id)
-                except Exception as e:
-                    messages.error(request, "Internal Error. Error creating event queue: %s" % e)
+                device_events.add(schedule.device_owner_id, 300, debounce=True)
                 schedule.delete()
             except ObjectDoesNotExist:
                 messages.error(request, "Feeding time was not found.")
@@ -309,36 +260,15 @@ def add_edit_schedule(request, schedule_id=None):
         try:
             feeding_time = "%s:00" % request.POST["time"]
             schedule.local_time = feeding_time
-            current = datetime.datetime.now()
-            local_datetime_str = "%04d-%02d-%02d %s" % (
-                current.year,
-                current.month,
-                current.day,
-                feeding_time,
-            )
-            local_tz = pytz.timezone(timezone)
-            naive_datetime = datetime.datetime.strptime(local_datetime_str, "%Y-%m-%d %H:%M:%S")
-            local_datetime = local_tz.localize(naive_datetime)
-            utc_datetime = local_datetime.astimezone(pytz.utc)
-            schedule.time = utc_datetime.strftime("%H:%M:%S")
+            local_time = datetime.datetime.strptime(feeding_time, "%H:%M:%S").time()
+            schedule.time = local_time_to_utc(local_time, timezone).strftime("%H:%M:%S")
         except KeyError:
             messages.error(request, "Not saved. Please enter feeding time.")
             error = True
 
         if not error:
             if previous_device_owner is not None:
-                try:
-                    eq = EventQueue.objects.filter(
-                        device_owner_id=previous_device_owner.id, event_code=300, status_code="P"
-                    )
-                    if not len(eq):
-                        event_queue = EventQueue(
-                            device_owner_id=previous_device_owner.id, event_code=300, status_code="P"
-                        )
-                        event_queue.save()
-                        update_has_event_tasks(previous_device_owner.device_id)
-                except Exception as e:
-                    messages.error(request, "Internal Error. Error creating event queue: %s" % e)
+                device_events.add(previous_device_owner.id, 300, debounce=True)
             schedule.save()
 
             if schedule_id is None:
@@ -574,55 +504,9 @@ def remove_pet(request):
 
 @login_required
 def feeders(request):
-    s = Settings.objects.filter(user_id=request.user.id).values()
-    user_settings = {row["name"]: row["value"] for row in s}
+    user_settings = get_user_settings(request)
     timezone = user_settings["timezone"] if "timezone" in user_settings else "UTC"
-    devices = DeviceOwner.objects.filter(user_id=request.user.id).order_by("name")
-    devices_owned = []
-
-    for i in devices:
-        devices_owned.append(i.device_id)
-
-    data = {}
-    device_info = []
-    i = 0
-
-    for device in devices:
-        try:
-            device_status = DeviceStatus.objects.get(device_id=device.device_id)
-
-            online = True
-            last_ping = uptime(device_status.last_ping)
-            if last_ping > 500:
-                online = False
-
-            log.debug("Last ping: %d" % last_ping)
-            next_meal = get_next_feeding(device.device_id, user_settings["timezone"])
-            feedings = FeedingLog.objects.filter(device_owner__device_id=device.device_id).order_by("-feed_timestamp")[
-                :5
-            ]
-
-            crate_time = battery_time(device_status.battery_soc, device_status.battery_crate)
-
-            firmware_update = (
-                FirmwareUpdate.objects.filter(control_board__revision=device_status.control_board_revision)
-                .order_by("-created_at")
-                .first()
-            )
-
-            device_info.append(
-                {
-                    "uptime": seconds_to_days(uptime(device_status.last_boot)),
-                    "device": device,
-                    "online": "Online" if online else "Offline",
-                    "device_status": device_status,
-                    "crate_time": str(datetime.timedelta(seconds=crate_time)),
-                    "firmware_update": firmware_update,
-                }
-            )
-            i += 1
-        except ObjectDoesNotExist:
-            log.error("Unable to get DeviceStatus")
+    device_info = load_feeder_overview(request.user.id, timezone, firmware=True)
 
     data = {
         "title": "Registered Feeders",
@@ -654,8 +538,9 @@ def edit_feeder(request, device_owner_id):
         device_owner.feeder_model_id = feeder_model_id
         device_owner.manual_motor_timing_id = request.POST["manual_motor_timing_id"]
         device_owner.manual_button = True if "manual_button" in request.POST else False
-        device_status.hopper_level = request.POST.get("hopper_level", 0)
-        device_status.save(update_fields=["hopper_level"])
+        hopper_level = float(request.POST.get("hopper_level", 0))
+        if hopper_level != device_status.hopper_level:
+            refill(device_owner.device_id, hopper_level)
         device_owner.save()
         messages.success(request, "Settings have been saved.")
         return HttpResponseRedirect("/feeders/")
@@ -783,28 +668,12 @@ def settings(request):
 
             if old_settings != ptz.timezone:
                 log.info("Timezone changed, updating feeding times to %s timezone", ptz.timezone)
-                update_setting("timezone", ptz.timezone, request.user.id)
-                update_setting("tz_esp32", ptz.posix_tz, request.user.id)
+                rebase_schedules(request.user.id, ptz.timezone, ptz.posix_tz)
+                # The daily rollups are per day of the user's timezone
+                invalidate_user_feeders(request.user.id)
+                rebuild_feeding_rollups.apply_async(args=[request.user.id])
                 devices = DeviceOwner.objects.filter(user_id=request.user.id)
 
-                scheduled_feedings = FeedingSchedule.objects.filter(device_owner__user_id=request.user.id)
-                for schedule in scheduled_feedings:
-                    log.info("processing feeding schedule id: %d", schedule.id)
-                    feeding_time = schedule.local_time
-                    current = datetime.datetime.now()
-                    local_datetime_str = "%04d-%02d-%02d %s" % (
-                        current.year,
-                        current.month,
-                        current.day,
-                        feeding_time,
-                    )
-                    local_tz = pytz.timezone(ptz.timezone)
-                    naive_datetime = datetime.datetime.strptime(local_datetime_str, "%Y-%m-%d %H:%M:%S")
-                    local_datetime = local_tz.localize(naive_datetime)
-                    utc_datetime = local_datetime.astimezone(pytz.utc)
-                    schedule.time = utc_datetime.strftime("%H:%M:%S")
-                    schedule.save()
-
                 if len(devices):
                     messages.success(request, "Settings Saved. Changes are being synced with feeders.")
                 else:
@@ -879,8 +748,8 @@ def pushover_verify(request, user_key):
     if user_key is None:
         raise ValueError("user_key is required.")
 
-    c = Pushover()
-    r = c.validate_user(user_key)
+    with Pushover(pool_size=1) as c:
+        r = c.validate_user(user_key)
 
     return HttpResponse(r.text, content_type="application/json")
 
@@ -942,3 +811,14 @@ def help_page(request):
 @login_required
 def feeder_calibration(request):
     return render(request, "placeholder.html", context={"title": "Calibrating Your Feeder"})
+
+
+def metrics(request):
+    """
+    Request metrics of all the workers in the Prometheus text format
+    """
+    if not can_read_metrics(request):
+        return HttpResponseForbidden()
+    return HttpResponse(
+        render_prometheus(request_metrics.collect()), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
@@ -14,3 +14,7 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'smart_petfeeder.settings')
 
 application = get_asgi_application()
+
+from app.timezones import warm_transition_tables  # noqa: E402
+
+warm_transition_tables()
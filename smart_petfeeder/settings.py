@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.0/ref/settings/
 """
 import os.path
+import sys
 from pathlib import Path
 
 from .settings_secret import *  # noqa
@@ -25,6 +26,9 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
 
+# Running the test suite (manage.py test), which needs no external service
+TESTING = len(sys.argv) > 1 and sys.argv[1] == "test"
+
 # Set IS_STAGING to True if you want to use the staging/development website
 IS_STAGING = False
 
@@ -65,6 +69,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "app.middleware.metrics.RequestMetricsMiddleware",
     "app.middleware.cloudflare.CloudflareMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -213,6 +218,128 @@ REST_FRAMEWORK = {
     },
 }
 
+# Redis server shared by the web, ASGI and celery processes, e.g. by the device event channel below
+REDIS_URL = "redis://127.0.0.1:6379"
+
+# Cache
+# https://docs.djangoproject.com/en/4.0/topics/cache/
+#
+# The local memory cache is per process. To share cached entries between gunicorn workers, point the default
+# cache to the Redis server instead, e.g.
+#
+#     "BACKEND": "django.core.cache.backends.redis.RedisCache",
+#     "LOCATION": REDIS_URL + "/1",
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+}
+
+# Device key to device owner resolution cache used by the device API (seconds). The alias must be a shared backend
+# (Redis) for removed and re-keyed feeders to be invalidated in every worker. With a per-process backend only the
+# local tier is used and the other workers serve a stale entry for up to DEVICE_OWNER_LOCAL_CACHE_TIMEOUT.
+DEVICE_OWNER_CACHE_ALIAS = "default"
+DEVICE_OWNER_CACHE_TIMEOUT = 300
+DEVICE_OWNER_LOCAL_CACHE_TIMEOUT = 5
+DEVICE_OWNER_LOCAL_CACHE_SIZE = 1024
+
+# Most feeds a feeder can upload at once to api/feeding-log/batch/
+FEEDING_LOG_BATCH_SIZE = 100
+# Feeding log rows older than this many days are moved to app_feeding_log_archive by the archive_feeding_log
+# command (run it daily from cron or celery beat). Dashboards and hopper reconciliation only read the recent rows.
+FEEDING_LOG_HOT_DAYS = 90
+# Archived feeding log row counts used to paginate the full history, cached until the next archive run (seconds)
+FEEDING_LOG_ARCHIVE_COUNT_TIMEOUT = 24 * 3600
+# Feeders whose daily consumption rollups are rebuilt per transaction by the backfill_feeding_rollups command
+FEEDING_ROLLUP_BATCH_SIZE = 100
+# Longest date range served by api/feeding-consumption/ (days)
+FEEDING_CONSUMPTION_MAX_DAYS = 366
+
+# Device, owner, hopper capacity and owner's timezone of a feeder looked up for every dispensed feed (app.hopper,
+# seconds). Only cached when the default cache is shared (Redis), so that changes made in one worker are seen by the
+# others and by celery.
+FEEDER_CACHE_TIMEOUT = 300
+# Devices whose hopper level is recomputed from the feeding log per UPDATE by app.tasks.reconcile_hopper_levels
+HOPPER_RECONCILE_BATCH_SIZE = 500
+
+# Next meal index of each feeder (app.next_meal), rebuilt when its schedule changes (seconds). Only cached when the
+# default cache is shared (Redis): a per-process cache would keep serving the old index in the other workers.
+NEXT_MEAL_CACHE_TIMEOUT = 300
+# Minutes ahead the scheduled feeds of the fleet are counted by app.tasks.forecast_feed_load (run it from celery beat),
+# a warning is logged when FEED_LOAD_WARNING feeders or more are scheduled within the same minute
+FEED_LOAD_FORECAST_MINUTES = 60
+FEED_LOAD_WARNING = 1000
+
+# Heartbeat telemetry (last_ping, battery and power) write coalescing, in seconds.
+# 0 writes every heartbeat to DeviceStatus, e.g. 10 buffers the pings in each worker and flushes them
+# with one bulk UPDATE every 10 seconds.
+TELEMETRY_COALESCE_INTERVAL = 0
+TELEMETRY_FLUSH_CHUNK_SIZE = 100
+
+# Battery and hopper telemetry history (app.timeseries), in seconds.
+# A raw sample is kept at most once per TELEMETRY_SAMPLE_INTERVAL per feeder (0 disables the history) and
+# rolled up into 1-minute, 1-hour and 1-day tiers by the app.tasks.rollup_device_telemetry task.
+TELEMETRY_SAMPLE_INTERVAL = 60
+TELEMETRY_ROLLUP_LAG = 120
+TELEMETRY_ROLLUP_MAX_BUCKETS = 1440
+TELEMETRY_QUERY_MAX_POINTS = 500
+TELEMETRY_RETENTION = {
+    "raw": 2 * 86400,
+    "minute": 14 * 86400,
+    "hour": 180 * 86400,
+    "day": 5 * 365 * 86400,
+}
+
+# Long-polling feeders (api/event/wait/, served by the ASGI application) are woken through this channel when an
+# event is enqueued for them. The events are enqueued by the WSGI and celery workers, separate processes from the ASGI
+# workers, so the channel must be shared through Redis (REDIS_URL). None only wakes requests waiting in the same
+# process, which is enough for development and the tests; a warning is logged when it is used with DEBUG off.
+DEVICE_EVENT_CHANNEL_URL = None if TESTING else REDIS_URL + "/2"
+DEVICE_EVENT_LONGPOLL_TIMEOUT = 30
+# Most pending events returned to a feeder at once, by heartbeat and api/event/wait/
+DEVICE_EVENT_BATCH_SIZE = 10
+# Seconds a schedule change waits before the feeder is told to sync, edits within the window end in a single sync.
+# Debounced events are queued by a celery task (app.tasks.flush_device_events), 0 queues them on commit. The web and
+# celery workers share the debounce through the default cache, which must be shared (Redis), otherwise a warning is
+# logged and the events are queued on commit.
+DEVICE_EVENT_DEBOUNCE = 0
+
+# Per view request metrics (app.metrics), served in the Prometheus text format at metrics/ to staff users and to
+# scrapers sending "Authorization: Bearer <REQUEST_METRICS_TOKEN>". Each gunicorn worker keeps its histograms in
+# memory and writes them to its own file in REQUEST_METRICS_DIR every REQUEST_METRICS_FLUSH_INTERVAL seconds, the
+# endpoint adds up the files of all the workers. Without a directory only the worker answering the scrape is
+# reported. Empty the directory when gunicorn is restarted, e.g. REQUEST_METRICS_DIR = "/run/smart_petfeeder/metrics"
+REQUEST_METRICS_DIR = None
+REQUEST_METRICS_FLUSH_INTERVAL = 10
+REQUEST_METRICS_TOKEN = None
+# Slowest query fingerprints kept per view
+REQUEST_METRICS_SLOW_QUERIES = 5
+
+# Pushover notifications (app.pushover). The pending MessageQueue rows of PUSHOVER_BATCH_SIZE users are claimed at
+# a time and sent by PUSHOVER_CONCURRENCY threads, at most PUSHOVER_RATE messages per second with bursts
+# of PUSHOVER_BURST. The rate is shared by the workers through the default cache, which must be shared (Redis) for
+# it to hold across workers. Point PUSHOVER_API_URL to the local stub (manage.py pushover_stub) for throughput tests.
+PUSHOVER_API_URL = "https://api.pushover.net"
+PUSHOVER_TIMEOUT = 10
+PUSHOVER_BATCH_SIZE = 50
+PUSHOVER_CONCURRENCY = 4
+PUSHOVER_RATE = 5
+PUSHOVER_BURST = 10
+# Longest run of a dispatch task, the messages still pending are left for the next one (seconds)
+PUSHOVER_DISPATCH_MAX_SECONDS = 240
+# Claimed messages are hidden from the other dispatchers while they are sent, longer than a dispatch run and a
+# request timeout. The messages of a dispatcher that died are sent again after it (seconds).
+PUSHOVER_CLAIM_TIMEOUT = 300
+# A user's pending messages are held until the oldest is this old, then sent as one digest, so an offline alert
+# followed by back online cancels out and several feeders going offline make one notification (seconds)
+PUSHOVER_DIGEST_WINDOW = 60
+# A message failing transiently (5xx, no connection) is retried after PUSHOVER_RETRY_BACKOFF seconds, doubling up to
+# PUSHOVER_RETRY_BACKOFF_MAX, and moved to the dead letter status after PUSHOVER_MAX_ATTEMPTS attempts
+PUSHOVER_MAX_ATTEMPTS = 6
+PUSHOVER_RETRY_BACKOFF = 30
+PUSHOVER_RETRY_BACKOFF_MAX = 3600
+
 MEDIA_URL = "/media/"
 MEDIA_ROOT = os.path.join(BASE_DIR, "media/")
 
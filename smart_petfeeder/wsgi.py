@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'smart_petfeeder.settings')
 
 application = get_wsgi_application()
+
+from app.timezones import warm_transition_tables  # noqa: E402
+
+warm_transition_tables()